@@ -1,6 +1,6 @@
 import click
 
-from controller_cli import connect, discover
+from controller_cli import COMMANDS, LazyGroup
 
 
 __author__ = """Dave Curtis"""
@@ -8,13 +8,10 @@ __email__ = 'dave@dcurtis.co.uk'
 __version__ = '0.1.0'
 
 
-@click.group()
+@click.group(cls=LazyGroup, lazy_subcommands=COMMANDS)
 def cli():
     pass
 
 
-cli.add_command(connect)
-cli.add_command(discover)
-
 if __name__ == "__main__":
     cli()
\ No newline at end of file
@@ -1,2 +1,17 @@
-from .connect import connect
-from .discover import discover
\ No newline at end of file
+"""
+Controller subcommands. They are imported when invoked, see `LazyGroup`.
+"""
+
+from .lazy import LazyGroup
+
+COMMANDS: dict[str, str] = {
+    "connect": "controller_cli.connect:connect",
+    "discover": "controller_cli.discover:discover",
+    "capture": "controller_cli.capture:capture",
+    "analyse": "controller_cli.analyse:analyse_command",
+    "supervise": "controller_cli.supervisor:supervise",
+    "daemon": "controller_cli.daemon:daemon",
+    "run": "controller_cli.run:run",
+    "proxy": "controller_cli.proxy:proxy",
+    "upload": "controller_cli.transfer:upload",
+}
@@ -0,0 +1,291 @@
+"""
+Traffic analyser
+----------------
+
+Batch analysis of capture files (see `controller_cli.capture`) or pcap files of OCP.1 over UDP.
+Records are streamed through a generator pipeline
+
+    records -> PDUs -> decoded PDUs -> TrafficReport
+
+so memory use depends on the number of devices, objects and methods seen, not on the size of
+the capture. Large files can be split at record boundaries and analysed by a process pool,
+the per-chunk reports are then merged in file order.
+"""
+
+import logging
+import time
+import click
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, Optional, Union
+
+from ocacomms.OcaCapture import CaptureReader, PcapReader, RecordKind, open_capture
+from controller_cli.metrics import Histogram
+from ocacore.ocp1 import *
+
+
+DEFAULT_CHUNK_SIZE: int = 64 * 1024 * 1024  # bytes of capture per worker task
+MAX_PENDING: int = 65536  # commands awaiting a response, per report
+MAX_BUFFERED: int = 65536  # bytes of an incomplete PDU kept per stream and direction
+
+ObjectKey = tuple[str, int]  # (device, ONo)
+MethodKey = tuple[str, int, str]  # (device, ONo, "def_level.index"), events are "event def_level.index"
+
+
+class Tally:
+    __slots__ = ("count", "bytes")
+
+    def __init__(self) -> None:
+        self.count: int = 0
+        self.bytes: int = 0
+
+    def add(self, size: int) -> None:
+        self.count += 1
+        self.bytes += size
+
+    def merge(self, other: "Tally") -> None:
+        self.count += other.count
+        self.bytes += other.bytes
+
+
+# == == == == == Pipeline
+
+def split_pdus(reader: Union[CaptureReader, PcapReader]) -> Iterator[tuple[float, str, RecordKind, bytes]]:
+    """
+    Split records into whole PDUs, as `(timestamp, device, kind, pdu)`. A datagram may hold several
+    PDUs, and PDUs split across stream chunks are reassembled.
+    """
+    buffers: dict[tuple[int, RecordKind], bytes] = {}
+    for record in reader:
+        key = (record.stream, record.kind)
+        data = buffers.pop(key, b"") + record.data
+        device = reader.stream_name(record.stream) or f"stream-{record.stream}"
+        offset = 0
+        while offset < len(data):
+            if data[offset] != SYNC_VAL:
+                # Lost sync, skip to the next candidate PDU
+                if (offset := data.find(SYNC_VAL, offset + 1)) < 0:
+                    offset = len(data)
+                yield record.timestamp, device, record.kind, b""
+                continue
+            if len(data) - offset < 10:
+                break
+            end = offset + 1 + int.from_bytes(data[offset + 3:offset + 7], "big")
+            if end > len(data):
+                break
+            yield record.timestamp, device, record.kind, data[offset:end]
+            offset = end
+        if offset < len(data) and len(data) - offset <= MAX_BUFFERED:
+            buffers[key] = data[offset:]
+
+
+def decode(pdus: Iterable[tuple[float, str, RecordKind, bytes]]) -> Iterator[tuple[float, str, int, Optional[Ocp1PDU]]]:
+    """
+    Decode each PDU, as `(timestamp, device, size, pdu)`. `pdu` is None if it could not be decoded.
+    """
+    handle_registry = HandleTable()
+    for timestamp, device, kind, data in pdus:
+        try:
+            pdu = marshal(data, handle_registry, None) if data else None
+        except Exception as exc:
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("Could not parse PDU from %s: %s", device, exc)
+            pdu = None
+        yield timestamp, device, len(data), pdu
+
+
+# == == == == == Aggregation
+
+class TrafficReport:
+    """
+    Counts and sizes per device, object and method, and command to response latency per method.
+
+    Commands are matched to responses by handle. Responses whose command was not seen are kept
+    in `orphans` until `finish()`, so that a report for one chunk of a file can still match the
+    commands left pending at the end of the previous chunk when the reports are merged.
+    """
+    def __init__(self) -> None:
+        self.pdus: int = 0
+        self.bytes: int = 0
+        self.errors: int = 0
+        self.message_types: dict[str, int] = {}
+        self.devices: dict[str, Tally] = {}
+        self.objects: dict[ObjectKey, Tally] = {}
+        self.methods: dict[MethodKey, Tally] = {}
+        self.latency: dict[MethodKey, Histogram] = {}
+        self.pending: dict[tuple[str, int], tuple[float, MethodKey]] = {}
+        self.orphans: dict[tuple[str, int], float] = {}
+        self.unanswered: int = 0  # Commands whose response was never seen
+        self.unmatched: int = 0  # Responses whose command was never seen
+
+    @staticmethod
+    def _tally(table: dict, key: tuple) -> Tally:
+        if (tally := table.get(key)) is None:
+            tally = table[key] = Tally()
+        return tally
+
+    def _observe(self, method: MethodKey, sent: float, received: float) -> None:
+        if (histogram := self.latency.get(method)) is None:
+            histogram = self.latency[method] = Histogram()
+        histogram.observe(received - sent)
+
+    def _trim(self) -> None:
+        while len(self.pending) > MAX_PENDING:
+            del self.pending[next(iter(self.pending))]
+            self.unanswered += 1
+        while len(self.orphans) > MAX_PENDING:
+            del self.orphans[next(iter(self.orphans))]
+            self.unmatched += 1
+
+    def add(self, timestamp: float, device: str, size: int, pdu: Optional[Ocp1PDU]) -> None:
+        self.pdus += 1
+        self.bytes += size
+        self._tally(self.devices, device).add(size)
+        if pdu is None:
+            self.errors += 1
+            return
+        message_type = MessageType(pdu.header.message_type).name
+        self.message_types[message_type] = self.message_types.get(message_type, 0) + 1
+
+        if isinstance(pdu, Ocp1CommandPdu):
+            for command in pdu.commands:
+                ono = int(command.target_ono)
+                method = (device, ono, f"{int(command.method_id.def_level)}.{int(command.method_id.method_index)}")
+                command_size = 16 + len(command.parameter_data)
+                self._tally(self.objects, (device, ono)).add(command_size)
+                self._tally(self.methods, method).add(command_size)
+                if (device, int(command.handle)) in self.pending:
+                    self.unanswered += 1
+                self.pending[(device, int(command.handle))] = (timestamp, method)
+
+        elif isinstance(pdu, Ocp1ResponsePdu):
+            for response in pdu.responses:
+                key = (device, int(response.handle))
+                if (sent := self.pending.pop(key, None)) is not None:
+                    self._observe(sent[1], sent[0], timestamp)
+                else:
+                    self.orphans[key] = timestamp
+
+        elif isinstance(pdu, Ocp1NotificationPdu):
+            for notification in pdu.notifications:
+                ono = int(notification.event.emitter_ono)
+                event_id = notification.event.event_id
+                method = (device, ono, f"event {int(event_id.def_level)}.{int(event_id.event_index)}")
+                self._tally(self.objects, (device, ono)).add(int(notification.notification_size))
+                self._tally(self.methods, method).add(int(notification.notification_size))
+        self._trim()
+
+    def merge(self, other: "TrafficReport") -> None:
+        """
+        Add the report for the next chunk of the same file
+        """
+        self.pdus += other.pdus
+        self.bytes += other.bytes
+        self.errors += other.errors
+        self.unanswered += other.unanswered
+        self.unmatched += other.unmatched
+        for message_type, count in other.message_types.items():
+            self.message_types[message_type] = self.message_types.get(message_type, 0) + count
+        for table, other_table in ((self.devices, other.devices), (self.objects, other.objects), (self.methods, other.methods)):
+            for key, tally in other_table.items():
+                self._tally(table, key).merge(tally)
+        for method, histogram in other.latency.items():
+            if method in self.latency:
+                self.latency[method].merge(histogram)
+            else:
+                self.latency[method] = histogram
+        for key, received in other.orphans.items():
+            if (sent := self.pending.pop(key, None)) is not None:
+                self._observe(sent[1], sent[0], received)
+            else:
+                self.unmatched += 1
+        self.pending.update(other.pending)
+        self._trim()
+
+    def finish(self) -> None:
+        """
+        Count the responses that were never matched, once the whole file has been read
+        """
+        self.unmatched += len(self.orphans)
+        self.orphans.clear()
+
+    @staticmethod
+    def top(table: dict[tuple, Tally], n: int = 10) -> list[tuple[tuple, Tally]]:
+        """
+        The `n` entries of `table` with the most bytes
+        """
+        return sorted(table.items(), key=lambda item: item[1].bytes, reverse=True)[:n]
+
+
+def analyse_records(reader: Union[CaptureReader, PcapReader]) -> TrafficReport:
+    report = TrafficReport()
+    for timestamp, device, size, pdu in decode(split_pdus(reader)):
+        report.add(timestamp, device, size, pdu)
+    return report
+
+
+def _analyse_chunk(path: str, start: int, end: Optional[int], streams: dict[int, str]) -> TrafficReport:
+    return analyse_records(open_capture(path, start, end, streams))
+
+
+def analyse(path: str, workers: int = 0, chunk_size: int = DEFAULT_CHUNK_SIZE) -> TrafficReport:
+    """
+    Analyse a capture or pcap file.
+
+    Args:
+        path:       File to analyse
+        workers:    Number of worker processes, 0 to analyse in this process
+        chunk_size: Approximate bytes of the file given to each worker task
+    """
+    if not workers:
+        report = analyse_records(open_capture(path))
+    else:
+        reader = open_capture(path)
+        chunks = reader.chunks(chunk_size)
+        report = TrafficReport()
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_analyse_chunk, path, start, end, reader.streams) for start, end in chunks]
+            for future in futures:
+                report.merge(future.result())
+    report.finish()
+    return report
+
+
+# == == == == =
+
+@click.command("analyse")
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', '-j', type=int, default=0, help="Worker processes, 0 to run in this process")
+@click.option('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE // (1024 * 1024), help="MiB of capture per worker task")
+@click.option('--top', 'top_n', type=int, default=10, help="Rows in each top talkers table")
+def analyse_command(path: str, workers: int, chunk_size: int, top_n: int):
+    """ Summarise the traffic in a capture or pcap file """
+    start = time.perf_counter()
+    report = analyse(path, workers, chunk_size * 1024 * 1024)
+    elapsed = time.perf_counter() - start
+
+    click.echo(
+        f"{report.pdus} PDUs, {report.bytes} bytes in {elapsed:.2f}s "
+        f"({report.pdus / elapsed if elapsed else 0:.0f} PDU/s) | "
+        f"{report.errors} undecodable, {report.unanswered + len(report.pending)} unanswered, {report.unmatched} unmatched"
+    )
+    click.echo("  ".join(f"{name}: {count}" for name, count in sorted(report.message_types.items())))
+
+    click.echo("\nDevices")
+    for device, tally in sorted(report.devices.items(), key=lambda item: item[1].bytes, reverse=True)[:top_n]:
+        click.echo(f"  {device:<32}{tally.count:>10} PDUs{tally.bytes:>12} bytes")
+
+    click.echo("\nObjects")
+    for (device, ono), tally in report.top(report.objects, top_n):
+        click.echo(f"  {device:<32}{ono:>#12x}{tally.count:>10} msgs{tally.bytes:>12} bytes")
+
+    click.echo("\nMethods & events")
+    for (device, ono, method), tally in report.top(report.methods, top_n):
+        click.echo(f"  {device:<32}{ono:>#12x}  {method:<12}{tally.count:>10} msgs{tally.bytes:>12} bytes")
+
+    click.echo("\nSlowest methods")
+    slowest = sorted(report.latency.items(), key=lambda item: item[1].mean, reverse=True)[:top_n]
+    for (device, ono, method), histogram in slowest:
+        click.echo(
+            f"  {device:<32}{ono:>#12x}  {method:<12}{histogram.count:>10} calls"
+            f"  mean {histogram.mean * 1e3:.2f}ms  p99 <= {histogram.quantile(0.99) * 1e3:.1f}ms"
+        )
@@ -0,0 +1,145 @@
+"""
+Capture & replay
+----------------
+
+Record the raw traffic of a live session to a capture file, and replay captures through the
+decoder and controller offline, either at the recorded speed or as fast as possible. Useful
+for profiling decoding on real traffic and for reproducing parser bugs seen in the field.
+"""
+
+import asyncio
+import logging
+import time
+import click
+from typing import Optional
+
+from ocacomms.OcaCapture import CaptureReader, CaptureWriter, RecordKind
+from ocacomms.OcaDiscoveryCache import OcaDiscoveryCache
+from controller_cli.connect import OCAController
+from controller_cli.metrics import Metrics
+from ocacore.ocp1 import *
+from ocacore.utils import *
+
+
+def _replay_sent(controller: OCAController, data: bytes) -> None:
+    """
+    Register the commands in a recorded outgoing datagram, so that their responses can be decoded and timed
+    """
+    pdu = None
+    if len(data) >= 10 and data[7] in (MessageType.COMMAND.value, MessageType.COMMAND_RESPONSE_REQUIRED.value):
+        try:
+            pdu = Ocp1CommandPdu.from_bytes(data)
+        except Exception as exc:
+            logging.warning("Could not parse outgoing data: %s", exc)
+        else:
+            for command in pdu.commands:
+                controller.handle_registry[command.handle] = command
+    controller.record_sent(data, pdu, time.monotonic())
+
+
+async def replay(path: str, speed: float = 0.0, metrics: Optional[Metrics] = None) -> dict[int, OCAController]:
+    """
+    Feed a capture through one offline controller per recorded stream.
+
+    Args:
+        path:       Capture file
+        speed:      Playback rate relative to the recording, e.g. 1.0 for real time.
+                    0 replays as fast as possible.
+        metrics:    Registry the controllers record into, a fresh one by default
+
+    Returns:
+        dict: The controllers, keyed by stream number
+    """
+    metrics = metrics or Metrics()
+    reader = CaptureReader(path)
+    controllers: dict[int, OCAController] = {}
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    first_timestamp = None
+
+    for record in reader:
+        if first_timestamp is None:
+            first_timestamp = record.timestamp
+        if speed:
+            delay = (record.timestamp - first_timestamp) / speed - (loop.time() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        if (controller := controllers.get(record.stream)) is None:
+            name = reader.stream_name(record.stream) or f"stream-{record.stream}"
+            controller = controllers[record.stream] = OCAController(name, "udp", metrics=metrics)
+            controller.device_model = ControlledDevice()
+
+        if record.kind is RecordKind.SENT:
+            _replay_sent(controller, data=record.data)
+        else:
+            controller.handle_datagram(record.data)
+    return controllers
+
+
+async def record(target: str, path: str, cache: bool = True, duration: Optional[float] = None) -> None:
+    """
+    Run a session with `target`, recording its traffic to `path` until `duration` seconds have passed
+    """
+    with CaptureWriter(path) as capture:
+        controller = OCAController(
+            target, "udp", discovery_cache=OcaDiscoveryCache() if cache else None, capture=capture
+        )
+        session = asyncio.create_task(controller.start())
+        try:
+            await asyncio.wait_for(asyncio.shield(session), duration)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            session.cancel()
+            await controller.close()
+
+
+# == == == == =
+
+@click.group()
+def capture():
+    """ Record and replay raw OCP.1 traffic """
+
+
+@capture.command("record")
+@click.argument('target', nargs=1)
+@click.argument('path', type=click.Path(dir_okay=False))
+@click.option('--cache/--no-cache', default=True, help="Connect to the last known address while rediscovering")
+@click.option('--duration', type=float, default=None, help="Stop after this many seconds")
+def record_command(target: str, path: str, cache: bool, duration: Optional[float]):
+    logging.basicConfig(format="[%(asctime)s][%(levelname)s]: \t%(message)s", level=logging.INFO)
+    try:
+        asyncio.run(record(target, path, cache, duration))
+    except KeyboardInterrupt:
+        pass
+
+
+@capture.command("replay")
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--speed', type=float, default=0.0, help="Playback rate, 1.0 for recorded speed, 0 for as fast as possible")
+@click.option('--verbose', '-v', is_flag=True, help="Log every packet")
+def replay_command(path: str, speed: float, verbose: bool):
+    logging.basicConfig(
+        format="[%(asctime)s][%(levelname)s]: \t%(message)s", level=logging.DEBUG if verbose else logging.WARNING
+    )
+    metrics = Metrics()
+    start = time.perf_counter()
+    controllers = asyncio.run(replay(path, speed, metrics))
+    elapsed = time.perf_counter() - start
+
+    snapshot = metrics.snapshot()
+    received = 0
+    for controller in controllers.values():
+        labels = controller.metric_labels
+        decode = snapshot["oca_decode_seconds"][labels]
+        received += snapshot["oca_packets_received_total"][labels]
+        click.echo(
+            f"{controller.device_name:<24}"
+            f"sent {snapshot['oca_packets_sent_total'][labels]:<8}"
+            f"received {snapshot['oca_packets_received_total'][labels]:<8}"
+            f"errors {snapshot['oca_decode_errors_total'][labels]:<6}"
+            f"decode mean {decode['mean'] * 1e6:.1f}us "
+            f"p99 <= {decode['p99'] * 1e6:.0f}us"
+        )
+    click.echo(f"Decoded {received} PDUs in {elapsed:.3f}s ({received / elapsed if elapsed else 0:.0f} PDU/s)")
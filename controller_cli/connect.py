@@ -1,13 +1,25 @@
 import socket
 import enum
+import itertools
 import logging
 import asyncio
+import random
+import time
 import click
-from typing import Awaitable
+from typing import Any, Awaitable, Callable, Iterable, Optional, Union
 
-from ocacomms.OcaDiscovery import OcaDiscovery
+from ocacomms.OcaDiscovery import SERVICE_TYPES, OcaDiscovery
+from ocacomms.OcaDiscoveryCache import OcaDiscoveryCache
+from ocacomms.OcaCapture import CaptureWriter, RecordKind
+from ocacomms.OcaWebSocket import OcaWebSocket, connect as connect_websocket, split_pdus
+from controller_cli.keepalive import KeepaliveScheduler
+from controller_cli.methods import getter_ids
+from controller_cli.metrics import Labels, Metrics, metrics as default_metrics, serve_prometheus
+from controller_cli.offload import DecodeOffload
+from controller_cli.transmit import TransmitClass, TransmitQueue
 from ocacore.ocp1 import *
 from ocacore.utils import *
+from ocacore.occ.manager import OcaDeviceManager, OcaSubscriptionManager
 
 
 class State(enum.Enum):
@@ -18,52 +30,145 @@ class State(enum.Enum):
 
 
 T_KEEPALIVE_S: int = 5  # seconds
-T_DISCOVERY_S: int = 0.5
+T_DISCOVERY_S: int = 15  # seconds
+T_WARM_CONNECT_S: int = 2  # seconds to wait for a cached endpoint to answer a keepalive
+T_CONNECT_S: int = 20  # seconds to wait for any other endpoint to answer a keepalive
+T_RESPONSE_S: int = 2  # seconds
+T_RECONNECT_MIN_S: float = 0.5  # seconds, first reconnect backoff
+T_RECONNECT_MAX_S: float = 30  # seconds, backoff cap
+RECONNECT_REDISCOVER_AFTER: int = 3  # failed reconnects before rediscovering the device
 RECV_IP: str = ""
 RECV_PORT: int = 42042
+MAX_PDU_SIZE: int = 1400  # bytes, keeps a coalesced PDU inside one Ethernet frame
+MAX_UNANSWERED_KEEPALIVES: int = 3
+TRANSMIT_BURST: int = 16  # PDUs sent back to back before letting other tasks queue more urgent ones
 
+DEVICE_MANAGER_ONO: int = 0x1
+SUBSCRIPTION_MANAGER_ONO: int = 0x4
+# Echoed back by the device in every notification, the controller does not host objects itself
+SUBSCRIBER = OcaMethod(ono=OcaONo(1055), method_id=OcaMethodID(def_level=1, method_index=1))
+
+KEEPALIVE_PDU = Ocp1KeepAlivePdu(
+    header=Ocp1Header(
+        protocol_version=OcaUint16(1),
+        message_size=OcaUint32(11),
+        message_type=MessageType.KEEPALIVE,
+        message_count=OcaUint16(1),
+    ),
+    heartbeat=OcaUint16(value=T_KEEPALIVE_S),
+)
+
+KEEPALIVE_TEMPLATE = Ocp1PduTemplate.of(KEEPALIVE_PDU)
+
+# Shared by every controller that is not given its own scheduler
+keepalive_scheduler = KeepaliveScheduler(T_KEEPALIVE_S)
+
+# Tells apart the metrics of controllers for the same device, e.g. a daemon's and a script's
+_controller_ids = itertools.count(1)
 
 
 class OCAClientProtocol:
-    def __init__(self, receive_queue):
+    def __init__(self, receive_queue, capture: Optional[CaptureWriter] = None, stream: int = 0):
         self.transport = None
         self.receive_queue = receive_queue
+        self.capture = capture
+        self.stream = stream
 
     def connection_made(self, transport):
         self.transport = transport
 
-    def send(self, message):
-        self.message = message.bytes
-        self.transport.sendto(self.message)
-        # logging.debug(f"To device   --> {len(self.message)} bytes")
+    def send(self, data: bytes):
+        if self.capture is not None:
+            self.capture.write(RecordKind.SENT, self.stream, data)
+        self.transport.sendto(data)
 
     def datagram_received(self, data, addr):
-        # logging.debug(f"From device <-- {len(self.message)} bytes")
+        if self.capture is not None:
+            self.capture.write(RecordKind.RECEIVED, self.stream, data)
         self.receive_queue.put_nowait(data)
-        # self.transport.close()
 
     def error_received(self, exc):
-        logging.warn(f"From device <-- Error: {exc}")
+        logging.warning("From device <-- Error: %s", exc)
 
     def connection_lost(self, exc):
         pass
 
 
+class OCAWebSocketProtocol:
+    """
+    OCP.1 over WebSocket, with the same `send()` as `OCAClientProtocol`. PDUs sent in one event
+    loop iteration share a WebSocket message, and received messages are split back into PDUs.
+    """
+    def __init__(
+        self,
+        websocket: OcaWebSocket,
+        receive_queue,
+        capture: Optional[CaptureWriter] = None,
+        stream: int = 0,
+        on_lost: Optional[Callable[[], None]] = None,
+    ):
+        self.websocket = websocket
+        self.receive_queue = receive_queue
+        self.capture = capture
+        self.stream = stream
+        self.on_lost = on_lost
+        self.reader_task = asyncio.create_task(self._read())
+
+    @classmethod
+    async def open(cls, endpoint: tuple[str, int], receive_queue, **kwargs) -> "OCAWebSocketProtocol":
+        return cls(await connect_websocket(*endpoint), receive_queue, **kwargs)
+
+    def send(self, data: bytes):
+        if self.capture is not None:
+            self.capture.write(RecordKind.SENT, self.stream, data)
+        self.websocket.send(data)
+
+    async def _read(self):
+        try:
+            while True:
+                for pdu in split_pdus(await self.websocket.recv()):
+                    if self.capture is not None:
+                        self.capture.write(RecordKind.RECEIVED, self.stream, pdu)
+                    self.receive_queue.put_nowait(pdu)
+        except ConnectionError as exc:
+            logging.warning("From device <-- WebSocket closed: %s", exc)
+        self.websocket.close()
+        if self.on_lost is not None:
+            self.on_lost()
+
+    def close(self):
+        self.on_lost = None
+        self.reader_task.cancel()
+        self.websocket.close()
+
+
 class OCAController:
     def __init__(
         self: object,
         device_name: str,
         device_protocol: str,  # "udp" | "tcp" | "websocket"
+        discovery_cache: Optional[OcaDiscoveryCache] = None,
+        discovery: Optional[OcaDiscovery] = None,
+        scheduler: Optional[KeepaliveScheduler] = None,
+        metrics: Optional[Metrics] = None,
+        capture: Optional[CaptureWriter] = None,
+        offload: Optional[DecodeOffload] = None,
+        endpoint: Optional[tuple[str, int]] = None,
     ) -> None:
         self.transport = None
         self.device_name: str = device_name
         self.device_protocol: str = device_protocol
         self.device_model: ControlledDevice = None
+        # A static endpoint skips discovery, for devices that do not advertise themselves
+        self.device_endpoint: Optional[tuple[str, int]] = endpoint
+        self._static_endpoint: bool = endpoint is not None
 
-        # Set up logging
-        logging.basicConfig(
-            format="[%(asctime)s][%(levelname)s]: \t%(message)s", level=logging.DEBUG
-        )
+        self.discovery: Optional[OcaDiscovery] = discovery
+        # Set while `discovery` is a browser this controller started, rather than one passed in
+        self._owns_discovery: bool = False
+        self.discovery_cache: Optional[OcaDiscoveryCache] = discovery_cache
+        self.revalidate_task = None
+        self._warm_start: bool = False
 
         self._state_callbacks: dict = {
             State.DISCONNECTED: self._main_disconnected,
@@ -72,33 +177,126 @@ class OCAController:
             State.CONNECTED: self._main_connected,
         }
         self.state: int = State.DISCONNECTED
+        self.connected = asyncio.Event()
+        self._state_changed = asyncio.Event()
         self._cur_state_main: Awaitable = self._state_callbacks[self.state]
 
         self.transmit_task = None
-        self.transmit_queue = asyncio.Queue()
+        # Keepalives first, then interactive, notification and bulk traffic by weight, see `TransmitQueue`
+        self.transmit_queue = TransmitQueue()
+        # Every outgoing PDU is encoded into this one buffer, the transport copies it if it must queue
+        self.encoder = Ocp1Encoder()
         self.receive_task = None
         self.receive_queue = asyncio.Queue()
         
+        self.scheduler: KeepaliveScheduler = scheduler if scheduler is not None else keepalive_scheduler
         self.unanswered_keepalives = 0
         self.session_active = asyncio.Event()
+        self.last_receive: float = 0.0
+        self.last_transmit: float = 0.0
+
+        # Called with each `Ocp1Notification` received from the device
+        self.notification_handlers: list[Callable[[Ocp1Notification], None]] = []
+        # Called after a reconnect with each cached read whose value changed while disconnected
+        self.resync_handlers: list[Callable[[Ocp1Command, Ocp1Response], None]] = []
+        # Called with the new `State` on every transition
+        self.state_handlers: list[Callable[[State], None]] = []
+
+        # Session state restored after a reconnect
+        self._pending: dict[int, asyncio.Future] = {}
+        self.subscriptions: dict[tuple[int, int, int], OcaEvent] = {}
+        self.read_cache: dict[tuple[int, OcaMethodID, bytes], tuple[Ocp1Parameters, bytes]] = {}
+        self.model_probes: list[tuple[int, Method]] = [
+            (DEVICE_MANAGER_ONO, OcaDeviceManager.get_model_guid),
+            (DEVICE_MANAGER_ONO, OcaDeviceManager.get_serial_number),
+        ]
+        self._probe_results: Optional[list[tuple[OcaStatus, bytes]]] = None
+        self.probe_task = None
+        self._was_connected: bool = False
+        self._reconnect_attempt: int = 0
+
+        self.handle_registry: HandleTable = HandleTable()
+
+        # Instrumentation, children are bound once here so recording stays cheap
+        self.metrics: Metrics = metrics or default_metrics
+        # Sorted by name, as `Metrics.snapshot()` keys are
+        self.metric_labels: Labels = (("controller", str(next(_controller_ids))), ("device", device_name))
+        labels = dict(self.metric_labels)
+        self._packets_sent = self.metrics.counter("oca_packets_sent_total", "PDUs sent").labels(**labels)
+        self._packets_received = self.metrics.counter("oca_packets_received_total", "PDUs received").labels(**labels)
+        self._bytes_sent = self.metrics.counter("oca_bytes_sent_total", "Bytes sent").labels(**labels)
+        self._bytes_received = self.metrics.counter("oca_bytes_received_total", "Bytes received").labels(**labels)
+        self._decode_errors = self.metrics.counter("oca_decode_errors_total", "PDUs that could not be decoded").labels(**labels)
+        self._timeouts = self.metrics.counter("oca_request_timeouts_total", "Requests without a response in time").labels(**labels)
+        self._retransmits = self.metrics.counter("oca_retransmits_total", "Commands sent again after a timeout").labels(**labels)
+        self._encode_seconds = self.metrics.histogram("oca_encode_seconds", "Time to encode one PDU").labels(**labels)
+        self._decode_seconds = self.metrics.histogram("oca_decode_seconds", "Time to decode one PDU").labels(**labels)
+        self._rtt_seconds = self.metrics.histogram("oca_rtt_seconds", "Command to response round trip").labels(**labels)
+        # Bound to the queues rather than to `self`, so that the registry never keeps a controller alive
+        self.metrics.gauge("oca_transmit_queue_depth", "PDUs waiting to be sent").labels(**labels).set_function(
+            self.transmit_queue.qsize
+        )
+        self.metrics.gauge("oca_receive_queue_depth", "Datagrams waiting to be decoded").labels(**labels).set_function(
+            self.receive_queue.qsize
+        )
+        self.metrics.gauge("oca_pending_requests", "Requests awaiting a response").labels(**labels).set_function(
+            self._pending.__len__
+        )
+        self._sent_at: dict[int, float] = {}
+
+        # Raw traffic is recorded here when given, see `controller_cli.capture`
+        self.capture: Optional[CaptureWriter] = capture
+        self._capture_stream: int = 0 if capture is None else capture.add_stream(device_name)
 
-        self.handle_registry = HandleRegistry()
-        self._current_handle = 0
+        # Large response PDUs are decoded off the event loop when given
+        self.offload: Optional[DecodeOffload] = offload
+        self._offload_tasks: set[asyncio.Task] = set()
+        self._offloaded = self.metrics.counter("oca_offloaded_decodes_total", "PDUs decoded off the event loop").labels(**labels)
 
 
     # == == == == == Helpers
 
     @property
     def next_handle(self) -> int:
-        self._current_handle += 1
-        return self._current_handle
+        """
+        Raises:
+            HandleTableFull: if `handle_registry.capacity` commands are awaiting a response
+        """
+        try:
+            return self.handle_registry.allocate()
+        except HandleTableFull:
+            # Commands sent without a future, e.g. by `send_commands()`, hold their handle until
+            # a response arrives. Take back those whose response was lost.
+            queued = self._queued_handles()
+            self.handle_registry.reclaim(lambda handle: handle in self._pending or handle in queued)
+            return self.handle_registry.allocate()
+
+
+    def _queued_handles(self) -> set[int]:
+        """
+        Handles of the commands still waiting in `transmit_queue`
+        """
+        return {
+            int(command.handle)
+            for pdu in self.transmit_queue.items() if isinstance(pdu, Ocp1CommandPdu)
+            for command in pdu.commands
+        }
+
+
+    def make_command(self, target_ono: int, method: Method, *arguments: OCCBase) -> Ocp1Command:
+        return Ocp1Command(
+            handle=self.next_handle,
+            target_ono=target_ono,
+            method_id=method.method_id,
+            parameters=Ocp1Parameters(parameters=[Parameter(value=argument) for argument in arguments] or None)
+        )
 
 
     def create_commandrrq(self, commands: list[Ocp1Command]) -> Ocp1CommandPdu:
         payload_length = 0
         for command in commands:
             self.handle_registry[command.handle] = command
-            payload_length += command.__sizeof__()
+            payload_length += command.encoded_size
         return Ocp1CommandPdu(
             header=Ocp1Header(
                 protocol_version = OcaUint16(1),
@@ -108,7 +306,184 @@ class OCAController:
             ),
             commands=commands
         )
-        
+
+
+    def create_commandrrq_batches(self, commands: list[Union[Ocp1Command, list[Ocp1Command]]]) -> list[Ocp1CommandPdu]:
+        """
+        Coalesce `commands` into as few PDUs as possible, each no larger than `MAX_PDU_SIZE`.
+        Order is preserved, and a nested list of commands is never split across PDUs, so that
+        dependent sequences (e.g. `OcaMatrix.SetCurrentXY` followed by a proxy setter) stay together.
+        """
+        pdus = []
+        batch = []
+        batch_size = 1 + Ocp1Header.__sizeof__()
+        for group in commands:
+            if isinstance(group, Ocp1Command):
+                group = [group]
+            group_size = sum(command.encoded_size for command in group)
+            if batch and (batch_size + group_size > MAX_PDU_SIZE or len(batch) + len(group) > 0xFFFF):
+                pdus.append(self.create_commandrrq(batch))
+                batch = []
+                batch_size = 1 + Ocp1Header.__sizeof__()
+            batch.extend(group)
+            batch_size += group_size
+        if batch:
+            pdus.append(self.create_commandrrq(batch))
+        return pdus
+
+
+    @staticmethod
+    def transmit_class(commands: Iterable[Ocp1Command]) -> TransmitClass:
+        """
+        The class of a PDU of `commands`: bulk when they are all reads, notification when any
+        manages subscriptions, interactive otherwise
+        """
+        getters = getter_ids()
+        reads = True
+        for command in commands:
+            if int(command.target_ono) == SUBSCRIPTION_MANAGER_ONO:
+                return TransmitClass.NOTIFICATION
+            reads = reads and (int(command.method_id.def_level), int(command.method_id.method_index)) in getters
+        return TransmitClass.BULK if reads else TransmitClass.INTERACTIVE
+
+
+    async def send_commands(
+        self,
+        commands: list[Union[Ocp1Command, list[Ocp1Command]]],
+        transmit_class: Optional[TransmitClass] = None,
+    ) -> None:
+        """
+        Queue `commands` for transmission, coalesced into multi-message PDUs. A nested list of
+        commands is a group, always sent in order within one PDU. Each PDU is queued in
+        `transmit_class`, or the class for its commands if None.
+        """
+        for pdu in self.create_commandrrq_batches(commands):
+            await self.transmit_queue.put(pdu, transmit_class if transmit_class is not None else self.transmit_class(pdu.commands))
+
+
+    async def request(
+        self,
+        command: Ocp1Command,
+        timeout: float = T_RESPONSE_S,
+        retries: int = 0,
+        transmit_class: Optional[TransmitClass] = None,
+    ) -> Ocp1Response:
+        """
+        Send `command` and wait for its response
+        """
+        response, = await self.request_many([command], timeout, retries, transmit_class)
+        return response
+
+
+    async def request_many(
+        self,
+        commands: list[Union[Ocp1Command, list[Ocp1Command]]],
+        timeout: float = T_RESPONSE_S,
+        retries: int = 0,
+        transmit_class: Optional[TransmitClass] = None,
+    ) -> list[Ocp1Response]:
+        """
+        Send `commands`, coalesced into multi-message PDUs, and wait for all of their responses.
+        Commands still unanswered after `timeout` seconds are sent again, up to `retries` times,
+        with the rest of their group. See `send_commands()` for groups and `transmit_class`.
+
+        Returns:
+            list: One response per command, groups flattened
+
+        Raises:
+            asyncio.TimeoutError: if any response does not arrive in time
+            ConnectionError: if the session is lost while waiting
+        """
+        if not commands:
+            return []
+        groups = [[group] if isinstance(group, Ocp1Command) else group for group in commands]
+        flat = [command for group in groups for command in group]
+        futures = []
+        try:
+            futures = await self.submit(groups, transmit_class)
+            for attempt in range(retries + 1):
+                _, unanswered = await asyncio.wait(futures, timeout=timeout)
+                if not unanswered:
+                    break
+                if attempt == retries:
+                    self._timeouts.inc()
+                    raise asyncio.TimeoutError(f"{len(unanswered)} of {len(flat)} commands unanswered")
+                pending = {int(command.handle) for command, future in zip(flat, futures) if future in unanswered}
+                resend = [group for group in groups if any(int(command.handle) in pending for command in group)]
+                self._retransmits.inc(len(pending))
+                await self.send_commands(resend, transmit_class)
+            return [future.result() for future in futures]
+        finally:
+            self.forget(flat)
+            # A lost session fails every future, retrieve them all so none is reported as unhandled
+            for future in futures:
+                if future.done() and not future.cancelled():
+                    future.exception()
+
+
+    async def submit(
+        self,
+        commands: list[Union[Ocp1Command, list[Ocp1Command]]],
+        transmit_class: Optional[TransmitClass] = None,
+    ) -> list[asyncio.Future]:
+        """
+        Send `commands`, coalesced into multi-message PDUs, without waiting for their responses.
+        Each future resolves to its command's `Ocp1Response`, one per command with groups
+        flattened. Commands given up on before their response arrives must be passed to
+        `forget()`. See `send_commands()` for groups and `transmit_class`.
+        """
+        loop = asyncio.get_running_loop()
+        futures = []
+        for group in commands:
+            for command in [group] if isinstance(group, Ocp1Command) else group:
+                futures.append(loop.create_future())
+                self._pending[int(command.handle)] = futures[-1]
+        await self.send_commands(commands, transmit_class)
+        return futures
+
+
+    def forget(self, commands: Iterable[Ocp1Command]) -> None:
+        """
+        Stop waiting for responses to `commands`
+        """
+        for command in commands:
+            self._pending.pop(int(command.handle), None)
+            self._sent_at.pop(int(command.handle), None)
+            self.handle_registry.release(int(command.handle))
+
+
+    async def read(self, target_ono: int, method: Method, *arguments: OCCBase) -> Ocp1Response:
+        """
+        Call a getter and remember its result, so that it can be checked cheaply after a reconnect
+        """
+        command = self.make_command(target_ono, method, *arguments)
+        response = await self.request(command)
+        if response.status_code == OcaStatus.OK:
+            key = (target_ono, command.method_id, command.parameters.bytes)
+            self.read_cache[key] = (command.parameters, response.parameter_data)
+        return response
+
+
+    def _add_subscription_command(self, event: OcaEvent) -> Ocp1Command:
+        return self.make_command(
+            SUBSCRIPTION_MANAGER_ONO,
+            OcaSubscriptionManager.add_subscription,
+            event,
+            SUBSCRIBER,
+            OcaBlob(data=b""),
+            OcaUint8(OcaNotificationDeliveryMode.Reliable.value),
+            OcaBlob(data=b""),
+        )
+
+
+    async def subscribe(self, emitter_ono: int, event_id: OcaEventID = OcaRoot.property_changed_event) -> Ocp1Response:
+        """
+        Subscribe to an event, by default PropertyChanged. Subscriptions are restored after a reconnect.
+        """
+        event = OcaEvent(emitter_ono=OcaONo(emitter_ono), event_id=event_id)
+        self.subscriptions[(emitter_ono, int(event_id.def_level), int(event_id.event_index))] = event
+        return await self.request(self._add_subscription_command(event))
+
 
 
     # == == == == == Queue Consumers
@@ -117,23 +492,47 @@ class OCAController:
         """
         Send packets out when one is ready
         """
-        loop = asyncio.get_event_loop()
-        self.transport, self.protocol, = await loop.create_datagram_endpoint(
-            lambda: OCAClientProtocol(self.receive_queue),
-            remote_addr=(
-                (
-                    socket.inet_ntoa(self.device_service.addresses[0]),
-                    self.device_service.port,
-                )
-            ),
-        )
+        if self.device_protocol == "udp":
+            loop = asyncio.get_event_loop()
+            self.transport, self.protocol, = await loop.create_datagram_endpoint(
+                lambda: OCAClientProtocol(self.receive_queue, self.capture, self._capture_stream),
+                remote_addr=self.device_endpoint,
+            )
+        burst = 0
         while True:
+            if self.transmit_queue.empty():
+                burst = 0
+            elif burst >= TRANSMIT_BURST:
+                # Let other tasks queue keepalives and interactive commands ahead of a backlog
+                burst = 0
+                await asyncio.sleep(0)
             pkt = await self.transmit_queue.get()
-            logging.info(f"Transmit: {type(pkt).__qualname__}")
-            if isinstance(pkt, Ocp1CommandPdu):
-                for cmd in pkt.commands:
-                    logging.info(f"\t{cmd.target_ono}::{cmd.method_id}({cmd.parameters})")
-            self.protocol.send(pkt)
+            burst += 1
+            start = time.perf_counter()
+            data = self.encoder.encode(pkt)
+            self._encode_seconds.observe(time.perf_counter() - start)
+
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("Transmit: %s", type(pkt).__qualname__)
+                if isinstance(pkt, Ocp1CommandPdu):
+                    for cmd in pkt.commands:
+                        logging.debug("\t%s::%s(%s)", cmd.target_ono, cmd.method_id, cmd.parameters)
+
+            self.protocol.send(data)
+            self.record_sent(data, pkt, time.monotonic())
+
+
+    def record_sent(self, data: bytes, pdu: Any, now: float) -> None:
+        """
+        Account for a PDU sent to the device, timing the responses to its commands from `now`.
+        Also used to replay captured traffic.
+        """
+        self.last_transmit = now
+        self._packets_sent.inc()
+        self._bytes_sent.inc(len(data))
+        if isinstance(pdu, Ocp1CommandPdu):
+            for command in pdu.commands:
+                self._sent_at[int(command.handle)] = now
 
 
     async def _receive(self) -> None:
@@ -141,51 +540,116 @@ class OCAController:
         Handle incoming data
         """
         while True:
+            message = await self.receive_queue.get()
             try:
-                message = await self.receive_queue.get()
-                try:
-                    pdu = marshal(message, self.handle_registry, self.device_model)
-                except Exception as exc:
-                    logging.warning(f"Could not parse incoming data: {exc}")
-                logging.info(f"Receive: {type(pdu).__qualname__}")
-                if isinstance(pdu, Ocp1ResponsePdu):
-                    for resp_i, resp in enumerate(pdu.responses):
-                        for param_i, param in enumerate(resp.parameters):
-                            logging.info(f"\tResponse {resp_i} Parameters {param_i}: {[p for p in param[1]]}")
-                
-                if isinstance(pdu, Ocp1KeepAlivePdu):
-                    if not self.session_active.is_set():
-                        self.session_active.set()
-                    self.unanswered_keepalives -= 1 if self.unanswered_keepalives > 0 else self.unanswered_keepalives
+                self.handle_datagram(message)
             except Exception as exc:
-                logging.warning(f"Exception raised: {exc}")
+                logging.warning("Exception raised: %s", exc)
+
+
+    def handle_datagram(self, message: bytes) -> None:
+        """
+        Decode and dispatch one datagram from the device. Also used to replay captured traffic.
+        """
+        # Any traffic from the device shows the session is alive
+        self.last_receive = now = time.monotonic()
+        self.unanswered_keepalives = 0
+        self._packets_received.inc()
+        self._bytes_received.inc(len(message))
+        if self.offload is not None and self.offload.wants(message):
+            task = asyncio.ensure_future(self._decode_offloaded(message, now))
+            self._offload_tasks.add(task)
+            task.add_done_callback(self._offload_tasks.discard)
+            return
+        try:
+            start = time.perf_counter()
+            pdu = marshal(message, self.handle_registry, self.device_model)
+            self._decode_seconds.observe(time.perf_counter() - start)
+        except Exception as exc:
+            self._decode_errors.inc()
+            logging.warning("Could not parse incoming data: %s", exc)
+            return
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("Receive: %s", type(pdu).__qualname__)
+
+        if isinstance(pdu, Ocp1ResponsePdu):
+            for resp in pdu.responses:
+                self._dispatch_response(resp, now)
+
+        if isinstance(pdu, Ocp1NotificationPdu):
+            for notification in pdu.notifications:
+                for handler in self.notification_handlers:
+                    handler(notification)
+
+        if isinstance(pdu, Ocp1KeepAlivePdu):
+            if not self.session_active.is_set():
+                self.session_active.set()
+
+
+    def _dispatch_response(self, resp: Ocp1Response, received_at: float) -> None:
+        handle = int(resp.handle)
+        if (sent_at := self._sent_at.pop(handle, None)) is not None:
+            self._rtt_seconds.observe(received_at - sent_at)
+        if (future := self._pending.pop(handle, None)) is not None and not future.done():
+            future.set_result(resp)
+        self.handle_registry.release(handle)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("\tResponse %s: %s %r", handle, resp.status_code, resp.parameter_data)
+
+
+    async def _decode_offloaded(self, message: bytes, received_at: float) -> None:
+        """
+        Decode a large response PDU in the offload pool, then dispatch its responses.
+        The responses carry `parameter_data` and the compact `values`, not typed parameters.
+        """
+        formats = {}
+        for handle in self._pending:
+            command = self.handle_registry.get(handle)
+            if command is not None and (value_format := self.offload.format_for(command, self.device_model)):
+                formats[handle] = value_format
+        try:
+            responses = await self.offload.decode(message, formats)
+        except Exception as exc:
+            self._decode_errors.inc()
+            logging.warning("Could not parse incoming data: %s", exc)
+            return
+        self._offloaded.inc()
+        for handle, status, parameter_data, values in responses:
+            try:
+                status_code = OcaStatus(status)
+            except ValueError:
+                self._decode_errors.inc()
+                continue
+            self._dispatch_response(Ocp1Response.construct(
+                response_size=OcaUint32(9 + len(parameter_data)),
+                handle=OcaUint32(handle),
+                status_code=status_code,
+                parameters=Ocp1Parameters(parameters=None),
+                parameter_data=parameter_data,
+                values=values,
+            ), received_at)
 
 
     # == == == == == Device Supervision
     
-    async def _keepalive(self) -> None:
+    def _send_keepalive(self) -> None:
+        self.transmit_queue.put_nowait(KEEPALIVE_TEMPLATE, TransmitClass.KEEPALIVE)
+        self.unanswered_keepalives += 1
+
+
+    def keepalive_due(self) -> None:
         """
-        Maintain KeepAlive with the device
+        Maintain KeepAlive with the device, called by the keepalive scheduler once per `T_KEEPALIVE_S`.
+        A keepalive is redundant when traffic has flowed both ways within the last interval.
         AES70-3 5.3
         """
-        try:
-            keepalive_pkt = Ocp1KeepAlivePdu(
-                header=Ocp1Header(
-                    protocol_version=OcaUint16(1),
-                    message_size=OcaUint32(11),
-                    message_type=MessageType.KEEPALIVE,
-                    message_count=OcaUint16(1),
-                ),
-                heartbeat=OcaUint16(value=T_KEEPALIVE_S),
-            )
-            while True:
-                if self.unanswered_keepalives >= 3:
-                    self._state_transition(State.DISCONNECTED)
-                self.transmit_queue.put_nowait(keepalive_pkt)
-                self.unanswered_keepalives += 1
-                await asyncio.sleep(T_KEEPALIVE_S)
-        except Exception as exc:
-            logging.warning(f"Exception!: {exc}")
+        now = time.monotonic()
+        if now - self.last_receive < T_KEEPALIVE_S and now - self.last_transmit < T_KEEPALIVE_S:
+            return
+        if self.unanswered_keepalives >= MAX_UNANSWERED_KEEPALIVES:
+            self._state_transition(State.DISCONNECTED)
+            return
+        self._send_keepalive()
     
     
     # == == == == == State management
@@ -194,96 +658,240 @@ class OCAController:
         """
         Handle any cleanup required from exiting current state, and any setup required for entering new state
         """
-        logging.debug(f"Transition: {self.state} -> {new_state}")
+        logging.debug("Transition: %s -> %s", self.state, new_state)
+
+        if new_state is State.DISCONNECTED:
+            self._stop_session()
 
         # Assume no action needed and safe to move
         self.state = new_state
+        if new_state is State.CONNECTED:
+            self.connected.set()
+        else:
+            self.connected.clear()
+        self._state_changed.set()
+        for handler in self.state_handlers:
+            handler(new_state)
 
 
     async def _main_disconnected(self: object) -> None:
         """
         Main tick for State.DISCONNECTED
+        Wait with jittered exponential backoff, then reconnect to the last known endpoint.
+        Every `RECONNECT_REDISCOVER_AFTER` failed attempts, rediscover the device in case it has moved.
         """
-        raise NotImplementedError("#TODO handle reconnection")
+        if self.device_endpoint is None:
+            self._state_transition(State.DISCOVERING)
+            return
+
+        backoff = min(T_RECONNECT_MAX_S, T_RECONNECT_MIN_S * 2 ** self._reconnect_attempt)
+        delay = random.uniform(backoff / 2, backoff)
+        logging.info("Reconnecting to %s in %.1fs (attempt %d)", self.device_name, delay, self._reconnect_attempt + 1)
+        await asyncio.sleep(delay)
+
+        self._reconnect_attempt += 1
+        if (
+            self._reconnect_attempt % RECONNECT_REDISCOVER_AFTER == 0
+            and self.device_protocol in SERVICE_TYPES
+            and not self._static_endpoint
+        ):
+            self._state_transition(State.DISCOVERING)
+        else:
+            self._state_transition(State.CONNECTING)
 
 
     async def _main_discovering(self: object) -> None:
         """
         Main tick for State.DISCOVERING
         """
-        self.discovery = OcaDiscovery(self.device_protocol)
-        loop_counter = 0
-        while True:
-            if loop_counter > 30:
-                raise TimeoutError(
-                    "Could not discover {device}, available services: {services}".format(
-                        device=self.device_name,
-                        services=[service.name for service in self.discovery.services],
-                    )
+        if self.discovery is None:
+            self.discovery = OcaDiscovery(self.device_protocol)
+            self._owns_discovery = True
+            await self.discovery.start()
+        try:
+            self.device_service = await self.discovery.wait_for(self.device_name, timeout=T_DISCOVERY_S)
+        except asyncio.TimeoutError as exc:
+            services = [service.name for service in self.discovery.services]
+            if self._was_connected:
+                # Keep trying to reconnect to the last known endpoint
+                self._state_transition(State.DISCONNECTED)
+                return
+            raise TimeoutError(
+                "Could not discover {device}, available services: {services}".format(
+                    device=self.device_name,
+                    services=services,
                 )
-            if service := self.discovery.find(self.device_name):
-                self.device_service = service
-                break
-            await asyncio.sleep(T_DISCOVERY_S)
-            loop_counter += 1
-
-        logging.debug(
-            f"Discovered {self.device_name}: {socket.inet_ntoa(self.device_service.addresses[0])}:{self.device_service.port}"
-        )
+            ) from exc
+        finally:
+            # A browser holds sockets and a thread, so one of our own only runs while discovering
+            await self._close_discovery()
+
+        self.device_endpoint = (socket.inet_ntoa(self.device_service.addresses[0]), self.device_service.port)
+        if self.discovery_cache is not None:
+            self.discovery_cache.update(self.device_name, self.device_protocol, self.device_service)
+
+        logging.debug("Discovered %s: %s:%s", self.device_name, *self.device_endpoint)
         self._state_transition(State.CONNECTING)
 
 
+    async def _close_discovery(self: object) -> None:
+        """
+        Stop the browser if this controller started it, it is started again when next needed
+        """
+        if not self._owns_discovery or self.discovery is None:
+            return
+        discovery, self.discovery = self.discovery, None
+        self._owns_discovery = False
+        await discovery.close()
+
+
     async def _main_connecting(self: object) -> None:
         """
         Main tick for State.CONNECTING
         """
-        if self.device_protocol != "udp":
-            raise NotImplementedError("Just working on UDP for now!")
+        if self.device_protocol == "tcp":
+            raise NotImplementedError("OCP.1 over TCP is not implemented yet")
+        if self.device_protocol == "websocket":
+            # Connected here rather than in the transmit task, so that a refused connection backs off
+            try:
+                self.protocol = self.transport = await OCAWebSocketProtocol.open(
+                    self.device_endpoint, self.receive_queue,
+                    capture=self.capture, stream=self._capture_stream, on_lost=self._websocket_lost,
+                )
+            except (OSError, asyncio.TimeoutError) as exc:
+                logging.warning("Could not open WebSocket to %s: %r", self.device_name, exc)
+                self._state_transition(State.DISCONNECTED)
+                return
 
+        endpoint = self.device_endpoint
         logging.debug("Start receive task")
         self.receive_task = asyncio.create_task(self._receive())
         logging.debug("Start transmit task")
         self.transmit_task = asyncio.create_task(self._transmit())
-        logging.debug("Start keepalive task")
-        self.keepalive_task = asyncio.create_task(self._keepalive())
+        logging.debug("Start keepalive")
+        self._send_keepalive()
+        self.scheduler.register(self)
 
-        # Set by first keepalive response
-        await self.session_active.wait()
+        # Set by first keepalive response. Unanswered keepalives may end the session first.
+        self._state_changed.clear()
+        active = asyncio.ensure_future(self.session_active.wait())
+        changed = asyncio.ensure_future(self._state_changed.wait())
+        try:
+            await asyncio.wait(
+                {active, changed},
+                timeout=T_WARM_CONNECT_S if self._warm_start or self._was_connected else T_CONNECT_S,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            active.cancel()
+            changed.cancel()
+        if self.state is not State.CONNECTING:
+            return
+        if not self.session_active.is_set():
+            if self.device_endpoint != endpoint:
+                # `_revalidate()` found the device elsewhere while we waited
+                self._stop_session()
+                self._state_transition(State.CONNECTING)
+                return
+            if self._was_connected or not self._warm_start:
+                logging.warning("No answer from %s at %s:%s", self.device_name, *self.device_endpoint)
+                self._state_transition(State.DISCONNECTED)
+                return
+            # The cached endpoint is stale, discover the device again
+            logging.warning("No answer from cached endpoint %s:%s", *self.device_endpoint)
+            self.discovery_cache.invalidate(self.device_name, self.device_protocol)
+            self._warm_start = False
+            self._stop_session()
+            self._state_transition(State.DISCOVERING)
+            return
 
+        if self._was_connected:
+            try:
+                await self._resync()
+            except (asyncio.TimeoutError, ConnectionError) as exc:
+                logging.warning("Resync with %s failed: %r", self.device_name, exc)
+                self._state_transition(State.DISCONNECTED)
+                return
+        else:
+            # Record the probe baseline without delaying the first connection
+            self.probe_task = asyncio.create_task(self._probe_model())
+
+        self._was_connected = True
+        self._reconnect_attempt = 0
         self._state_transition(State.CONNECTED)
 
 
+    async def _probe_model(self: object) -> bool:
+        """
+        Compare cheap identifying reads (model GUID and serial number by default) with those
+        from the first session, to check the cached device model without re-enumerating.
+
+        Returns:
+            bool: False if the device no longer matches
+        """
+        commands = [self.make_command(ono, method) for ono, method in self.model_probes]
+        try:
+            responses = await self.request_many(commands)
+        except (asyncio.TimeoutError, ConnectionError) as exc:
+            logging.warning("Could not probe %s: %r", self.device_name, exc)
+            return self._probe_results is None
+        results = [(response.status_code, response.parameter_data) for response in responses]
+        if self._probe_results is None:
+            self._probe_results = results
+        return results == self._probe_results
+
+
+    async def _resync(self: object) -> None:
+        """
+        Restore a session after reconnecting: re-add subscriptions, check the device model
+        still matches, then repeat the cached reads and report only those whose value changed.
+        """
+        if self.subscriptions:
+            for response in await self.request_many(
+                [self._add_subscription_command(event) for event in self.subscriptions.values()]
+            ):
+                if response.status_code != OcaStatus.OK:
+                    logging.warning("Could not restore subscription: %s", response.status_code)
+
+        if not await self._probe_model():
+            logging.warning("%s changed while disconnected, discarding cached model", self.device_name)
+            self.device_model = None
+            self.read_cache.clear()
+            self._probe_results = None
+            return
+
+        keys = list(self.read_cache)
+        commands = [
+            Ocp1Command(
+                handle=self.next_handle,
+                target_ono=ono,
+                method_id=method_id,
+                parameters=self.read_cache[(ono, method_id, arguments)][0]
+            )
+            for ono, method_id, arguments in keys
+        ]
+        changed = 0
+        for key, command, response in zip(keys, commands, await self.request_many(commands)):
+            parameters, data = self.read_cache[key]
+            if response.status_code != OcaStatus.OK or response.parameter_data == data:
+                continue
+            self.read_cache[key] = (parameters, response.parameter_data)
+            changed += 1
+            for handler in self.resync_handlers:
+                handler(command, response)
+        logging.info("Resynced %s: %d of %d cached reads changed", self.device_name, changed, len(keys))
+
+
     async def _main_connected(self: object) -> None:
         """
         Main tick for State.CONNECTED
         """
-        self.device_model = ControlledDevice()
-        await asyncio.sleep(0.1)
-
-        # Demo
-        await self.enumerate_test()
-
-        await asyncio.sleep(5)
-        exit(0)
-        # for param in [Parameter(value=0, format="H"), Parameter(value=1, format="H")]:
-        #     pkt = Ocp1CommandPdu(
-        #         header=Ocp1Header(
-        #             protocol_version=1,
-        #             message_size=28,
-        #             message_type=MessageType.COMMAND_RESPONSE_REQUIRED,
-        #             message_count=1,
-        #         ),
-        #         commands=[
-        #             Ocp1Command(
-        #                 handle=1,
-        #                 target_ono=0x3060058,
-        #                 method_id=OcaMethodID(def_level=4, method_index=2),
-        #                 parameters=Ocp1Parameters(parameters=[param]),
-        #             )
-        #         ],
-        #     )
-        #     await self.transmit_queue.put(pkt)
-        #     await asyncio.sleep(5)
+        if self.device_model is None:
+            self.device_model = ControlledDevice()
+
+        # Idle until something moves us out of State.CONNECTED
+        self._state_changed.clear()
+        await self._state_changed.wait()
     
 
     async def enumerate_test(self) -> None:
@@ -300,20 +908,191 @@ class OCAController:
         )
 
 
+    def _stop_session(self: object) -> None:
+        """
+        Tear down the transport and session tasks
+        """
+        self.scheduler.unregister(self)
+        for task in (self.receive_task, self.transmit_task):
+            if task is not None:
+                task.cancel()
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self.session_active.clear()
+        self.unanswered_keepalives = 0
+        # Queued commands go out on the next session, so they keep their handles
+        queued = self._queued_handles()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Session with {self.device_name} lost"))
+        self._pending.clear()
+        self._sent_at.clear()
+        # Responses from this session are stale now
+        self.handle_registry.reclaim(queued.__contains__)
+
+
+    async def close(self: object) -> None:
+        """
+        End the session for good, stop a browser this controller started, finish saving the
+        discovery cache and drop its metrics from the registry. Metrics survive reconnects, so they are only removed here.
+        """
+        self._stop_session()
+        if self.revalidate_task is not None:
+            self.revalidate_task.cancel()
+        await self._close_discovery()
+        if self.discovery_cache is not None:
+            await self.discovery_cache.flush()
+        self.metrics.remove(**dict(self.metric_labels))
+
+
+    def _websocket_lost(self: object) -> None:
+        """
+        The device closed the WebSocket, so reconnect now rather than waiting for keepalives to go unanswered
+        """
+        if self.state is State.CONNECTED:
+            self._state_transition(State.DISCONNECTED)
+
+
+    async def _revalidate(self: object) -> None:
+        """
+        Confirm a cached endpoint with mDNS while the session comes up, and move the session
+        if the device is now elsewhere
+        """
+        # A browser of our own is kept apart from `self.discovery`, which the state machine may close
+        owned = self.discovery is None
+        discovery = OcaDiscovery(self.device_protocol) if owned else self.discovery
+        if owned:
+            await discovery.start()
+        try:
+            service = await discovery.wait_for(self.device_name, timeout=T_DISCOVERY_S)
+        except asyncio.TimeoutError:
+            logging.warning("%s not seen by mDNS, keeping cached endpoint", self.device_name)
+            return
+        finally:
+            if owned:
+                await discovery.close()
+        entry = self.discovery_cache.update(self.device_name, self.device_protocol, service)
+        if entry.endpoint == self.device_endpoint:
+            return
+        logging.warning("%s moved to %s:%s, reconnecting", self.device_name, *entry.endpoint)
+        self.device_endpoint = entry.endpoint
+        if self.state is State.CONNECTED:
+            # Rather than waiting for keepalives to the old endpoint to go unanswered
+            self._stop_session()
+            self._state_transition(State.CONNECTING)
+        # A session still connecting to the old endpoint retries when its warm connect times out
+
+
     async def start(self: object) -> None:
         """
         Start loop
         """
-        # Discover services & resolve address
-        self._state_transition(State.DISCOVERING)
+        if self.device_endpoint is not None:
+            self._state_transition(State.CONNECTING)
+        # Connect straight to a cached endpoint if there is one, revalidating it in the background
+        elif self.discovery_cache is not None and (cached := self.discovery_cache.get(self.device_name, self.device_protocol)):
+            self.device_endpoint = cached.endpoint
+            self._warm_start = True
+            self.revalidate_task = asyncio.create_task(self._revalidate())
+            self._state_transition(State.CONNECTING)
+        else:
+            # Discover services & resolve address
+            self._state_transition(State.DISCOVERING)
         while True:
             await self._state_callbacks[self.state]()
 
 
+async def start_controllers(
+    controllers: list[OCAController],
+    max_concurrent: int = 32,
+    timeout: float = T_DISCOVERY_S + T_KEEPALIVE_S,
+    browsers: Optional[dict[str, OcaDiscovery]] = None,
+) -> list[asyncio.Task]:
+    """
+    Bring up many sessions in parallel, with at most `max_concurrent` discovering or connecting at once.
+    A session that has not connected within `timeout` seconds keeps its place until it connects
+    or its task ends.
+
+    Args:
+        browsers:   Browsers by protocol, shared by the controllers without their own `OcaDiscovery`.
+                    Missing ones are started and added, and the caller closes them once the
+                    controllers are done. If None, each controller browses for itself when needed.
+
+    Returns:
+        list: The running `OCAController.start()` tasks, once every controller has connected or timed out
+    """
+    for controller in controllers:
+        if (
+            browsers is not None
+            and controller.discovery is None
+            and controller.device_protocol in SERVICE_TYPES
+            and not controller._static_endpoint
+        ):
+            if controller.device_protocol not in browsers:
+                browsers[controller.device_protocol] = OcaDiscovery(controller.device_protocol)
+                await browsers[controller.device_protocol].start()
+            controller.discovery = browsers[controller.device_protocol]
+
+    semaphore = asyncio.Semaphore(max_concurrent)
+    tasks = []
+
+    async def bring_up(controller: OCAController) -> None:
+        await semaphore.acquire()
+        task = asyncio.create_task(controller.start())
+        tasks.append(task)
+        connected = asyncio.ensure_future(controller.connected.wait())
+        # The slot is held until the session connects or its task ends, even after `timeout`,
+        # so that sessions still discovering or connecting count against `max_concurrent`
+        slot = asyncio.ensure_future(asyncio.wait({task, connected}, return_when=asyncio.FIRST_COMPLETED))
+        slot.add_done_callback(lambda _: (connected.cancel(), semaphore.release()))
+        try:
+            await asyncio.wait_for(asyncio.shield(slot), timeout)
+        except asyncio.TimeoutError:
+            logging.warning("%s did not connect within %ss", controller.device_name, timeout)
+
+    await asyncio.gather(*(bring_up(controller) for controller in controllers))
+    return tasks
+
+
 # == == == == =
 
 @click.command()
 @click.argument('target', nargs=1)
-def connect(target: str):
-    controller = OCAController(target, "udp")
-    asyncio.get_event_loop().run_until_complete(controller.start())
+@click.option('--cache/--no-cache', default=True, help="Connect to the last known address while rediscovering")
+@click.option('--verbose', '-v', is_flag=True, help="Log every packet")
+@click.option('--metrics-port', type=int, default=None, help="Serve Prometheus metrics on this port")
+@click.option('--offload-threshold', type=int, default=None, help="Decode response PDUs of at least this many bytes in a process pool")
+def connect(target: str, cache: bool, verbose: bool, metrics_port: Optional[int], offload_threshold: Optional[int]):
+    logging.basicConfig(
+        format="[%(asctime)s][%(levelname)s]: \t%(message)s", level=logging.DEBUG if verbose else logging.INFO
+    )
+    asyncio.run(_connect(target, cache, metrics_port, offload_threshold))
+
+
+async def _connect(
+    target: str,
+    cache: bool,
+    metrics_port: Optional[int] = None,
+    offload_threshold: Optional[int] = None
+) -> None:
+    if metrics_port is not None:
+        await serve_prometheus(default_metrics, port=metrics_port)
+    offload = DecodeOffload(offload_threshold) if offload_threshold is not None else None
+    controller = OCAController(
+        target, "udp", discovery_cache=OcaDiscoveryCache() if cache else None, offload=offload
+    )
+    session = asyncio.create_task(controller.start())
+    connected = asyncio.create_task(controller.connected.wait())
+    await asyncio.wait({session, connected}, return_when=asyncio.FIRST_COMPLETED)
+    if session.done():
+        connected.cancel()
+        session.result()
+
+    # Demo
+    await controller.enumerate_test()
+
+    await asyncio.sleep(5)
+    session.cancel()
+    if offload is not None:
+        offload.close()
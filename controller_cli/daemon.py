@@ -0,0 +1,514 @@
+"""
+Controller daemon
+-----------------
+
+Every CLI call or script that starts its own `OCAController` has to discover the device, set
+up a session and build its model before it can send a single command. A `ControllerDaemon`
+keeps sessions and device models warm across calls instead. Short-lived clients talk to it
+through a `DaemonClient` over a local Unix socket, and their get/set/batch calls take
+milliseconds.
+
+The socket uses a compact binary framing. A frame is a header followed by its body:
+
+    length (uint32, of the rest of the frame), request ID (uint32), op or status (uint8)
+
+Requests, and the bodies of their `STATUS_OK` responses:
+
+    OP_CALL     device name, command count (uint16), then per command:
+                    ONo (uint32), def level (uint16), method index (uint16),
+                    parameter length (uint16), OCP.1 parameters with their count byte
+                responds with a count (uint16), then per response:
+                    OCP.1 status (uint8), parameter length (uint16), OCP.1 parameters
+    OP_STATUS   no body
+                responds with a count (uint16), then per device:
+                    device name, session state (uint8), objects in its model (uint16)
+
+Device names are a length (uint8) and UTF-8. A request that fails is answered with
+`STATUS_ERROR` and a UTF-8 message. Requests on one connection are handled concurrently and
+answered as they complete, matched by their request ID.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import struct
+import tempfile
+import click
+from typing import Iterable, Optional, Sequence
+
+from ocacomms.OcaDiscovery import SERVICE_TYPES, OcaDiscovery
+from ocacomms.OcaDiscoveryCache import DEFAULT_CACHE_PATH, OcaDiscoveryCache
+from controller_cli.connect import OCAController, State, T_DISCOVERY_S, T_KEEPALIVE_S, T_RESPONSE_S
+from controller_cli.methods import format_result, parse_arguments, resolve_method
+from ocacore.ocp1 import *
+from ocacore.occ.root import Method
+
+
+T_DEVICE_CONNECT_S: float = T_DISCOVERY_S + T_KEEPALIVE_S  # seconds for a new device's session to come up
+MAX_FRAME_BYTES: int = 1 << 24  # larger frames close the connection
+
+OP_CALL: int = 1
+OP_STATUS: int = 2
+STATUS_OK: int = 0
+STATUS_ERROR: int = 1
+
+HEADER = struct.Struct("!IIB")  # the length excludes its own 4 bytes
+COUNT = struct.Struct("!H")
+COMMAND = struct.Struct("!IHHH")
+RESULT = struct.Struct("!BH")
+DEVICE_STATUS = struct.Struct("!BH")
+
+DEFAULT_SOCKET_PATH: str = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(), f"aes70-controller-{os.getuid()}.sock"
+)
+
+# A command as sent over the socket: ONo, method ID and its encoded parameters, count byte included
+CommandSpec = tuple[int, OcaMethodID, bytes]
+# A response as received: OCP.1 status and its encoded parameters, count byte included
+Result = tuple[OcaStatus, bytes]
+
+
+class DaemonError(Exception):
+    """ A request the daemon could not carry out """
+
+
+# == == == == == Framing
+
+def frame(request_id: int, op: int, body: bytes = b"") -> bytes:
+    return HEADER.pack(HEADER.size - 4 + len(body), request_id, op) + body
+
+
+async def read_frame(reader: asyncio.StreamReader) -> tuple[int, int, bytes]:
+    """
+    Returns:
+        tuple: Request ID, op or status, and body
+
+    Raises:
+        asyncio.IncompleteReadError: when the connection closes
+        ValueError: for a frame over `MAX_FRAME_BYTES`
+    """
+    length, request_id, op = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if not HEADER.size - 4 <= length <= MAX_FRAME_BYTES:
+        raise ValueError(f"Bad frame length {length}")
+    return request_id, op, await reader.readexactly(length - (HEADER.size - 4))
+
+
+def pack_name(name: str) -> bytes:
+    data = name.encode()
+    if len(data) > 0xFF:
+        raise ValueError(f"Device name too long: {name!r}")
+    return bytes((len(data),)) + data
+
+
+def unpack_name(data: bytes, offset: int) -> tuple[str, int]:
+    end = offset + 1 + data[offset]
+    if end > len(data):
+        raise struct.error("Truncated device name")
+    return data[offset + 1:end].decode(), end
+
+
+def pack_call(device: str, commands: Sequence[CommandSpec]) -> bytes:
+    parts = [pack_name(device), COUNT.pack(len(commands))]
+    for ono, method_id, parameters in commands:
+        parts.append(COMMAND.pack(ono, int(method_id.def_level), int(method_id.method_index), len(parameters)))
+        parts.append(parameters)
+    return b"".join(parts)
+
+
+def unpack_call(data: bytes) -> tuple[str, list[CommandSpec]]:
+    """
+    Raises:
+        struct.error: for a truncated body
+    """
+    device, offset = unpack_name(data, 0)
+    count, = COUNT.unpack_from(data, offset)
+    offset += COUNT.size
+    commands = []
+    for _ in range(count):
+        ono, def_level, method_index, length = COMMAND.unpack_from(data, offset)
+        offset += COMMAND.size
+        if offset + length > len(data):
+            raise struct.error("Truncated parameters")
+        commands.append((ono, OcaMethodID(def_level=def_level, method_index=method_index), data[offset:offset + length]))
+        offset += length
+    return device, commands
+
+
+def pack_results(responses: Iterable[Ocp1Response]) -> bytes:
+    responses = list(responses)
+    parts = [COUNT.pack(len(responses))]
+    for response in responses:
+        parameters = response.parameter_data or b""
+        parts.append(RESULT.pack(response.status_code.value, len(parameters)))
+        parts.append(parameters)
+    return b"".join(parts)
+
+
+def unpack_results(data: bytes) -> list[Result]:
+    count, = COUNT.unpack_from(data, 0)
+    offset = COUNT.size
+    results = []
+    for _ in range(count):
+        status, length = RESULT.unpack_from(data, offset)
+        offset += RESULT.size
+        results.append((OcaStatus(status), bytes(data[offset:offset + length])))
+        offset += length
+    return results
+
+
+def encode_parameters(arguments: Sequence[OCCBase]) -> bytes:
+    return Ocp1Parameters(parameters=[Parameter(value=argument) for argument in arguments] or None).bytes
+
+
+# == == == == == Daemon
+
+class ControllerDaemon:
+    """
+    Keep device sessions warm and serve commands to local clients over a Unix socket.
+    Sessions start the first time a device is named, and stay up until the daemon closes.
+
+    Args:
+        socket_path:        Where to listen
+        protocol:           Device protocol, as for `OCAController`
+        discovery_cache:    Shared by every session, for warm starts
+        connect_timeout:    Seconds to wait for a new device's session
+    """
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET_PATH,
+        protocol: str = "udp",
+        discovery_cache: Optional[OcaDiscoveryCache] = None,
+        connect_timeout: float = T_DEVICE_CONNECT_S,
+    ) -> None:
+        self.socket_path: str = socket_path
+        self.protocol: str = protocol
+        self.discovery_cache: Optional[OcaDiscoveryCache] = discovery_cache
+        self.connect_timeout: float = connect_timeout
+
+        self.controllers: dict[str, OCAController] = {}
+        self.sessions: dict[str, asyncio.Task] = {}
+        self.discovery: Optional[OcaDiscovery] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._clients: dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    # == == == == == Sessions
+
+    def add_device(self, name: str, endpoint: Optional[tuple[str, int]] = None) -> OCAController:
+        """
+        Register a device without starting its session
+
+        Args:
+            name:       Service name of the device
+            endpoint:   Static `(host, port)`, skipping discovery
+        """
+        if name not in self.controllers:
+            self.controllers[name] = OCAController(
+                name, self.protocol, discovery_cache=self.discovery_cache, discovery=self.discovery, endpoint=endpoint
+            )
+        return self.controllers[name]
+
+    async def controller(self, name: str) -> OCAController:
+        """
+        The connected controller for `name`, starting its session if needed
+
+        Raises:
+            DaemonError: if the session does not come up in time
+        """
+        controller = self.add_device(name)
+        if controller.connected.is_set():
+            return controller
+        if controller.discovery is None and not controller._static_endpoint and self.protocol in SERVICE_TYPES:
+            # One browser for every device
+            if self.discovery is None:
+                self.discovery = OcaDiscovery(self.protocol)
+                await self.discovery.start()
+            controller.discovery = self.discovery
+        if name not in self.sessions:
+            self.sessions[name] = asyncio.create_task(controller.start())
+        session = self.sessions[name]
+        connected = asyncio.create_task(controller.connected.wait())
+        try:
+            await asyncio.wait({session, connected}, timeout=self.connect_timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            connected.cancel()
+        if controller.connected.is_set():
+            return controller
+        if session.done():
+            # Let the next request try again from scratch
+            del self.sessions[name]
+            del self.controllers[name]
+            error = session.exception() if not session.cancelled() else None
+            raise DaemonError(f"Could not connect to {name}: {error!r}")
+        raise DaemonError(f"{name} did not connect within {self.connect_timeout}s")
+
+    async def call(self, name: str, commands: Sequence[CommandSpec], timeout: float = T_RESPONSE_S) -> list[Ocp1Response]:
+        """
+        Send `commands` to a device as one coalesced batch and wait for every response
+
+        Raises:
+            DaemonError: if the device cannot be reached
+            asyncio.TimeoutError: if any response does not arrive in time
+        """
+        controller = await self.controller(name)
+        return await controller.request_many([
+            Ocp1Command(
+                handle=controller.next_handle,
+                target_ono=ono,
+                method_id=method_id,
+                parameters=Ocp1Parameters(parameters=None),
+                parameter_data=parameters,
+            )
+            for ono, method_id, parameters in commands
+        ], timeout)
+
+    # == == == == == Clients
+
+    async def _request(self, op: int, body: bytes) -> bytes:
+        if op == OP_CALL:
+            try:
+                name, commands = unpack_call(body)
+            except (struct.error, UnicodeDecodeError) as error:
+                raise DaemonError(f"Malformed call: {error}")
+            return pack_results(await self.call(name, commands))
+        if op == OP_STATUS:
+            parts = [COUNT.pack(len(self.controllers))]
+            for name, controller in self.controllers.items():
+                model = controller.device_model
+                parts.append(pack_name(name))
+                parts.append(DEVICE_STATUS.pack(controller.state.value, len(model.control_objects) if model else 0))
+            return b"".join(parts)
+        raise DaemonError(f"Unknown op {op}")
+
+    async def _answer(self, writer: asyncio.StreamWriter, request_id: int, op: int, body: bytes) -> None:
+        try:
+            response = frame(request_id, STATUS_OK, await self._request(op, body))
+        except Exception as error:
+            # Every request is answered, or the client would wait forever. Besides our own errors
+            # this covers e.g. the session dropping mid-call, or `HandleTableFull`.
+            response = frame(request_id, STATUS_ERROR, (str(error) or type(error).__name__).encode())
+        if not writer.is_closing():
+            writer.write(response)
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._clients[task] = writer
+        requests: set[asyncio.Task] = set()
+        try:
+            while True:
+                request = asyncio.create_task(self._answer(writer, *await read_frame(reader)))
+                requests.add(request)
+                request.add_done_callback(requests.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except ValueError as error:
+            logging.warning("Dropping daemon client: %s", error)
+        finally:
+            for request in requests:
+                request.cancel()
+            writer.close()
+            self._clients.pop(task, None)
+
+    async def start(self) -> None:
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = await asyncio.start_unix_server(self._client, self.socket_path)
+        # Anyone who can reach the socket can control the devices
+        os.chmod(self.socket_path, 0o600)
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+        # Closing the connections ends their tasks, which asyncio's stream callbacks expect
+        # rather than cancellation
+        for writer in self._clients.values():
+            writer.close()
+        await asyncio.gather(*self._clients, return_exceptions=True)
+        for controller in self.controllers.values():
+            await controller.close()
+        for session in self.sessions.values():
+            session.cancel()
+        self.sessions.clear()
+        self.controllers.clear()
+        if self.discovery is not None:
+            await self.discovery.close()
+            self.discovery = None
+
+
+# == == == == == Client
+
+class DaemonClient:
+    """
+    A connection to a `ControllerDaemon`. Calls from many tasks share the connection.
+
+        async with DaemonClient() as client:
+            status, data = await client.get("dsp", 0x1001, OcaGain.get_gain)
+    """
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH) -> None:
+        self.socket_path: str = socket_path
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._receive_task: Optional[asyncio.Task] = None
+        self._pending: dict[int, asyncio.Future] = {}
+        self._request_ids = itertools.count(1)
+
+    async def connect(self) -> None:
+        self._reader, self._writer = await asyncio.open_unix_connection(self.socket_path)
+        self._receive_task = asyncio.create_task(self._receive())
+
+    async def close(self) -> None:
+        if self._receive_task is not None:
+            self._receive_task.cancel()
+            self._receive_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def __aenter__(self) -> "DaemonClient":
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    async def _receive(self) -> None:
+        error = ConnectionError("Daemon closed the connection")
+        try:
+            while True:
+                request_id, status, body = await read_frame(self._reader)
+                future = self._pending.get(request_id)
+                if future is None or future.done():
+                    continue
+                if status == STATUS_OK:
+                    future.set_result(body)
+                else:
+                    future.set_exception(DaemonError(body.decode(errors="replace")))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as exc:
+            error = ConnectionError(f"Lost the daemon: {exc}")
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def _send(self, op: int, body: bytes = b"") -> bytes:
+        if self._writer is None:
+            raise ConnectionError("Not connected")
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._writer.write(frame(request_id, op, body))
+            return await future
+        finally:
+            del self._pending[request_id]
+
+    async def call(self, device: str, commands: Sequence[CommandSpec]) -> list[Result]:
+        """
+        Send encoded commands to a device as one batch
+
+        Raises:
+            DaemonError: if the daemon could not carry them out
+        """
+        return unpack_results(await self._send(OP_CALL, pack_call(device, commands)))
+
+    async def batch(self, device: str, calls: Sequence[tuple]) -> list[Result]:
+        """
+        Call many methods on a device in one round trip
+
+        Args:
+            calls:  `(ono, method, *arguments)` tuples, with `Method`s and OCC arguments
+        """
+        return await self.call(device, [
+            (ono, method.method_id, encode_parameters(arguments)) for ono, method, *arguments in calls
+        ])
+
+    async def get(self, device: str, ono: int, method: Method, *arguments: OCCBase) -> Result:
+        return (await self.batch(device, [(ono, method, *arguments)]))[0]
+
+    async def set(self, device: str, ono: int, method: Method, *arguments: OCCBase) -> OcaStatus:
+        return (await self.batch(device, [(ono, method, *arguments)]))[0][0]
+
+    async def status(self) -> dict[str, tuple[State, int]]:
+        """
+        Returns:
+            dict: Device name to its session state and the number of objects in its model
+        """
+        body = await self._send(OP_STATUS)
+        count, = COUNT.unpack_from(body, 0)
+        offset = COUNT.size
+        devices = {}
+        for _ in range(count):
+            name, offset = unpack_name(body, offset)
+            state, objects = DEVICE_STATUS.unpack_from(body, offset)
+            offset += DEVICE_STATUS.size
+            devices[name] = (State(state), objects)
+        return devices
+
+
+# == == == == =
+
+@click.group()
+def daemon():
+    """ Keep device sessions warm for fast calls from scripts """
+
+
+@daemon.command()
+@click.option('--socket', 'socket_path', default=DEFAULT_SOCKET_PATH, show_default=True, help="Unix socket to listen on")
+@click.option('--protocol', type=click.Choice(["udp", "websocket"]), default="udp", show_default=True)
+@click.option('--cache/--no-cache', default=True, help="Connect to the last known address while rediscovering")
+@click.option('--verbose', '-v', is_flag=True, help="Log every packet")
+def serve(socket_path: str, protocol: str, cache: bool, verbose: bool):
+    """ Run the daemon """
+    logging.basicConfig(
+        format="[%(asctime)s][%(levelname)s]: \t%(message)s", level=logging.DEBUG if verbose else logging.INFO
+    )
+    asyncio.run(_serve(socket_path, protocol, cache))
+
+
+async def _serve(socket_path: str, protocol: str, cache: bool) -> None:
+    server = ControllerDaemon(socket_path, protocol, OcaDiscoveryCache(DEFAULT_CACHE_PATH) if cache else None)
+    await server.start()
+    logging.info("Listening on %s", socket_path)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+@daemon.command()
+@click.argument('device')
+@click.argument('ono', type=lambda text: int(text, 0))
+@click.argument('method')
+@click.argument('arguments', nargs=-1)
+@click.option('--socket', 'socket_path', default=DEFAULT_SOCKET_PATH, show_default=True)
+def call(device: str, ono: int, method: str, arguments: tuple[str, ...], socket_path: str):
+    """ Call METHOD, e.g. OcaGain.set_gain, on object ONO of DEVICE """
+    try:
+        _, resolved = resolve_method(method)
+        parsed = parse_arguments(resolved, arguments) if resolved.kwargs or arguments else []
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+    status, data = asyncio.run(_call(socket_path, device, ono, resolved, parsed))
+    click.echo(f"{status.name}\t{format_result(resolved, data)}".rstrip())
+    if status != OcaStatus.OK:
+        raise SystemExit(1)
+
+
+async def _call(socket_path: str, device: str, ono: int, method: Method, arguments: list[OCCBase]) -> Result:
+    async with DaemonClient(socket_path) as client:
+        return await client.get(device, ono, method, *arguments)
+
+
+@daemon.command()
+@click.option('--socket', 'socket_path', default=DEFAULT_SOCKET_PATH, show_default=True)
+def status(socket_path: str):
+    """ List the daemon's devices and their sessions """
+    for name, (state, objects) in asyncio.run(_status(socket_path)).items():
+        click.echo(f"{name}\t{state.name}\t{objects}")
+
+
+async def _status(socket_path: str) -> dict[str, tuple[State, int]]:
+    async with DaemonClient(socket_path) as client:
+        return await client.status()
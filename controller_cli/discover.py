@@ -1,17 +1,20 @@
 from ocacomms.OcaDiscovery import OcaDiscovery
+import asyncio
 import logging
-from time import sleep
 import click
 
+
+async def _discover() -> None:
+    async with OcaDiscovery("udp"):
+        await asyncio.Event().wait()
+
+
 @click.command()
 def discover() -> None:
     logging.basicConfig(
         format="[%(asctime)s]:\t%(message)s", level=logging.DEBUG
     )
-    discovery = OcaDiscovery("udp")
-    while True:
-        try:
-            sleep(.1)
-        except KeyboardInterrupt:
-            del discovery
-            exit(0)
\ No newline at end of file
+    try:
+        asyncio.run(_discover())
+    except KeyboardInterrupt:
+        exit(0)
@@ -0,0 +1,71 @@
+"""
+Keepalive scheduler
+-------------------
+
+A single timer wheel that drives the keepalives of every session, spreading them across the
+keepalive interval so that hundreds of sessions do not all send in the same tick.
+"""
+
+import asyncio
+import logging
+from typing import Optional, Protocol
+
+
+class KeepaliveSession(Protocol):
+    def keepalive_due(self) -> None:
+        """ Called once per keepalive interval """
+
+
+class KeepaliveScheduler:
+    """
+    Timer wheel with `slots` slots per `interval`. Each registered session is placed in the
+    least loaded slot and has `keepalive_due()` called once per revolution.
+
+    Args:
+        interval:   Seconds between keepalives for one session
+        slots:      Number of ticks per interval, i.e. the scheduling resolution
+    """
+    def __init__(self, interval: float, slots: int = 50) -> None:
+        self.interval: float = interval
+        self.slots: int = slots
+        self.tick: float = interval / slots
+        self.wheel: list[set[KeepaliveSession]] = [set() for _ in range(slots)]
+        self._slot_of: dict[KeepaliveSession, int] = {}
+        self._cursor: int = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._slot_of)
+
+    def register(self, session: KeepaliveSession) -> None:
+        """
+        Start calling `session.keepalive_due()` once per interval
+        """
+        if session in self._slot_of:
+            return
+        # Search backwards from the current slot, so ties go to the slot furthest in the future
+        slot = min(
+            ((self._cursor - offset) % self.slots for offset in range(self.slots)),
+            key=lambda i: len(self.wheel[i])
+        )
+        self.wheel[slot].add(session)
+        self._slot_of[session] = slot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def unregister(self, session: KeepaliveSession) -> None:
+        if (slot := self._slot_of.pop(session, None)) is not None:
+            self.wheel[slot].discard(session)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while self._slot_of:
+            next_tick += self.tick
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            self._cursor = (self._cursor + 1) % self.slots
+            for session in list(self.wheel[self._cursor]):
+                try:
+                    session.keepalive_due()
+                except Exception as exc:
+                    logging.warning("Keepalive failed for %s: %s", session, exc)
@@ -0,0 +1,36 @@
+"""
+Lazy click groups
+-----------------
+
+Subcommands are named by import path and only imported when they are invoked (or listed by
+`--help`), so a short CLI run only pays for the modules it uses.
+"""
+
+import importlib
+import click
+from typing import Optional
+
+
+class LazyGroup(click.Group):
+    """
+    Args:
+        lazy_subcommands:   Command name to `"module:attribute"` of the click command
+    """
+    def __init__(self, *args, lazy_subcommands: Optional[dict[str, str]] = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.lazy_subcommands: dict[str, str] = lazy_subcommands or {}
+
+    def list_commands(self, ctx: click.Context) -> list[str]:
+        return sorted({*super().list_commands(ctx), *self.lazy_subcommands})
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> Optional[click.Command]:
+        if cmd_name in self.lazy_subcommands:
+            return self._load(cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def _load(self, cmd_name: str) -> click.Command:
+        module_name, attribute = self.lazy_subcommands[cmd_name].split(":")
+        command = getattr(importlib.import_module(module_name), attribute)
+        if not isinstance(command, click.Command):
+            raise ValueError(f"{self.lazy_subcommands[cmd_name]} is not a click command")
+        return command
@@ -0,0 +1,228 @@
+"""
+Crosspoint matrix client
+------------------------
+
+Local mirror of an `OcaMatrix` whose members are gain or mute actuators, such as a mixer's
+crosspoint matrix. Bulk changes are diffed against the mirrored state and only the changed
+cells are sent, coalesced into as few PDUs as possible.
+"""
+
+import logging
+from array import array
+from enum import Enum
+from typing import Mapping, NamedTuple, Optional, Sequence, Union
+
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain, OcaMatrix, OcaMute
+from ocacore.occ.types.block_matrix import OcaMatrixCoordinate
+
+
+WILDCARD: int = 0xFFFF  # SetCurrentXY coordinate meaning "every row / column"
+PROPERTY_CHANGED: tuple[int, int] = (1, 1)  # OcaRoot PropertyChanged event ID
+
+
+class CrosspointKind(NamedTuple):
+    setter: Method
+    property_id: OcaPropertyID
+    typecode: str  # `array` typecode used to mirror the member values
+    value_type: type
+
+
+CROSSPOINT_KINDS: dict[type, CrosspointKind] = {
+    OcaGain: CrosspointKind(OcaGain.set_gain, OcaGain.gain_property_id, "f", OcaDB),
+    OcaMute: CrosspointKind(OcaMute.set_state, OcaMute.state_property_id, "B", OcaUint8),
+}
+
+Cell = tuple[int, int]
+CrosspointValue = Union[float, int, OcaMuteState]
+
+
+class CrosspointMatrix:
+    """
+    Mirror of an `OcaMatrix` of `OcaGain` or `OcaMute` members.
+
+    Values are held row-major in a flat `array`, indexed by `(x, y)`. Mute matrices hold
+    `OcaMuteState` values. The mirror is kept current from PropertyChanged notifications
+    emitted by the members, so `members` must be known for notifications to be applied.
+
+    Args:
+        controller:     Connected controller used to send commands
+        matrix_ono:     Object number of the `OcaMatrix`
+        proxy_ono:      Object number of the matrix proxy
+        x_size:         Number of columns
+        y_size:         Number of rows
+        member_class:   `OcaGain` or `OcaMute`
+        members:        Optional member object numbers, row-major. When given, single cell
+                        changes are sent straight to the member instead of via the proxy.
+    """
+    def __init__(
+        self,
+        controller: "OCAController",
+        matrix_ono: int,
+        proxy_ono: int,
+        x_size: int,
+        y_size: int,
+        member_class: type = OcaGain,
+        members: Optional[Sequence[int]] = None,
+    ) -> None:
+        if member_class not in CROSSPOINT_KINDS:
+            raise TypeError(f"Unsupported crosspoint member class: {member_class.__qualname__}")
+        if members is not None and len(members) != x_size * y_size:
+            raise ValueError(f"Expected {x_size * y_size} members, got {len(members)}")
+
+        self.controller = controller
+        self.matrix_ono: int = matrix_ono
+        self.proxy_ono: int = proxy_ono
+        self.x_size: int = x_size
+        self.y_size: int = y_size
+        self.kind: CrosspointKind = CROSSPOINT_KINDS[member_class]
+        self.values: array = array(self.kind.typecode, [0]) * (x_size * y_size)
+
+        self.members: Optional[list[int]] = None if members is None else list(members)
+        self._member_index: dict[int, int] = {} if members is None else {ono: i for i, ono in enumerate(members)}
+
+        controller.notification_handlers.append(self.handle_notification)
+
+
+    # == == == == == Helpers
+
+    def _index(self, cell: Cell) -> int:
+        x, y = cell
+        if not (0 <= x < self.x_size and 0 <= y < self.y_size):
+            raise IndexError(f"Crosspoint {cell} outside {self.x_size}x{self.y_size} matrix")
+        return y * self.x_size + x
+
+    @staticmethod
+    def _raw(value: CrosspointValue) -> Union[float, int]:
+        return value.value if isinstance(value, Enum) else value
+
+    def __getitem__(self, cell: Cell) -> CrosspointValue:
+        return self.values[self._index(cell)]
+
+    def _proxy_set(self, x: int, y: int, value: Union[float, int]) -> list[Ocp1Command]:
+        return [
+            self.controller.make_command(self.matrix_ono, OcaMatrix.set_current_xy, OcaMatrixCoordinate(x), OcaMatrixCoordinate(y)),
+            self.controller.make_command(self.proxy_ono, self.kind.setter, self.kind.value_type(value)),
+        ]
+
+
+    # == == == == == Bulk operations
+
+    def commands_for(self, target: array) -> list[list[Ocp1Command]]:
+        """
+        Build the commands needed to move the matrix from its current values to `target`.
+        Uniform rows, columns or the whole matrix are set with a single wildcard
+        SetCurrentXY + proxy setter pair; the remaining cells are set one by one.
+
+        Returns:
+            list: Groups of commands, each group must be sent in order within one PDU
+        """
+        return [commands for _, commands in self._plan(target)]
+
+
+    def _plan(self, target: array) -> list[tuple[list[int], list[Ocp1Command]]]:
+        """
+        As `commands_for()`, with the indices of the changed cells each group sets
+        """
+        changed = [i for i, (old, new) in enumerate(zip(self.values, target)) if old != new]
+        if not changed:
+            return []
+
+        if len(changed) > 1 and target.count(target[0]) == len(target):
+            return [(changed, self._proxy_set(WILDCARD, WILDCARD, target[0]))]
+
+        groups = []
+        remaining = set(changed)
+
+        rows: dict[int, list[int]] = {}
+        for i in changed:
+            rows.setdefault(i // self.x_size, []).append(i)
+        for y, row_changed in rows.items():
+            row = target[y * self.x_size:(y + 1) * self.x_size]
+            if len(row_changed) > 1 and row.count(row[0]) == len(row):
+                groups.append((row_changed, self._proxy_set(WILDCARD, y, row[0])))
+                remaining.difference_update(row_changed)
+
+        columns: dict[int, list[int]] = {}
+        for i in sorted(remaining):
+            columns.setdefault(i % self.x_size, []).append(i)
+        for x, column_changed in columns.items():
+            column = target[x::self.x_size]
+            if len(column_changed) > 1 and column.count(column[0]) == len(column):
+                groups.append((column_changed, self._proxy_set(x, WILDCARD, column[0])))
+                remaining.difference_update(column_changed)
+
+        for i in sorted(remaining):
+            if self.members is not None:
+                groups.append(([i], [self.controller.make_command(self.members[i], self.kind.setter, self.kind.value_type(target[i]))]))
+            else:
+                groups.append(([i], self._proxy_set(i % self.x_size, i // self.x_size, target[i])))
+        return groups
+
+
+    async def set(self, changes: Mapping[Cell, CrosspointValue]) -> int:
+        """
+        Set any number of crosspoints, sending only the cells whose value changes.
+
+        Args:
+            changes: New values keyed by `(x, y)`
+
+        Returns:
+            int: Number of commands sent. Cells the device rejects keep their old value.
+        """
+        target = array(self.kind.typecode, self.values)
+        for cell, value in changes.items():
+            target[self._index(cell)] = self._raw(value)
+        return await self._apply(target)
+
+
+    async def load(self, grid: Sequence[Sequence[CrosspointValue]]) -> int:
+        """
+        Replace the whole matrix, e.g. when recalling a routing preset.
+
+        Args:
+            grid: New values indexed `grid[y][x]`
+
+        Returns:
+            int: Number of commands sent. Cells the device rejects keep their old value.
+        """
+        if len(grid) != self.y_size or any(len(row) != self.x_size for row in grid):
+            raise ValueError(f"Expected a {self.x_size}x{self.y_size} grid")
+        target = array(self.kind.typecode, (self._raw(value) for row in grid for value in row))
+        return await self._apply(target)
+
+
+    async def _apply(self, target: array) -> int:
+        """
+        Send the commands for `target` and mirror only the cells the device accepted
+
+        Raises:
+            asyncio.TimeoutError: if any response does not arrive, leaving the mirror unchanged
+            ConnectionError: if the session is lost
+        """
+        groups = self._plan(target)
+        responses = iter(await self.controller.request_many([commands for _, commands in groups]))
+        for cells, commands in groups:
+            # SetCurrentXY then the setter, the cells changed only if every command succeeded
+            statuses = [next(responses).status_code for _ in commands]
+            if all(status == OcaStatus.OK for status in statuses):
+                for i in cells:
+                    self.values[i] = target[i]
+            else:
+                logging.warning("Could not set %d crosspoints of matrix %#x: %s", len(cells), self.matrix_ono, statuses)
+        return sum(len(commands) for _, commands in groups)
+
+
+    # == == == == == Notifications
+
+    def handle_notification(self, notification: Ocp1Notification) -> None:
+        """
+        Update the mirrored value when a member reports a PropertyChanged event
+        """
+        index = self._member_index.get(int(notification.event.emitter_ono))
+        event_id = notification.event.event_id
+        if index is None or (int(event_id.def_level), int(event_id.event_index)) != PROPERTY_CHANGED:
+            return
+        property_id, value, change_type = notification.property_changed(self.kind.value_type)
+        if property_id == self.kind.property_id and change_type == OcaPropertyChangeType.CurrentChanged:
+            self.values[index] = value.value
@@ -0,0 +1,109 @@
+"""
+Methods by name
+---------------
+
+Look up OCC methods from text such as `OcaGain.set_gain` and parse their arguments, for
+commands given on the command line or in scripts. The class registry is only built the
+first time it is needed.
+"""
+
+import functools
+from typing import Optional, Sequence
+
+from ocacore.ocp1 import *
+from ocacore.occ.root import Method, OcaRoot
+
+
+@functools.lru_cache(maxsize=None)
+def occ_classes() -> dict[str, type]:
+    """ Every OCC class by name, e.g. `"OcaGain"` """
+    # Imported here so that the class modules are only loaded when methods are looked up by name
+    from ocacore.occ import manager, worker
+
+    classes = {}
+    pending = [OcaRoot]
+    while pending:
+        cls = pending.pop()
+        classes[cls.__name__] = cls
+        pending.extend(cls.__subclasses__())
+    return classes
+
+
+@functools.lru_cache(maxsize=None)
+def getter_ids() -> frozenset[tuple[int, int]]:
+    """
+    `(def_level, method_index)` of the methods that only read. An ID counts when every class
+    that has it names it `get_*`, so methods unknown here are never taken for reads.
+    """
+    is_getter: dict[tuple[int, int], set[bool]] = {}
+    for cls in occ_classes().values():
+        for name in dir(cls):
+            if isinstance(method := getattr(cls, name, None), Method):
+                key = (int(method.method_id.def_level), int(method.method_id.method_index))
+                is_getter.setdefault(key, set()).add(name.startswith("get_"))
+    return frozenset(key for key, flags in is_getter.items() if flags == {True})
+
+
+def resolve_method(spec: str) -> tuple[Optional[type], Method]:
+    """
+    Look up a method from `"OcaClass.method_name"`, or a bare method ID such as `"4.2"`,
+    which has no known argument types.
+
+    Returns:
+        tuple: The class, None for a bare method ID, and the `Method`
+
+    Raises:
+        ValueError: if the class or method is unknown
+    """
+    class_name, _, method_name = spec.rpartition(".")
+    if class_name.isdigit() and method_name.isdigit():
+        return None, Method(method_id=OcaMethodID(def_level=int(class_name), method_index=int(method_name)))
+    if (cls := occ_classes().get(class_name)) is None:
+        raise ValueError(f"Unknown class {class_name!r}")
+    if not isinstance(method := getattr(cls, method_name, None), Method):
+        raise ValueError(f"{class_name} has no method {method_name!r}")
+    return cls, method
+
+
+def parse_argument(value_type: type, text: str) -> OCCBase:
+    """
+    Parse one argument of a simple OCC type from text. Blobs are given in hex.
+
+    Raises:
+        ValueError: for text that is not a valid value, or a type that cannot be given as text
+    """
+    if issubclass(value_type, OcaString):
+        return value_type(text)
+    if issubclass(value_type, (OcaBlob, OcaBlobFixedLen)):
+        return value_type(data=bytes.fromhex(text))
+    if issubclass(value_type, OcaBoolean):
+        if text.lower() not in ("0", "1", "true", "false", "on", "off"):
+            raise ValueError(f"Not a boolean: {text!r}")
+        return value_type(text.lower() in ("1", "true", "on"))
+    value_format = getattr(value_type, "_format", None)
+    if not issubclass(value_type, OcaValueBase) or not isinstance(value_format, str):
+        raise ValueError(f"Arguments of type {value_type.__name__} cannot be given as text")
+    return value_type(float(text) if value_format in ("f", "d") else int(text, 0))
+
+
+def parse_arguments(method: Method, texts: Sequence[str]) -> list[OCCBase]:
+    """
+    Raises:
+        ValueError: if the number of arguments does not match, or one cannot be parsed
+    """
+    types = list((method.kwargs or {}).values())
+    if len(texts) != len(types):
+        raise ValueError(f"Method {method.method_id} takes {len(types)} arguments, {len(texts)} given")
+    return [parse_argument(value_type, text) for value_type, text in zip(types, texts)]
+
+
+def format_result(method: Method, parameter_data: bytes) -> str:
+    """ A response's parameters as text, decoded if the method's response type allows, else hex """
+    if not parameter_data or parameter_data[0] == 0:
+        return ""
+    if method.response_type is not None and hasattr(method.response_type, "from_bytes"):
+        try:
+            return str(method.response_type.from_bytes(parameter_data[1:]))
+        except Exception:
+            pass
+    return parameter_data.hex()
@@ -0,0 +1,220 @@
+"""
+Metrics
+-------
+
+Lightweight in-process counters, gauges and histograms for the controller hot path, with an
+optional Prometheus text endpoint. Recording a value is a couple of attribute updates, so
+instrumentation can stay enabled in production.
+"""
+
+import asyncio
+from bisect import bisect_left
+from typing import Callable, Optional, Union
+
+
+# Seconds, suited to encode/decode times and round trips on a LAN
+DEFAULT_BUCKETS: tuple[float, ...] = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5
+)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value: Union[int, float] = 0
+
+    def inc(self, amount: Union[int, float] = 1) -> None:
+        self.value += amount
+
+
+class Gauge:
+    """ Either set explicitly, or read from `function` when collected (e.g. a queue size) """
+    __slots__ = ("value", "function")
+
+    def __init__(self) -> None:
+        self.value: Union[int, float] = 0
+        self.function: Optional[Callable[[], Union[int, float]]] = None
+
+    def set(self, value: Union[int, float]) -> None:
+        self.value = value
+
+    def set_function(self, function: Callable[[], Union[int, float]]) -> None:
+        self.function = function
+
+    def get(self) -> Union[int, float]:
+        return self.function() if self.function is not None else self.value
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.bounds: tuple[float, ...] = bounds
+        self.counts: list[int] = [0] * (len(bounds) + 1)  # Last bucket is +Inf
+        self.sum: float = 0.0
+        self.count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: "Histogram") -> None:
+        """ Add the observations of `other`, which must have the same bounds """
+        if other.bounds != self.bounds:
+            raise ValueError("Cannot merge histograms with different buckets")
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the `q` quantile, `inf` if it is above the last bucket
+        """
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target and seen:
+                return bound
+        return float("inf")
+
+
+class MetricFamily:
+    """
+    A named metric with one child per set of label values, e.g. one counter per device
+    """
+    def __init__(self, kind: str, name: str, help: str, factory: Callable) -> None:
+        self.kind: str = kind
+        self.name: str = name
+        self.help: str = help
+        self._factory: Callable = factory
+        self.children: dict[Labels, Union[Counter, Gauge, Histogram]] = {}
+
+    def labels(self, **labels: str) -> Union[Counter, Gauge, Histogram]:
+        key = tuple(sorted((name, str(value)) for name, value in labels.items()))
+        if (child := self.children.get(key)) is None:
+            child = self.children[key] = self._factory()
+        return child
+
+    def remove(self, **labels: str) -> None:
+        self.children.pop(tuple(sorted((name, str(value)) for name, value in labels.items())), None)
+
+
+class Metrics:
+    """
+    Registry of metric families. Families are created on first use and shared after that,
+    so several controllers can record into the same family with different labels.
+    """
+    def __init__(self) -> None:
+        self.families: dict[str, MetricFamily] = {}
+
+    def _family(self, kind: str, name: str, help: str, factory: Callable) -> MetricFamily:
+        if (family := self.families.get(name)) is None:
+            family = self.families[name] = MetricFamily(kind, name, help, factory)
+        elif family.kind != kind:
+            raise TypeError(f"Metric {name} is a {family.kind}, not a {kind}")
+        return family
+
+    def counter(self, name: str, help: str) -> MetricFamily:
+        return self._family("counter", name, help, Counter)
+
+    def gauge(self, name: str, help: str) -> MetricFamily:
+        return self._family("gauge", name, help, Gauge)
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> MetricFamily:
+        return self._family("histogram", name, help, lambda: Histogram(buckets))
+
+    def remove(self, **labels: str) -> None:
+        """ Drop every child with exactly these labels, e.g. when a controller goes away """
+        for family in self.families.values():
+            family.remove(**labels)
+
+    def snapshot(self) -> dict[str, dict[Labels, Union[int, float, dict]]]:
+        """
+        Current values, keyed by metric name then labels. Histograms are summarised as
+        `{"count", "sum", "mean", "p50", "p99"}`.
+        """
+        snapshot = {}
+        for name, family in self.families.items():
+            values = {}
+            for labels, child in family.children.items():
+                if isinstance(child, Histogram):
+                    values[labels] = {
+                        "count": child.count,
+                        "sum": child.sum,
+                        "mean": child.mean,
+                        "p50": child.quantile(0.5),
+                        "p99": child.quantile(0.99),
+                    }
+                elif isinstance(child, Gauge):
+                    values[labels] = child.get()
+                else:
+                    values[labels] = child.value
+            snapshot[name] = values
+        return snapshot
+
+    def prometheus(self) -> str:
+        """
+        Render all metrics in the Prometheus text exposition format
+        """
+        def escape(value: str) -> str:
+            return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        def fmt(labels: Labels, extra: Labels = ()) -> str:
+            labels = labels + extra
+            if not labels:
+                return ""
+            return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+        lines = []
+        for name, family in self.families.items():
+            lines.append(f"# HELP {name} {family.help}")
+            lines.append(f"# TYPE {name} {family.kind}")
+            for labels, child in family.children.items():
+                if isinstance(child, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(child.bounds, child.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{fmt(labels, (('le', repr(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{fmt(labels, (('le', '+Inf'),))} {child.count}")
+                    lines.append(f"{name}_sum{fmt(labels)} {child.sum}")
+                    lines.append(f"{name}_count{fmt(labels)} {child.count}")
+                elif isinstance(child, Gauge):
+                    lines.append(f"{name}{fmt(labels)} {child.get()}")
+                else:
+                    lines.append(f"{name}{fmt(labels)} {child.value}")
+        return "\n".join(lines) + "\n"
+
+
+# Shared by every controller that is not given its own registry
+metrics = Metrics()
+
+
+async def serve_prometheus(registry: Metrics, host: str = "127.0.0.1", port: int = 9642) -> asyncio.AbstractServer:
+    """
+    Serve `registry.prometheus()` over HTTP on every request, for Prometheus to scrape
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            body = registry.prometheus().encode("UTF-8")
+            writer.write(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode("ascii")
+                + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
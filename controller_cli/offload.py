@@ -0,0 +1,72 @@
+"""
+Decode offload
+--------------
+
+Large response PDUs (member lists of big blocks, transfer functions, property dumps) can take
+long enough to decode that keepalives and other sessions on the same event loop stall. With
+a `DecodeOffload`, a controller hands response PDUs above a size threshold to a process or
+thread pool, which decodes them with `unpack_responses()` into tuples and arrays.
+"""
+
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Optional
+
+from ocacore.ocp1 import *
+
+
+OFFLOAD_THRESHOLD_BYTES: int = 4096  # response PDUs at least this large are decoded in the pool
+
+
+class DecodeOffload:
+    """
+    A pool for decoding large responses, shared by any number of controllers.
+
+    Args:
+        threshold:  PDUs of at least this many bytes are offloaded
+        threads:    Use a thread pool instead of a process pool. Threads avoid copying the data
+                    to another process, but still share the GIL with the event loop.
+        workers:    Pool size, the executor's default if None
+        executor:   Use this executor instead of creating one
+    """
+    def __init__(
+        self,
+        threshold: int = OFFLOAD_THRESHOLD_BYTES,
+        threads: bool = False,
+        workers: Optional[int] = None,
+        executor: Optional[Executor] = None,
+    ) -> None:
+        self.threshold: int = threshold
+        self._threads: bool = threads
+        self._workers: Optional[int] = workers
+        self.executor: Optional[Executor] = executor
+        # Compact formats for methods whose response type has no fixed `struct` format,
+        # e.g. `"*f"` for a list of floats. See `unpack_responses()`.
+        self.formats: dict[OcaMethodID, str] = {}
+
+    def wants(self, data: bytes) -> bool:
+        return len(data) >= self.threshold and data[7] == MessageType.RESPONSE.value
+
+    def format_for(self, command: Ocp1Command, device_model: Optional[ControlledDevice]) -> Optional[str]:
+        """
+        The compact format for the response to `command`, from `formats` or the fixed `struct`
+        format of the method's response type
+        """
+        if (value_format := self.formats.get(command.method_id)) is not None:
+            return value_format
+        try:
+            response_type = device_model.control_objects[command.target_ono].methods[command.method_id].response_type
+        except (KeyError, AttributeError):
+            return None
+        value_format = getattr(response_type, "_format", None)
+        return value_format.replace("!", "") if isinstance(value_format, str) else None
+
+    async def decode(self, data: bytes, formats: dict[int, str]) -> list[tuple[int, int, bytes, Any]]:
+        if self.executor is None:
+            self.executor = (ThreadPoolExecutor if self._threads else ProcessPoolExecutor)(self._workers)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, unpack_responses, data, formats)
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,320 @@
+"""
+Proxy
+-----
+
+Small devices accept few controller connections and slow down when several controllers poll
+them. An `OcaProxy` holds one upstream session with a device through an `OCAController`, and
+serves any number of downstream OCP.1 clients over UDP or WebSocket:
+
+- Commands are forwarded upstream with the upstream session's own handles, and each
+  response is returned under the handle its client chose.
+- Reads are answered from a cache shared by every client. Concurrent identical reads share
+  one upstream request. A cached value lasts `cache_ttl` seconds, or until it changes for
+  objects whose PropertyChanged event the proxy is subscribed to upstream.
+- Subscriptions are kept by the proxy. The first client subscribing to an event subscribes
+  the proxy upstream, and every upstream notification is fanned out to the subscribed
+  clients with their own subscriber method and context.
+- Any other command to an object invalidates that object's cached reads.
+"""
+
+import asyncio
+import logging
+import time
+import click
+from typing import Optional, Union
+
+from ocacomms.OcaDeviceServer import COMMAND_HEADER, RESPONSE_HEADER, Address, OcaDeviceServer
+from ocacomms.OcaDiscoveryCache import OcaDiscoveryCache
+from controller_cli.connect import OCAController, State, T_RESPONSE_S
+from controller_cli.methods import getter_ids
+from ocacore.ocp1 import *
+from ocacore.occ.root import OcaRoot
+
+
+T_CACHE_S: float = 0.5  # seconds a read is served from the cache, for objects without an upstream subscription
+
+ReadKey = tuple[int, int, int, bytes]  # (ONo, def_level, method_index, parameters)
+PROPERTY_CHANGED = (int(OcaRoot.property_changed_event.def_level), int(OcaRoot.property_changed_event.event_index))
+
+
+def response_message(handle: int, status: OcaStatus, parameters: bytes) -> bytes:
+    parameters = parameters or b"\x00"
+    return RESPONSE_HEADER.pack(RESPONSE_HEADER.size + len(parameters), handle, status.value) + parameters
+
+
+class OcaProxy(OcaDeviceServer):
+    """
+    Args:
+        controller: Upstream session with the device, started by the caller
+        cache_ttl:  Seconds reads are served from the cache for objects without an upstream subscription
+        timeout:    Seconds to wait for an upstream response before answering `OcaStatus.Timeout`
+    """
+    def __init__(self, controller: OCAController, cache_ttl: float = T_CACHE_S, timeout: float = T_RESPONSE_S) -> None:
+        super().__init__()
+        self.controller: OCAController = controller
+        self.cache_ttl: float = cache_ttl
+        self.timeout: float = timeout
+        self.getters: frozenset[tuple[int, int]] = getter_ids()
+
+        # Read -> (status, parameters, expiry), the expiry is None while it is kept up to date by notifications
+        self.cache: dict[ReadKey, tuple[OcaStatus, bytes, Optional[float]]] = {}
+        self._cached_onos: dict[int, set[ReadKey]] = {}
+        self._inflight: dict[ReadKey, asyncio.Future] = {}
+        # Bumped whenever an object's cached reads are invalidated
+        self._generation: dict[int, int] = {}
+        self._upstream_events: set[tuple[int, int, int]] = set()
+        # Upstream subscriptions the device has accepted, only these keep cached reads fresh
+        self._subscribed: set[tuple[int, int, int]] = set()
+        self._replies: dict[Address, list[bytes]] = {}
+        self._forwarding: set[asyncio.Task] = set()
+
+        self.forwarded: int = 0
+        self.cache_hits: int = 0
+        self.shared_reads: int = 0
+
+        controller.notification_handlers.append(self._upstream_notification)
+        controller.state_handlers.append(self._upstream_state)
+
+    # == == == == == Commands
+
+    def _commands_received(self, data: bytes, offset: int, count: int, addr: Address, response_required: bool) -> None:
+        now = time.monotonic()
+        local = []
+        forward = []
+        for _ in range(count):
+            command_size, handle, ono, def_level, method_index = COMMAND_HEADER.unpack_from(data, offset)
+            end = offset + command_size
+            key = (ono, def_level, method_index)
+            if key in self.dispatch:
+                # Subscriptions are the proxy's own
+                status, result = self._call(data, offset + COMMAND_HEADER.size, end, key, addr)
+                local.append(response_message(handle, status, b"\x00" if result is None else b"\x01" + result.bytes))
+            else:
+                parameters = bytes(data[offset + COMMAND_HEADER.size:end])
+                read = (ono, def_level, method_index, parameters) if (def_level, method_index) in self.getters else None
+                cached = self.cache.get(read) if read is not None else None
+                if cached is not None and (cached[2] is None or cached[2] > now):
+                    self.cache_hits += 1
+                    local.append(response_message(handle, cached[0], cached[1]))
+                else:
+                    forward.append((handle, ono, def_level, method_index, parameters, read))
+            offset = end
+        if response_required:
+            for message in local:
+                self._reply(addr, message)
+        if forward:
+            task = asyncio.ensure_future(self._forward(addr, forward, response_required))
+            self._forwarding.add(task)
+            task.add_done_callback(self._forwarding.discard)
+
+    async def _forward(self, addr: Address, commands: list[tuple], response_required: bool) -> None:
+        if not self.controller.connected.is_set():
+            if response_required:
+                for handle, *_ in commands:
+                    self._reply(addr, response_message(handle, OcaStatus.DeviceError, b"\x00"))
+            return
+        loop = asyncio.get_running_loop()
+        futures: list[asyncio.Future] = []
+        upstream: list[tuple[Ocp1Command, Optional[ReadKey], int, asyncio.Future]] = []
+        for handle, ono, def_level, method_index, parameters, read in commands:
+            if read is not None and (shared := self._inflight.get(read)) is not None:
+                self.shared_reads += 1
+                futures.append(shared)
+                continue
+            if read is None:
+                self._invalidate(ono)
+            command = Ocp1Command(
+                handle=self.controller.next_handle,
+                target_ono=ono,
+                method_id=OcaMethodID(def_level=def_level, method_index=method_index),
+                parameters=Ocp1Parameters(parameters=None),
+                parameter_data=parameters,
+            )
+            # Resolved from the upstream response, and shared with any identical read until then
+            result = loop.create_future()
+            if read is not None:
+                self._inflight[read] = result
+            futures.append(result)
+            upstream.append((command, read, self._generation.get(ono, 0), result))
+
+        if upstream:
+            try:
+                sent = await self.controller.submit([command for command, *_ in upstream])
+            except Exception as exc:
+                sent = []
+                for args in upstream:
+                    self._upstream_done(*args, exc)
+            self.forwarded += len(sent)
+            for args, future in zip(upstream, sent):
+                future.add_done_callback(lambda future, args=args: self._upstream_done(*args, future))
+            loop.call_later(self.timeout, self._expire, sent)
+
+        if response_required:
+            for (handle, *_), future in zip(commands, futures):
+                future.add_done_callback(lambda future, handle=handle: self._reply_with(addr, handle, future))
+
+    def _upstream_done(
+        self,
+        command: Ocp1Command,
+        read: Optional[ReadKey],
+        generation: int,
+        result: asyncio.Future,
+        future: Union[asyncio.Future, Exception],
+    ) -> None:
+        ono = int(command.target_ono)
+        if read is not None and self._inflight.get(read) is result:
+            del self._inflight[read]
+        if not isinstance(future, Exception):
+            error = asyncio.CancelledError() if future.cancelled() else future.exception()
+        else:
+            error = future
+        if error is not None:
+            self.controller.forget([command])
+            if not result.done():
+                result.set_exception(error)
+            return
+        response = future.result()
+        if not result.done():
+            result.set_result(response)
+        if read is None:
+            self._invalidate(ono)
+        elif response.status_code == OcaStatus.OK and self._generation.get(ono, 0) == generation:
+            # Only cached when nothing changed the object while the read was on its way
+            subscribed = (ono, *PROPERTY_CHANGED) in self._subscribed
+            self.cache[read] = (response.status_code, response.parameter_data, None if subscribed else time.monotonic() + self.cache_ttl)
+            self._cached_onos.setdefault(ono, set()).add(read)
+
+    def _expire(self, futures: list[asyncio.Future]) -> None:
+        for future in futures:
+            if not future.done():
+                future.set_exception(asyncio.TimeoutError())
+
+    def _reply_with(self, addr: Address, handle: int, future: asyncio.Future) -> None:
+        if future.cancelled():
+            status, parameters = OcaStatus.DeviceError, b"\x00"
+        elif (error := future.exception()) is not None:
+            status = OcaStatus.Timeout if isinstance(error, asyncio.TimeoutError) else OcaStatus.DeviceError
+            parameters = b"\x00"
+        else:
+            response = future.result()
+            status, parameters = response.status_code, response.parameter_data
+        self._reply(addr, response_message(handle, status, parameters))
+
+    def _reply(self, addr: Address, message: bytes) -> None:
+        """ Queue a response, sent with the others for `addr` completed in this event loop iteration """
+        if (replies := self._replies.get(addr)) is None:
+            replies = self._replies[addr] = []
+            asyncio.get_running_loop().call_soon(self._flush_replies, addr)
+        replies.append(message)
+
+    def _flush_replies(self, addr: Address) -> None:
+        self._send(addr, MessageType.RESPONSE, self._replies.pop(addr, []))
+
+    def _invalidate(self, ono: int) -> None:
+        self._generation[ono] = self._generation.get(ono, 0) + 1
+        for read in self._cached_onos.pop(ono, ()):
+            self.cache.pop(read, None)
+        # Reads already on their way may return the old value, later ones must not share them
+        for read in [read for read in self._inflight if read[0] == ono]:
+            del self._inflight[read]
+
+    # == == == == == Subscriptions & notifications
+
+    def _add_subscription(
+        self,
+        event: OcaEvent,
+        subscriber: OcaMethod,
+        subscriber_context: OcaBlob,
+        notification_delivery_mode: OcaUint8,
+        destination_information: OcaBlob,
+        addr: Address
+    ) -> None:
+        super()._add_subscription(event, subscriber, subscriber_context, notification_delivery_mode, destination_information, addr)
+        key = (int(event.emitter_ono), int(event.event_id.def_level), int(event.event_id.event_index))
+        if key not in self._upstream_events:
+            self._upstream_events.add(key)
+            task = asyncio.ensure_future(self._subscribe_upstream(key, event))
+            self._forwarding.add(task)
+            task.add_done_callback(self._forwarding.discard)
+
+    async def _subscribe_upstream(self, key: tuple[int, int, int], event: OcaEvent) -> None:
+        try:
+            response = await self.controller.subscribe(key[0], event.event_id)
+        except (asyncio.TimeoutError, ConnectionError) as exc:
+            logging.warning("Could not subscribe upstream to %s: %r", key, exc)
+            self.controller.subscriptions.pop(key, None)
+            self._upstream_events.discard(key)
+            self._invalidate(key[0])
+            return
+        if response.status_code != OcaStatus.OK:
+            logging.warning("Upstream refused subscription to %s: %s", key, response.status_code)
+            self.controller.subscriptions.pop(key, None)
+            self._upstream_events.discard(key)
+            self._invalidate(key[0])
+        elif key[1:] == PROPERTY_CHANGED:
+            # Values of this object are now kept fresh by notifications
+            self._subscribed.add(key)
+            self._invalidate(key[0])
+
+    def _upstream_state(self, state: State) -> None:
+        if state is State.CONNECTED:
+            return
+        # Changes made while the session is down never arrive as notifications
+        for ono in {read[0] for read in (*self.cache, *self._inflight)}:
+            self._invalidate(ono)
+
+    def _upstream_notification(self, notification: Ocp1Notification) -> None:
+        event = notification.event
+        emitter = int(event.emitter_ono)
+        key = (emitter, int(event.event_id.def_level), int(event.event_id.event_index))
+        supersede = None
+        if key[1:] == PROPERTY_CHANGED:
+            self._invalidate(emitter)
+            data = notification.event_data
+            # A newer current value makes a waiting one obsolete, see `OcaDeviceServer.property_changed()`
+            if len(data) > 4 and data[-1] == OcaPropertyChangeType.CurrentChanged.value:
+                supersede = bytes(data[:4])
+        if self.notifications.has_subscribers(key):
+            self.notifications.publish(key, notification.event_data, supersede)
+
+    def close(self) -> None:
+        for task in self._forwarding:
+            task.cancel()
+        if self._upstream_notification in self.controller.notification_handlers:
+            self.controller.notification_handlers.remove(self._upstream_notification)
+        if self._upstream_state in self.controller.state_handlers:
+            self.controller.state_handlers.remove(self._upstream_state)
+        super().close()
+
+
+# == == == == =
+
+@click.command()
+@click.argument('target', nargs=1)
+@click.option('--host', default="0.0.0.0", show_default=True, help="Address to serve clients on")
+@click.option('--port', type=int, default=50000, show_default=True, help="UDP port for clients")
+@click.option('--websocket-port', type=int, default=None, help="Also serve clients over WebSocket on this port")
+@click.option('--cache-ttl', type=float, default=T_CACHE_S, show_default=True, help="Seconds reads are served from the cache")
+@click.option('--cache/--no-cache', default=True, help="Connect to the last known address while rediscovering")
+@click.option('--verbose', '-v', is_flag=True, help="Log every packet")
+def proxy(target: str, host: str, port: int, websocket_port: Optional[int], cache_ttl: float, cache: bool, verbose: bool):
+    """ Share one session with TARGET between many OCP.1 clients """
+    logging.basicConfig(
+        format="[%(asctime)s][%(levelname)s]: \t%(message)s", level=logging.DEBUG if verbose else logging.INFO
+    )
+    asyncio.run(_proxy(target, host, port, websocket_port, cache_ttl, cache))
+
+
+async def _proxy(target: str, host: str, port: int, websocket_port: Optional[int], cache_ttl: float, cache: bool) -> None:
+    controller = OCAController(target, "udp", discovery_cache=OcaDiscoveryCache() if cache else None)
+    session = asyncio.create_task(controller.start())
+    server = OcaProxy(controller, cache_ttl)
+    await server.start(host, port)
+    if websocket_port is not None:
+        await server.start_websocket(host, websocket_port)
+    logging.info("Proxying %s on %s:%s", target, host, port)
+    try:
+        await session
+    finally:
+        server.close()
+        await controller.close()
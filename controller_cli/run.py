@@ -0,0 +1,287 @@
+"""
+Batch runner
+------------
+
+Run a script of operations against one device, one operation per line:
+
+    # target        method              arguments
+    0x1001          OcaGain.set_gain    -6.5
+    Main Gain       OcaGain.get_gain
+    4097            4.1
+
+The target is an ONo, or a role path looked up in a role map. The method is
+`OcaClass.method_name`, or a bare method ID such as `4.1` without arguments. Fields are
+split as by a shell, so quote role paths and strings that contain spaces. Blank lines and
+lines starting with `#` are skipped.
+
+Instead of a round trip per line, operations are compiled to `Ocp1Command`s and pipelined.
+Whatever is ready is coalesced into multi-message PDUs, at most `window` commands are
+awaiting a response at any time, and results are streamed back as they arrive, which is
+not necessarily in script order.
+"""
+
+import asyncio
+import json
+import logging
+import shlex
+import threading
+import click
+from typing import AsyncIterator, Iterable, NamedTuple, Optional, TextIO
+
+from ocacomms.OcaDiscoveryCache import OcaDiscoveryCache
+from controller_cli.connect import OCAController, T_RESPONSE_S
+from controller_cli.methods import format_result, parse_arguments, resolve_method
+from ocacore.ocp1 import *
+from ocacore.occ.root import Method
+
+
+WINDOW: int = 256  # commands awaiting a response at once
+BATCH: int = 64  # most commands coalesced into one send, further split by PDU size
+
+
+class Operation(NamedTuple):
+    line: int
+    target: str
+    method: str
+    arguments: tuple[str, ...]
+
+
+class OperationResult(NamedTuple):
+    operation: Operation
+    method: Optional[Method]
+    response: Optional[Ocp1Response]
+    error: Optional[str]  # When the operation could not be compiled or was not answered
+
+    @property
+    def ok(self) -> bool:
+        return self.response is not None and self.response.status_code == OcaStatus.OK
+
+    def __str__(self) -> str:
+        if self.response is None:
+            return f"{self.operation.line}\tERROR\t{self.error}"
+        return f"{self.operation.line}\t{self.response.status_code.name}\t{format_result(self.method, self.response.parameter_data)}".rstrip()
+
+
+def parse_operation(line_number: int, line: str) -> Optional[Operation]:
+    """
+    Returns:
+        Operation: The operation on `line`, or None for a blank or comment line
+
+    Raises:
+        ValueError: if the line has no method, or unbalanced quotes
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    fields = shlex.split(line)
+    if len(fields) < 2:
+        raise ValueError(f"Line {line_number}: expected a target and a method")
+    return Operation(line_number, fields[0], fields[1], tuple(fields[2:]))
+
+
+def load_roles(file: TextIO) -> dict[str, int]:
+    """ Read a role map, a JSON object of role paths to ONos """
+    return {path: int(ono, 0) if isinstance(ono, str) else int(ono) for path, ono in json.load(file).items()}
+
+
+class BatchRunner:
+    """
+    Run operations against a connected controller, pipelined and coalesced
+
+    Args:
+        controller: Connected controller for the device
+        roles:      Role paths to ONos. Objects in the controller's device model are found
+                    by their role as well.
+        window:     Most commands awaiting a response at once
+        batch:      Most commands coalesced into one send
+        timeout:    Seconds to wait for each batch's responses
+    """
+    def __init__(
+        self,
+        controller: OCAController,
+        roles: Optional[dict[str, int]] = None,
+        window: int = WINDOW,
+        batch: int = BATCH,
+        timeout: float = T_RESPONSE_S,
+    ) -> None:
+        if window < 1 or batch < 1:
+            raise ValueError("Window and batch must be at least 1")
+        self.controller: OCAController = controller
+        self.roles: dict[str, int] = {}
+        if controller.device_model is not None:
+            self.roles.update((str(obj.role), int(ono)) for ono, obj in controller.device_model.control_objects.items())
+        self.roles.update(roles or {})
+        self.window: int = window
+        self.batch: int = batch
+        self.timeout: float = timeout
+        self._methods: dict[str, Method] = {}
+
+    def compile(self, operation: Operation) -> tuple[Method, Ocp1Command]:
+        """
+        Raises:
+            ValueError: for an unknown target or method, or bad arguments
+        """
+        try:
+            ono = int(operation.target, 0)
+        except ValueError:
+            if (ono := self.roles.get(operation.target)) is None:
+                raise ValueError(f"Unknown role path {operation.target!r}")
+        if (method := self._methods.get(operation.method)) is None:
+            _, method = resolve_method(operation.method)
+            self._methods[operation.method] = method
+        arguments = parse_arguments(method, operation.arguments) if method.kwargs or operation.arguments else []
+        return method, self.controller.make_command(ono, method, *arguments)
+
+    async def run(self, lines: Iterable[str]) -> AsyncIterator[OperationResult]:
+        """
+        Run every operation in `lines` and yield each result as it completes. `lines` is read
+        in a thread, so it can be a slow stream such as stdin.
+        """
+        loop = asyncio.get_running_loop()
+        incoming: asyncio.Queue = asyncio.Queue()
+        results: asyncio.Queue = asyncio.Queue()
+        window = asyncio.Semaphore(self.window)
+
+        def read() -> None:
+            try:
+                for line in lines:
+                    loop.call_soon_threadsafe(incoming.put_nowait, line)
+            finally:
+                loop.call_soon_threadsafe(incoming.put_nowait, None)
+
+        def finish(operation: Operation, method: Method, command: Ocp1Command, future: asyncio.Future) -> None:
+            window.release()
+            if future.cancelled():
+                results.put_nowait(OperationResult(operation, method, None, "Cancelled"))
+            elif (error := future.exception()) is not None:
+                self.controller.forget([command])
+                results.put_nowait(OperationResult(operation, method, None, str(error) or type(error).__name__))
+            else:
+                results.put_nowait(OperationResult(operation, method, future.result(), None))
+
+        def expire(futures: list[asyncio.Future]) -> None:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(asyncio.TimeoutError(f"No response within {self.timeout}s"))
+
+        async def flush(batch: list[tuple[Operation, Method, Ocp1Command]]) -> None:
+            try:
+                futures = await self.controller.submit([command for _, _, command in batch])
+            except Exception as error:
+                for operation, method, command in batch:
+                    self.controller.forget([command])
+                    window.release()
+                    results.put_nowait(OperationResult(operation, method, None, str(error)))
+                return
+            for (operation, method, command), future in zip(batch, futures):
+                future.add_done_callback(lambda future, args=(operation, method, command): finish(*args, future))
+            loop.call_later(self.timeout, expire, futures)
+
+        async def produce() -> None:
+            batch = []
+            line_number = 0
+            while True:
+                if incoming.empty() and batch:
+                    # Nothing more is ready yet, send what there is
+                    await flush(batch)
+                    batch = []
+                if (line := await incoming.get()) is None:
+                    break
+                line_number += 1
+                operation = Operation(line_number, "", "", ())
+                try:
+                    if (operation := parse_operation(line_number, line)) is None:
+                        continue
+                    method, command = self.compile(operation)
+                except ValueError as error:
+                    results.put_nowait(OperationResult(operation, None, None, str(error)))
+                    continue
+                if window.locked() and batch:
+                    await flush(batch)
+                    batch = []
+                await window.acquire()
+                batch.append((operation, method, command))
+                if len(batch) >= self.batch:
+                    await flush(batch)
+                    batch = []
+            if batch:
+                await flush(batch)
+            # Every command has been answered or expired once the whole window is free
+            for _ in range(self.window):
+                await window.acquire()
+
+        reader = threading.Thread(target=read, name="oca-run-reader", daemon=True)
+        reader.start()
+        producer = asyncio.create_task(produce())
+        try:
+            while not (producer.done() and results.empty()):
+                getter = asyncio.create_task(results.get())
+                await asyncio.wait({getter, producer}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield getter.result()
+                else:
+                    getter.cancel()
+            producer.result()
+        finally:
+            producer.cancel()
+
+
+# == == == == =
+
+@click.command()
+@click.argument('target', nargs=1)
+@click.argument('script', type=click.File("r"), default="-")
+@click.option('--roles', type=click.File("r"), default=None, help="JSON object of role paths to ONos")
+@click.option('--window', type=int, default=WINDOW, show_default=True, help="Most commands awaiting a response at once")
+@click.option('--batch', type=int, default=BATCH, show_default=True, help="Most commands coalesced into one send")
+@click.option('--timeout', type=float, default=T_RESPONSE_S, show_default=True, help="Seconds to wait for responses")
+@click.option('--cache/--no-cache', default=True, help="Connect to the last known address while rediscovering")
+@click.option('--verbose', '-v', is_flag=True, help="Log every packet")
+def run(
+    target: str,
+    script: TextIO,
+    roles: Optional[TextIO],
+    window: int,
+    batch: int,
+    timeout: float,
+    cache: bool,
+    verbose: bool,
+):
+    """
+    Run the operations in SCRIPT, or stdin, against TARGET. Prints each result as
+    `line, status, value` as it arrives.
+    """
+    logging.basicConfig(
+        format="[%(asctime)s][%(levelname)s]: \t%(message)s", level=logging.DEBUG if verbose else logging.WARNING
+    )
+    role_map = load_roles(roles) if roles is not None else None
+    if not asyncio.run(_run(target, script, role_map, window, batch, timeout, cache)):
+        raise SystemExit(1)
+
+
+async def _run(
+    target: str,
+    script: TextIO,
+    roles: Optional[dict[str, int]],
+    window: int,
+    batch: int,
+    timeout: float,
+    cache: bool,
+) -> bool:
+    controller = OCAController(target, "udp", discovery_cache=OcaDiscoveryCache() if cache else None)
+    session = asyncio.create_task(controller.start())
+    connected = asyncio.create_task(controller.connected.wait())
+    await asyncio.wait({session, connected}, return_when=asyncio.FIRST_COMPLETED)
+    if session.done():
+        connected.cancel()
+        session.result()
+
+    ok = True
+    try:
+        async for result in BatchRunner(controller, roles, window, batch, timeout).run(script):
+            click.echo(str(result))
+            ok = ok and result.ok
+    finally:
+        await controller.close()
+        session.cancel()
+    return ok
@@ -0,0 +1,519 @@
+"""
+Supervisor
+----------
+
+One Python process runs every `OCAController` on one core. A `ControllerSupervisor` shards
+devices across worker processes instead, each with its own event loop and session pool.
+Devices are placed by consistent hashing of their name, so adding a worker only moves about
+1/N of them.
+
+The supervisor keeps the registry of devices, their shard and their session state, and talks
+to the workers over a local Unix socket with length-prefixed pickled messages. A device is used
+through a `RemoteController`, which has the same control API as a local `OCAController`.
+Calls are forwarded to the owning worker and run there against the warm session.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import struct
+import tempfile
+import click
+from typing import Any, Callable, Iterable, Optional, Union
+
+from ocacomms.OcaDiscovery import OcaDiscovery
+from ocacomms.OcaDiscoveryCache import DEFAULT_CACHE_PATH, OcaDiscoveryCache
+from controller_cli.connect import OCAController, State, T_DISCOVERY_S, T_KEEPALIVE_S, T_RESPONSE_S, start_controllers
+from ocacore.ocp1 import *
+from ocacore.occ.root import Method, OcaRoot
+
+
+RING_REPLICAS: int = 64  # points on the hash ring per worker
+T_WORKER_START_S: float = 30  # seconds for every worker to report in
+T_WORKER_STOP_S: float = 5  # seconds to wait for a worker to exit before terminating it
+T_CALL_S: float = 10  # seconds a worker has to answer a call, on top of the call's own timeout
+
+FRAME = struct.Struct("!I")
+
+# `OCAController` methods a `RemoteController` forwards to its worker
+FORWARDED = frozenset({"request", "request_many", "send_commands", "read", "subscribe"})
+
+Endpoint = Optional[tuple[str, int]]
+
+
+class ShardRing:
+    """
+    Consistent hash ring mapping device names to worker indexes
+
+    Args:
+        shards:     Number of workers
+        replicas:   Points on the ring per worker, more spread devices more evenly
+    """
+    def __init__(self, shards: int, replicas: int = RING_REPLICAS) -> None:
+        if shards < 1:
+            raise ValueError("At least one shard is needed")
+        self.shards: int = shards
+        points = sorted(
+            (self._hash(f"{shard}#{replica}"), shard) for shard in range(shards) for replica in range(replicas)
+        )
+        self._keys: list[int] = [key for key, _ in points]
+        self._shards: list[int] = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        # Not `hash()`, which is salted per process
+        return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+    def shard_for(self, name: str) -> int:
+        index = bisect.bisect(self._keys, self._hash(name.lower()))
+        return self._shards[index % len(self._keys)]
+
+
+# == == == == == IPC
+
+async def read_message(reader: asyncio.StreamReader) -> Any:
+    size, = FRAME.unpack(await reader.readexactly(FRAME.size))
+    return pickle.loads(await reader.readexactly(size))
+
+
+def write_message(writer: asyncio.StreamWriter, message: Any) -> None:
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    writer.write(FRAME.pack(len(data)) + data)
+
+
+def _rehandle(controller: OCAController, commands: list) -> tuple[list, dict[int, int]]:
+    """
+    Give commands made by the caller handles from `controller`, which owns the handle space
+
+    Returns:
+        tuple: The renumbered commands, with nested lists kept, and a map from new to original handle
+    """
+    original = {}
+
+    def renumber(command: Union[Ocp1Command, list]) -> Union[Ocp1Command, list]:
+        if isinstance(command, list):
+            return [renumber(member) for member in command]
+        handle = controller.next_handle
+        original[handle] = int(command.handle)
+        return command.copy(update={"handle": handle})
+
+    return [renumber(command) for command in commands], original
+
+
+def _restore(response: Ocp1Response, original: dict[int, int]) -> Ocp1Response:
+    return response.copy(update={"handle": OcaUint32(original[int(response.handle)])})
+
+
+# == == == == == Worker
+
+class _Worker:
+    """
+    Runs in each worker process: owns the controllers of one shard and serves calls from the supervisor
+    """
+    def __init__(self, shard: int, socket_path: str, protocol: str, cache_path: Optional[str]) -> None:
+        self.shard: int = shard
+        self.socket_path: str = socket_path
+        self.protocol: str = protocol
+        self.cache: Optional[OcaDiscoveryCache] = OcaDiscoveryCache(cache_path) if cache_path else None
+        self.controllers: dict[str, OCAController] = {}
+        self.sessions: list[asyncio.Task] = []
+        # Shared by every batch of controllers this worker adds
+        self.browsers: dict[str, OcaDiscovery] = {}
+        self.calls: set[asyncio.Task] = set()
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    def send(self, message: Any) -> None:
+        if self.writer is not None and not self.writer.is_closing():
+            write_message(self.writer, message)
+
+    async def run(self) -> None:
+        reader, self.writer = await asyncio.open_unix_connection(self.socket_path)
+        self.send(("hello", self.shard, os.getpid()))
+        try:
+            while True:
+                message = await read_message(reader)
+                if message[0] == "stop":
+                    break
+                if message[0] == "add":
+                    self._start(self.add(message[1]))
+                elif message[0] == "call":
+                    self._start(self.call(*message[1:]))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logging.warning("Worker %d lost the supervisor", self.shard)
+        finally:
+            await self.stop()
+
+    def _start(self, coroutine) -> None:
+        task = asyncio.create_task(coroutine)
+        self.calls.add(task)
+        task.add_done_callback(self.calls.discard)
+
+    async def add(self, devices: list[tuple[str, Endpoint]]) -> None:
+        controllers = []
+        for name, endpoint in devices:
+            if name in self.controllers:
+                continue
+            controller = OCAController(name, self.protocol, discovery_cache=self.cache, endpoint=endpoint)
+            controller.state_handlers.append(lambda state, name=name: self.send(("state", name, state.value)))
+            controller.notification_handlers.append(
+                lambda notification, name=name: self.send(("notification", name, notification.bytes))
+            )
+            self.controllers[name] = controller
+            controllers.append(controller)
+        self.sessions.extend(await start_controllers(controllers, browsers=self.browsers))
+
+    async def call(self, call_id: int, name: str, method: str, args: tuple, kwargs: dict) -> None:
+        try:
+            controller = self.controllers[name]
+            if method in ("request", "request_many", "send_commands"):
+                commands, original = _rehandle(controller, [args[0]] if method == "request" else args[0])
+                result = await getattr(controller, method)(commands[0] if method == "request" else commands, *args[1:], **kwargs)
+                if method == "request":
+                    result = _restore(result, original)
+                elif method == "request_many":
+                    result = [_restore(response, original) for response in result]
+            else:
+                result = await getattr(controller, method)(*args, **kwargs)
+        except Exception as exc:
+            reply = ("error", call_id, exc)
+        else:
+            reply = ("result", call_id, result)
+        try:
+            self.send(reply)
+        except Exception as exc:
+            # Something that cannot be pickled, the caller still gets an answer
+            logging.warning("Could not send the reply to call %d: %r", call_id, exc)
+            self.send(("error", call_id, RuntimeError(repr(reply[2]))))
+
+    async def stop(self) -> None:
+        for controller in self.controllers.values():
+            await controller.close()
+        for task in (*self.sessions, *self.calls):
+            task.cancel()
+        for browser in self.browsers.values():
+            await browser.close()
+        self.browsers.clear()
+        if self.writer is not None:
+            self.writer.close()
+
+
+def _worker_main(shard: int, socket_path: str, protocol: str, cache_path: Optional[str], log_level: int) -> None:
+    """ Entry point of a worker process """
+    logging.basicConfig(format=f"[%(asctime)s][%(levelname)s][worker {shard}]: \t%(message)s", level=log_level)
+    try:
+        asyncio.run(_Worker(shard, socket_path, protocol, cache_path).run())
+    except KeyboardInterrupt:
+        pass
+
+
+# == == == == == Supervisor
+
+class RemoteController:
+    """
+    A device session running in a worker process, used like a local `OCAController`.
+
+    `request()`, `request_many()`, `send_commands()`, `read()` and `subscribe()` run in the worker.
+    `state`, `connected` and the handler lists are kept up to date here from the worker's reports.
+    """
+    def __init__(self, supervisor: "ControllerSupervisor", device_name: str, shard: int, endpoint: Endpoint = None) -> None:
+        self.supervisor: "ControllerSupervisor" = supervisor
+        self.device_name: str = device_name
+        self.shard: int = shard
+        self.device_endpoint: Endpoint = endpoint
+        self.state: State = State.DISCONNECTED
+        self.connected = asyncio.Event()
+
+        # Called with each `Ocp1Notification` received from the device
+        self.notification_handlers: list[Callable[[Ocp1Notification], None]] = []
+        # Called with the new `State` on every transition
+        self.state_handlers: list[Callable[[State], None]] = []
+
+        # Handles here only match responses to commands, the worker renumbers them for the device
+        self._current_handle = 0
+
+    @property
+    def next_handle(self) -> int:
+        # Wraps within uint32, skipping 0
+        self._current_handle = self._current_handle % 0xFFFFFFFF + 1
+        return self._current_handle
+
+    make_command = OCAController.make_command
+
+    async def request(self, command: Ocp1Command, timeout: float = T_RESPONSE_S, retries: int = 0) -> Ocp1Response:
+        return await self.supervisor._call(self, "request", command, timeout, retries, timeout=timeout * (retries + 1))
+
+    async def request_many(self, commands: list[Ocp1Command], timeout: float = T_RESPONSE_S, retries: int = 0) -> list[Ocp1Response]:
+        return await self.supervisor._call(self, "request_many", commands, timeout, retries, timeout=timeout * (retries + 1))
+
+    async def send_commands(self, commands: list[Union[Ocp1Command, list[Ocp1Command]]]) -> None:
+        await self.supervisor._call(self, "send_commands", commands)
+
+    async def read(self, target_ono: int, method: Method, *arguments: OCCBase) -> Ocp1Response:
+        return await self.supervisor._call(self, "read", target_ono, method, *arguments, timeout=T_RESPONSE_S)
+
+    async def subscribe(self, emitter_ono: int, event_id: OcaEventID = OcaRoot.property_changed_event) -> Ocp1Response:
+        return await self.supervisor._call(self, "subscribe", emitter_ono, event_id, timeout=T_RESPONSE_S)
+
+    def _state_transition(self, new_state: State) -> None:
+        self.state = new_state
+        if new_state is State.CONNECTED:
+            self.connected.set()
+        else:
+            self.connected.clear()
+        for handler in self.state_handlers:
+            handler(new_state)
+
+
+class ControllerSupervisor:
+    """
+    Shard device sessions across worker processes.
+
+    Args:
+        workers:    Number of worker processes, one per CPU if None
+        protocol:   Device protocol, as for `OCAController`
+        cache_path: Discovery cache file shared by the workers, none if None
+        replicas:   Points on the hash ring per worker
+    """
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        protocol: str = "udp",
+        cache_path: Optional[str] = None,
+        replicas: int = RING_REPLICAS,
+    ) -> None:
+        self.workers: int = workers or os.cpu_count() or 1
+        self.protocol: str = protocol
+        self.cache_path: Optional[str] = cache_path
+        self.ring = ShardRing(self.workers, replicas)
+
+        # The registry: every device, its worker and its last reported state
+        self.controllers: dict[str, RemoteController] = {}
+
+        self.socket_path: Optional[str] = None
+        self._directory: Optional[tempfile.TemporaryDirectory] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._processes: list[multiprocessing.Process] = []
+        self._writers: dict[int, asyncio.StreamWriter] = {}
+        self._readers: set[asyncio.Task] = set()
+        self._ready = asyncio.Event()
+        self._pending: dict[int, tuple[int, asyncio.Future]] = {}
+        self._call_ids = itertools.count()
+
+    # == == == == == Registry
+
+    def add_device(self, name: str, endpoint: Endpoint = None) -> RemoteController:
+        """
+        Register a device and start its session on the owning worker
+
+        Args:
+            name:       Service name of the device
+            endpoint:   Static `(host, port)`, skipping discovery
+        """
+        if name in self.controllers:
+            return self.controllers[name]
+        controller = RemoteController(self, name, self.ring.shard_for(name), endpoint)
+        self.controllers[name] = controller
+        if (writer := self._writers.get(controller.shard)) is not None:
+            write_message(writer, ("add", [(name, endpoint)]))
+        return controller
+
+    def controller(self, name: str) -> RemoteController:
+        """
+        Raises:
+            KeyError: if the device was never added
+        """
+        return self.controllers[name]
+
+    def shard_devices(self, shard: int) -> list[str]:
+        return [name for name, controller in self.controllers.items() if controller.shard == shard]
+
+    # == == == == == Commands
+
+    async def fan_out(
+        self,
+        target_ono: int,
+        method: Method,
+        *arguments: OCCBase,
+        names: Optional[Iterable[str]] = None,
+        timeout: float = T_RESPONSE_S,
+    ) -> dict[str, Union[Ocp1Response, Exception]]:
+        """
+        Call the same method on many devices at once, every device if `names` is None
+
+        Returns:
+            dict: Device name to its response, or the exception raised for it
+        """
+        controllers = [self.controllers[name] for name in (self.controllers if names is None else names)]
+        results = await asyncio.gather(
+            *(controller.request(controller.make_command(target_ono, method, *arguments), timeout) for controller in controllers),
+            return_exceptions=True,
+        )
+        return {controller.device_name: result for controller, result in zip(controllers, results)}
+
+    async def _call(self, controller: RemoteController, method: str, *args: Any, timeout: float = 0) -> Any:
+        """
+        Run `method` on the worker of `controller`
+
+        Args:
+            timeout:    Seconds the call itself may take, the worker has `T_CALL_S` more to answer
+
+        Raises:
+            asyncio.TimeoutError: if the worker does not answer in time
+        """
+        if method not in FORWARDED:
+            raise AttributeError(method)
+        writer = self._writers.get(controller.shard)
+        if writer is None or writer.is_closing():
+            raise ConnectionError(f"Worker {controller.shard} for {controller.device_name} is not running")
+        call_id = next(self._call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[call_id] = (controller.shard, future)
+        try:
+            write_message(writer, ("call", call_id, controller.device_name, method, args, {}))
+            return await asyncio.wait_for(future, timeout + T_CALL_S)
+        finally:
+            self._pending.pop(call_id, None)
+
+    # == == == == == Workers
+
+    async def _accept(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            _, shard, pid = await read_message(reader)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        logging.debug("Worker %d started as pid %d", shard, pid)
+        self._writers[shard] = writer
+        if devices := self.shard_devices(shard):
+            write_message(writer, ("add", [(name, self.controllers[name].device_endpoint) for name in devices]))
+        if len(self._writers) == self.workers:
+            self._ready.set()
+        try:
+            while True:
+                try:
+                    message = await read_message(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    raise
+                except Exception as exc:
+                    # The whole frame was read, so the next one can still be
+                    logging.warning("Unreadable message from worker %d: %r", shard, exc)
+                    continue
+                self._handle(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        self._worker_lost(shard)
+
+    def _handle(self, message: tuple) -> None:
+        kind = message[0]
+        if kind == "result" or kind == "error":
+            _, future = self._pending.get(message[1], (None, None))
+            if future is None or future.done():
+                return
+            if kind == "result":
+                future.set_result(message[2])
+            else:
+                future.set_exception(message[2])
+        elif kind == "state":
+            if (controller := self.controllers.get(message[1])) is not None:
+                controller._state_transition(State(message[2]))
+        elif kind == "notification":
+            if (controller := self.controllers.get(message[1])) is not None and controller.notification_handlers:
+                notification = Ocp1Notification.from_bytes(message[2])
+                for handler in controller.notification_handlers:
+                    handler(notification)
+
+    def _worker_lost(self, shard: int) -> None:
+        if self._writers.pop(shard, None) is None:
+            return
+        logging.warning("Lost worker %d", shard)
+        for call_id, (call_shard, future) in list(self._pending.items()):
+            if call_shard == shard and not future.done():
+                future.set_exception(ConnectionError(f"Worker {shard} exited"))
+        for name in self.shard_devices(shard):
+            self.controllers[name]._state_transition(State.DISCONNECTED)
+
+    async def start(self, timeout: float = T_WORKER_START_S) -> None:
+        """
+        Start the workers and wait for all of them to report in. Devices added before this
+        are sent to their worker once it is up.
+        """
+        self._directory = tempfile.TemporaryDirectory(prefix="oca-supervisor-")
+        self.socket_path = os.path.join(self._directory.name, "registry.sock")
+
+        async def accept(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            task = asyncio.current_task()
+            self._readers.add(task)
+            try:
+                await self._accept(reader, writer)
+            finally:
+                self._readers.discard(task)
+
+        self._server = await asyncio.start_unix_server(accept, self.socket_path)
+        # Not fork: the parent has a running event loop
+        context = multiprocessing.get_context("spawn")
+        for shard in range(self.workers):
+            process = context.Process(
+                target=_worker_main,
+                args=(shard, self.socket_path, self.protocol, self.cache_path, logging.root.level),
+                name=f"oca-worker-{shard}",
+                daemon=True,
+            )
+            process.start()
+            self._processes.append(process)
+        await asyncio.wait_for(self._ready.wait(), timeout)
+
+    async def close(self) -> None:
+        for writer in self._writers.values():
+            write_message(writer, ("stop",))
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join, T_WORKER_STOP_S)
+            if process.is_alive():
+                process.terminate()
+        self._processes.clear()
+        for writer in self._writers.values():
+            writer.close()
+        self._writers.clear()
+        for task in self._readers:
+            task.cancel()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if self._directory is not None:
+            self._directory.cleanup()
+            self._directory = None
+
+
+# == == == == =
+
+@click.command()
+@click.argument('targets', nargs=-1, required=True)
+@click.option('--workers', '-j', type=int, default=None, help="Worker processes, one per CPU by default")
+@click.option('--cache/--no-cache', default=True, help="Connect to the last known address while rediscovering")
+@click.option('--verbose', '-v', is_flag=True, help="Log every packet")
+def supervise(targets: tuple[str, ...], workers: Optional[int], cache: bool, verbose: bool):
+    """ Hold sessions with many devices, sharded across worker processes """
+    logging.basicConfig(
+        format="[%(asctime)s][%(levelname)s]: \t%(message)s", level=logging.DEBUG if verbose else logging.INFO
+    )
+    asyncio.run(_supervise(targets, workers, cache))
+
+
+async def _supervise(targets: Iterable[str], workers: Optional[int], cache: bool) -> None:
+    supervisor = ControllerSupervisor(workers, cache_path=DEFAULT_CACHE_PATH if cache else None)
+    for target in targets:
+        supervisor.add_device(target)
+    await supervisor.start()
+    try:
+        await asyncio.sleep(T_DISCOVERY_S + T_KEEPALIVE_S)
+        for shard in range(supervisor.workers):
+            for name in supervisor.shard_devices(shard):
+                click.echo(f"{shard}\t{name}\t{supervisor.controller(name).state.name}")
+        await asyncio.Event().wait()
+    finally:
+        await supervisor.close()
@@ -0,0 +1,363 @@
+"""
+Firmware upload
+---------------
+
+Upload firmware images to devices through their `OcaFirmwareManager`. An image file is
+mapped rather than read, so it is paged in as it is sent and shared by every upload, and is
+cut into `AddImageData` chunks sliced straight from the mapping.
+
+Rather than waiting for each chunk's response before sending the next, up to `window`
+chunks are awaiting a response at once. A chunk that fails or goes unanswered is sent again
+on its own, up to `retries` times, and progress is reported as chunks are acknowledged.
+`upload_many()` updates many devices in parallel.
+
+Chunks are sent by `ChunkPipeline`, which takes any command per chunk, so other bulk
+transfers can reuse it.
+
+Usage:
+    image = open_image("amp-2.4.1.bin")
+    errors = await upload_many(controllers, image, progress=print)
+"""
+
+import asyncio
+import collections
+import logging
+import mmap
+import os
+import struct
+import click
+from typing import Callable, Iterable, NamedTuple, Optional, Union
+
+from ocacomms.OcaDiscovery import OcaDiscovery
+from ocacomms.OcaDiscoveryCache import OcaDiscoveryCache
+from controller_cli.connect import OCAController, start_controllers
+from controller_cli.transmit import TransmitClass
+from ocacore.ocp1 import *
+from ocacore.occ.manager import OcaFirmwareManager
+from ocacore.occ.root import Method
+
+
+FIRMWARE_MANAGER_ONO: int = 0x3
+CHUNK_BYTES: int = 1024  # image bytes per AddImageData command, one command per PDU
+WINDOW: int = 16  # chunks awaiting a response at once
+RETRIES: int = 3  # further attempts for each chunk
+PARALLEL: int = 16  # devices updated at once
+T_CHUNK_S: float = 2.0  # seconds to wait for a chunk's response
+T_STEP_S: float = 10.0  # seconds to wait for the other steps, e.g. while the device verifies
+
+ADD_IMAGE_DATA = struct.Struct("!BIH")  # parameter count, chunk ID, image data length
+EMPTY_PARAMETERS = Ocp1Parameters(parameters=None)
+
+
+class TransferError(Exception):
+    """
+    A step of a transfer failed
+
+    Args:
+        step:   What was being done, e.g. `"Chunk 12"`
+        status: The device's status, or None if it did not answer
+    """
+    def __init__(self, step: str, status: Optional[OcaStatus] = None) -> None:
+        super().__init__(f"{step}: {status.name if status is not None else 'no response'}")
+        self.step: str = step
+        self.status: Optional[OcaStatus] = status
+
+
+class Progress(NamedTuple):
+    device: str
+    done: int  # bytes acknowledged
+    total: int  # bytes
+    retries: int  # chunks sent again so far
+
+
+def open_image(source: Union[str, bytes, bytearray, memoryview]) -> memoryview:
+    """
+    A firmware image as a memoryview. A path is mapped read-only, not read.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return memoryview(source)
+    with open(source, "rb") as file:
+        if not os.fstat(file.fileno()).st_size:
+            return memoryview(b"")
+        # The mapping stays valid after the file is closed
+        return memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class ChunkPipeline:
+    """
+    Send one command per chunk, with at most `window` awaiting a response
+
+    Args:
+        controller: Connected controller for the device
+        window:     Most chunks awaiting a response at once
+        retries:    Further attempts for a chunk that fails or goes unanswered
+        timeout:    Seconds to wait for each chunk's response
+    """
+    def __init__(
+        self,
+        controller: OCAController,
+        window: int = WINDOW,
+        retries: int = RETRIES,
+        timeout: float = T_CHUNK_S,
+    ) -> None:
+        if window < 1 or retries < 0:
+            raise ValueError("Window must be at least 1 and retries at least 0")
+        self.controller: OCAController = controller
+        self.window: int = window
+        self.retries: int = retries
+        self.timeout: float = timeout
+        self.retried: int = 0  # chunks sent again
+
+    async def run(
+        self,
+        count: int,
+        make_command: Callable[[int], Ocp1Command],
+        acknowledged: Callable[[int, Ocp1Response], None],
+    ) -> None:
+        """
+        Send chunks `0` to `count - 1`, in order but answered in any order. `make_command(index)`
+        builds a chunk's command, again for each retry. `acknowledged(index, response)` is
+        called as each chunk succeeds.
+
+        Raises:
+            TransferError: if a chunk still fails after `retries` further attempts
+            ConnectionError: if the session is lost
+        """
+        loop = asyncio.get_running_loop()
+        # Each future maps to (chunk index, attempt, command, deadline), in the order sent
+        waiting: dict[asyncio.Future, tuple[int, int, Ocp1Command, float]] = {}
+        resend: collections.deque[tuple[int, int]] = collections.deque()
+        next_index = 0
+        try:
+            while next_index < count or resend or waiting:
+                batch = []
+                while len(waiting) + len(batch) < self.window and (resend or next_index < count):
+                    if resend:
+                        index, attempt = resend.popleft()
+                    else:
+                        index, attempt = next_index, 0
+                        next_index += 1
+                    batch.append((index, attempt, make_command(index)))
+                if batch:
+                    futures = await self.controller.submit([command for *_, command in batch], TransmitClass.BULK)
+                    deadline = loop.time() + self.timeout
+                    for (index, attempt, command), future in zip(batch, futures):
+                        waiting[future] = (index, attempt, command, deadline)
+
+                # Deadlines only grow, so the oldest chunk's comes first
+                first_deadline = next(iter(waiting.values()))[3]
+                finished, _ = await asyncio.wait(
+                    set(waiting), timeout=max(first_deadline - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED
+                )
+                now = loop.time()
+                for future, (index, attempt, command, deadline) in list(waiting.items()):
+                    if future in finished:
+                        del waiting[future]
+                        response = future.result()
+                        if response.status_code == OcaStatus.OK:
+                            acknowledged(index, response)
+                            continue
+                        status = response.status_code
+                    elif deadline <= now:
+                        del waiting[future]
+                        self.controller.forget([command])
+                        status = None
+                    else:
+                        continue
+                    if attempt == self.retries:
+                        raise TransferError(f"Chunk {index}", status)
+                    self.retried += 1
+                    resend.append((index, attempt + 1))
+        finally:
+            self.controller.forget([command for _, _, command, _ in waiting.values()])
+
+
+class FirmwareUpload:
+    """
+    Replace the active firmware image of one device
+
+    Args:
+        controller:         Connected controller for the device
+        component:          The `OcaComponent` to update
+        chunk_size:         Image bytes per `AddImageData` command
+        window:             Most chunks awaiting a response at once
+        retries:            Further attempts for a chunk that fails or goes unanswered
+        timeout:            Seconds to wait for each chunk's response
+        progress:           Called with a `Progress` as chunks are acknowledged
+        firmware_manager:   ONo of the device's firmware manager
+    """
+    def __init__(
+        self,
+        controller: OCAController,
+        component: int = 1,
+        chunk_size: int = CHUNK_BYTES,
+        window: int = WINDOW,
+        retries: int = RETRIES,
+        timeout: float = T_CHUNK_S,
+        progress: Optional[Callable[[Progress], None]] = None,
+        firmware_manager: int = FIRMWARE_MANAGER_ONO,
+    ) -> None:
+        if not 1 <= chunk_size <= 0xFFFF:
+            raise ValueError("Chunk size must be 1 to 65535 bytes")
+        self.controller: OCAController = controller
+        self.component: int = component
+        self.chunk_size: int = chunk_size
+        self.pipeline: ChunkPipeline = ChunkPipeline(controller, window, retries, timeout)
+        self.progress: Optional[Callable[[Progress], None]] = progress
+        self.firmware_manager: int = firmware_manager
+
+    def chunk_command(self, image: memoryview, index: int) -> Ocp1Command:
+        start = index * self.chunk_size
+        chunk = image[start:start + self.chunk_size]
+        return Ocp1Command.construct(
+            handle=self.controller.next_handle,
+            target_ono=self.firmware_manager,
+            method_id=OcaFirmwareManager.add_image_data.method_id,
+            parameters=EMPTY_PARAMETERS,
+            # Chunk IDs are sequence numbers from 1
+            parameter_data=ADD_IMAGE_DATA.pack(2, index + 1, len(chunk)) + chunk,
+        )
+
+    async def _step(self, name: str, method: Method, *arguments: OCCBase) -> None:
+        """
+        Raises:
+            TransferError: if the device does not answer OK
+        """
+        try:
+            response = await self.controller.request(
+                self.controller.make_command(self.firmware_manager, method, *arguments),
+                timeout=T_STEP_S,
+                retries=self.pipeline.retries,
+            )
+        except asyncio.TimeoutError:
+            raise TransferError(name)
+        if response.status_code != OcaStatus.OK:
+            raise TransferError(name, response.status_code)
+
+    async def run(self, image: memoryview, verify_data: bytes = b"") -> None:
+        """
+        Upload `image` and make it active
+
+        Args:
+            image:          The image, e.g. from `open_image()`
+            verify_data:    Passed to `VerifyImage`, e.g. a checksum or signature
+
+        Raises:
+            TransferError: if a step fails
+            ConnectionError: if the session is lost
+        """
+        total = len(image)
+        count = -(-total // self.chunk_size)
+        done = 0
+        device = self.controller.device_name
+
+        def acknowledged(index: int, response: Ocp1Response) -> None:
+            nonlocal done
+            done += min(self.chunk_size, total - index * self.chunk_size)
+            if self.progress is not None:
+                self.progress(Progress(device, done, total, self.pipeline.retried))
+
+        await self._step("StartUpdateProcess", OcaFirmwareManager.start_update_process)
+        await self._step("BeginActiveImageUpdate", OcaFirmwareManager.begin_active_image_update, OcaUint16(self.component))
+        await self.pipeline.run(count, lambda index: self.chunk_command(image, index), acknowledged)
+        await self._step("VerifyImage", OcaFirmwareManager.verify_image, OcaBlob(data=verify_data))
+        await self._step("EndActiveImageUpdate", OcaFirmwareManager.end_active_image_update)
+        await self._step("EndUpdateProcess", OcaFirmwareManager.end_update_process)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("%s: uploaded %s bytes, %s chunks sent again", device, total, self.pipeline.retried)
+
+
+async def upload_many(
+    controllers: Iterable[OCAController],
+    image: memoryview,
+    verify_data: bytes = b"",
+    parallel: int = PARALLEL,
+    **options,
+) -> dict[str, Optional[Exception]]:
+    """
+    Upload `image` to every device, `parallel` at a time. `options` are passed to `FirmwareUpload`.
+
+    Returns:
+        dict: The error for each device by name, None where the upload succeeded
+    """
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def upload(controller: OCAController) -> Optional[Exception]:
+        async with semaphore:
+            if not controller.connected.is_set():
+                return ConnectionError(f"{controller.device_name} is not connected")
+            try:
+                await FirmwareUpload(controller, **options).run(image, verify_data)
+            except (TransferError, ConnectionError) as exc:
+                logging.warning("%s: %s", controller.device_name, exc)
+                return exc
+            return None
+
+    controllers = list(controllers)
+    errors = await asyncio.gather(*(upload(controller) for controller in controllers))
+    return {controller.device_name: error for controller, error in zip(controllers, errors)}
+
+
+# == == == == =
+
+@click.command()
+@click.argument('image', type=click.Path(exists=True, dir_okay=False))
+@click.argument('targets', nargs=-1, required=True)
+@click.option('--component', type=int, default=1, show_default=True, help="OcaComponent to update")
+@click.option('--verify-file', type=click.File("rb"), default=None, help="Data passed to VerifyImage, e.g. a signature")
+@click.option('--chunk-size', type=int, default=CHUNK_BYTES, show_default=True, help="Image bytes per AddImageData command")
+@click.option('--window', type=int, default=WINDOW, show_default=True, help="Most chunks awaiting a response at once")
+@click.option('--retries', type=int, default=RETRIES, show_default=True, help="Further attempts for each chunk")
+@click.option('--parallel', type=int, default=PARALLEL, show_default=True, help="Devices updated at once")
+@click.option('--cache/--no-cache', default=True, help="Connect to the last known address while rediscovering")
+@click.option('--verbose', '-v', is_flag=True, help="Log every packet")
+def upload(
+    image: str,
+    targets: tuple[str, ...],
+    component: int,
+    verify_file,
+    chunk_size: int,
+    window: int,
+    retries: int,
+    parallel: int,
+    cache: bool,
+    verbose: bool,
+):
+    """
+    Upload the firmware IMAGE to every TARGET and make it active
+    """
+    logging.basicConfig(
+        format="[%(asctime)s][%(levelname)s]: \t%(message)s", level=logging.DEBUG if verbose else logging.WARNING
+    )
+    verify_data = verify_file.read() if verify_file is not None else b""
+    options = dict(component=component, chunk_size=chunk_size, window=window, retries=retries)
+    if not asyncio.run(_upload(image, targets, verify_data, parallel, cache, options)):
+        raise SystemExit(1)
+
+
+async def _upload(image: str, targets: tuple[str, ...], verify_data: bytes, parallel: int, cache: bool, options: dict) -> bool:
+    discovery_cache = OcaDiscoveryCache() if cache else None
+    controllers = [OCAController(target, "udp", discovery_cache=discovery_cache) for target in targets]
+    browsers: dict[str, OcaDiscovery] = {}
+    sessions = await start_controllers(controllers, browsers=browsers)
+    reported: dict[str, int] = {}
+
+    def progress(update: Progress) -> None:
+        # Every tenth of the image
+        step = 10 * update.done // max(update.total, 1)
+        if reported.get(update.device) != step:
+            reported[update.device] = step
+            click.echo(f"{update.device}\t{update.done}/{update.total}\t{update.retries} retried", err=True)
+
+    try:
+        errors = await upload_many(controllers, open_image(image), verify_data, parallel, progress=progress, **options)
+    finally:
+        for controller in controllers:
+            await controller.close()
+        for session in sessions:
+            session.cancel()
+        for browser in browsers.values():
+            await browser.close()
+    for device, error in errors.items():
+        click.echo(f"{device}\tOK" if error is None else f"{device}\tFAILED\t{error}")
+    return not any(errors.values())
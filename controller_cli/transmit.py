@@ -0,0 +1,128 @@
+"""
+Transmit scheduling
+-------------------
+
+PDUs waiting to be sent to a device, by class. Keepalives always go first, so that a session
+survives a long enumeration. The other classes share the link by deficit round robin: in
+each round a class may send as many PDUs as its weight. A PDU that has waited longer than
+`max_wait` is sent next whatever its class, so that no class is starved.
+"""
+
+import asyncio
+import collections
+import enum
+import time
+from typing import Any, Callable, Optional
+
+
+T_MAX_WAIT_S: float = 0.5  # seconds before a waiting PDU is sent ahead of its turn
+
+
+class TransmitClass(enum.IntEnum):
+    KEEPALIVE = 0  # Always sent first
+    INTERACTIVE = 1  # Setters and other commands from a user
+    NOTIFICATION = 2  # Subscription management for notifications
+    BULK = 3  # Reads, e.g. enumeration and snapshots
+
+
+WEIGHTS: dict[TransmitClass, int] = {
+    TransmitClass.INTERACTIVE: 8,
+    TransmitClass.NOTIFICATION: 4,
+    TransmitClass.BULK: 1,
+}
+
+
+class TransmitQueue:
+    """
+    A priority queue with the `asyncio.Queue` methods the transmit task uses, for one consumer.
+
+    Args:
+        weights:    PDUs per round for each class other than `KEEPALIVE`
+        max_wait:   Seconds after which a waiting PDU is sent ahead of its turn
+        clock:      Time source, for tests
+    """
+    def __init__(
+        self,
+        weights: Optional[dict[TransmitClass, int]] = None,
+        max_wait: float = T_MAX_WAIT_S,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.weights: dict[TransmitClass, int] = dict(weights or WEIGHTS)
+        if any(weight < 1 for weight in self.weights.values()):
+            raise ValueError("Weights must be at least 1")
+        self.max_wait: float = max_wait
+        self.clock: Callable[[], float] = clock
+        # Each class holds (queued at, item) in arrival order
+        self.queues: dict[TransmitClass, collections.deque] = {cls: collections.deque() for cls in TransmitClass}
+        self._rotation: list[TransmitClass] = [cls for cls in TransmitClass if cls is not TransmitClass.KEEPALIVE]
+        self._turn: int = 0
+        self._credit: dict[TransmitClass, int] = {cls: 0 for cls in self._rotation}
+        self._credit[self._rotation[0]] = self.weights[self._rotation[0]]
+        self._size: int = 0
+        self._ready = asyncio.Event()
+
+        self.promoted: int = 0  # PDUs sent ahead of their turn after waiting `max_wait`
+
+    def qsize(self, cls: Optional[TransmitClass] = None) -> int:
+        return self._size if cls is None else len(self.queues[cls])
+
+    def empty(self) -> bool:
+        return self._size == 0
+
+    def put_nowait(self, item: Any, cls: TransmitClass = TransmitClass.INTERACTIVE) -> None:
+        self.queues[cls].append((self.clock(), item))
+        self._size += 1
+        self._ready.set()
+
+    async def put(self, item: Any, cls: TransmitClass = TransmitClass.INTERACTIVE) -> None:
+        self.put_nowait(item, cls)
+
+    async def get(self) -> Any:
+        while not self._size:
+            self._ready.clear()
+            await self._ready.wait()
+        return self.get_nowait()
+
+    def get_nowait(self) -> Any:
+        """
+        Raises:
+            asyncio.QueueEmpty: if nothing is waiting
+        """
+        if not self._size:
+            raise asyncio.QueueEmpty()
+        self._size -= 1
+        if self.queues[TransmitClass.KEEPALIVE]:
+            return self.queues[TransmitClass.KEEPALIVE].popleft()[1]
+
+        # Starvation protection, the longest waiting PDU past `max_wait` goes first
+        deadline = self.clock() - self.max_wait
+        overdue = None
+        for cls in self._rotation:
+            queue = self.queues[cls]
+            if queue and queue[0][0] < deadline and (overdue is None or queue[0][0] < self.queues[overdue][0][0]):
+                overdue = cls
+        if overdue is not None:
+            self.promoted += 1
+            return self.queues[overdue].popleft()[1]
+
+        # Deficit round robin. Something is waiting, so this ends within one round.
+        while True:
+            cls = self._rotation[self._turn]
+            if self.queues[cls] and self._credit[cls] > 0:
+                self._credit[cls] -= 1
+                return self.queues[cls].popleft()[1]
+            if not self.queues[cls]:
+                # Credit is not saved up while idle
+                self._credit[cls] = 0
+            self._turn = (self._turn + 1) % len(self._rotation)
+            following = self._rotation[self._turn]
+            self._credit[following] = self.weights[following]
+
+    def items(self) -> list[Any]:
+        """ Everything still waiting, by class then arrival """
+        return [item for queue in self.queues.values() for _, item in queue]
+
+    def clear(self) -> None:
+        for queue in self.queues.values():
+            queue.clear()
+        self._size = 0
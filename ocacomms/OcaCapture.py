@@ -0,0 +1,290 @@
+"""
+Record and read raw OCP.1 traffic
+
+A capture file is an 8 byte magic followed by records, appended as traffic is seen:
+
+    !dBHI   timestamp (UNIX seconds), kind, stream, length
+    data    `length` bytes
+
+`kind` is one of `RecordKind`. Each stream (usually one device session) is declared once
+with a `STREAM` record whose data is the UTF-8 stream name, so traffic records only carry
+a 2 byte stream number.
+
+Classic libpcap files of OCP.1 over UDP can be read too, see `PcapReader` and `open_capture()`.
+"""
+
+import enum
+import struct
+import time
+from typing import BinaryIO, Iterator, NamedTuple, Optional, Union
+
+
+CAPTURE_MAGIC: bytes = b"OCAPCAP1"
+RECORD_HEADER = struct.Struct("!dBHI")
+
+
+class RecordKind(enum.IntEnum):
+    RECEIVED = 0  # Datagram or stream chunk from the device
+    SENT = 1  # Datagram or stream chunk to the device
+    STREAM = 2  # Declares a stream name
+
+
+class CaptureRecord(NamedTuple):
+    timestamp: float
+    kind: RecordKind
+    stream: int
+    data: bytes
+
+
+class CaptureWriter:
+    """
+    Append-only capture file writer, shared by any number of sessions.
+
+    Usage:
+        with CaptureWriter("traffic.ocap") as capture:
+            stream = capture.add_stream("amp-1")
+            capture.write(RecordKind.SENT, stream, data)
+    """
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self._file: BinaryIO = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(CAPTURE_MAGIC)
+        self.streams: dict[str, int] = {}
+
+    def add_stream(self, name: str) -> int:
+        """
+        Declare a stream, returning the stream number to record its traffic with
+        """
+        if (stream := self.streams.get(name)) is None:
+            stream = self.streams[name] = len(self.streams)
+            self.write(RecordKind.STREAM, stream, name.encode("UTF-8"))
+        return stream
+
+    def write(self, kind: RecordKind, stream: int, data: bytes) -> None:
+        self._file.write(RECORD_HEADER.pack(time.time(), kind, stream, len(data)) + data)
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> "CaptureWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class CaptureReader:
+    """
+    Stream the traffic records of a capture file one at a time, so captures of any size can be
+    read in bounded memory. Stream declarations are collected in `streams` as they are read.
+
+    Args:
+        path:       Capture file
+        start:      Offset of the first record to read, from `chunks()`
+        end:        Offset to stop at, the end of the file by default
+        streams:    Stream names declared before `start`, from `chunks()`
+    """
+    def __init__(
+        self,
+        path: str,
+        start: int = 0,
+        end: Optional[int] = None,
+        streams: Optional[dict[int, str]] = None
+    ) -> None:
+        self.path: str = path
+        self.start: int = start
+        self.end: Optional[int] = end
+        self.streams: dict[int, str] = dict(streams or {})
+
+    def _records(self, file: BinaryIO) -> Iterator[tuple[int, float, int, int, int]]:
+        """
+        Yield `(offset, timestamp, kind, stream, length)`, leaving the file positioned at the record data
+        """
+        if file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f"{self.path} is not an OCP.1 capture")
+        file.seek(max(self.start, len(CAPTURE_MAGIC)))
+        while self.end is None or file.tell() < self.end:
+            offset = file.tell()
+            if len(header := file.read(RECORD_HEADER.size)) < RECORD_HEADER.size:
+                return
+            yield (offset, *RECORD_HEADER.unpack(header))
+
+    def __iter__(self) -> Iterator[CaptureRecord]:
+        with open(self.path, "rb") as file:
+            for _, timestamp, kind, stream, length in self._records(file):
+                data = file.read(length)
+                if len(data) < length:
+                    break  # Truncated by an interrupted writer
+                if kind == RecordKind.STREAM:
+                    self.streams[stream] = data.decode("UTF-8")
+                    continue
+                yield CaptureRecord(timestamp, RecordKind(kind), stream, data)
+
+    def chunks(self, chunk_size: int) -> list[tuple[int, Optional[int]]]:
+        """
+        Split the capture at record boundaries into `(start, end)` ranges of about `chunk_size` bytes,
+        reading only record headers. Every stream declaration is collected into `streams`.
+        """
+        chunks = []
+        start = len(CAPTURE_MAGIC)
+        with open(self.path, "rb") as file:
+            for offset, _, kind, stream, length in self._records(file):
+                if offset - start >= chunk_size:
+                    chunks.append((start, offset))
+                    start = offset
+                if kind == RecordKind.STREAM:
+                    self.streams[stream] = file.read(length).decode("UTF-8")
+                else:
+                    file.seek(length, 1)
+        chunks.append((start, None))
+        return chunks
+
+    def stream_name(self, stream: int) -> Optional[str]:
+        return self.streams.get(stream)
+
+
+# == == == == == Packet captures
+
+PCAP_MAGIC: dict[bytes, tuple[str, float]] = {
+    # Magic as written: (byte order, timestamp fraction unit)
+    b"\xd4\xc3\xb2\xa1": ("<", 1e-6),
+    b"\xa1\xb2\xc3\xd4": (">", 1e-6),
+    b"\x4d\x3c\xb2\xa1": ("<", 1e-9),
+    b"\xa1\xb2\x3c\x4d": (">", 1e-9),
+}
+LINKTYPE_ETHERNET: int = 1
+LINKTYPE_RAW: int = 101
+LINKTYPE_LINUX_SLL: int = 113
+OCP1_COMMAND_TYPES: tuple[int, ...] = (0, 1)  # `MessageType.COMMAND`, `MessageType.COMMAND_RESPONSE_REQUIRED`
+
+
+class PcapReader:
+    """
+    Read OCP.1 over UDP/IPv4 from a classic libpcap file (e.g. saved by Wireshark or tcpdump),
+    with the same interface as `CaptureReader`. pcapng is not supported.
+
+    Each device is a stream named `"address:port"`. The device end of a datagram is taken to
+    be the receiver of commands and the sender of everything else; keepalives, which flow both
+    ways, are attributed to whichever end has already been seen as a device, else the lower port.
+    """
+    def __init__(
+        self,
+        path: str,
+        start: int = 0,
+        end: Optional[int] = None,
+        streams: Optional[dict[int, str]] = None
+    ) -> None:
+        self.path: str = path
+        self.start: int = start
+        self.end: Optional[int] = end
+        self.streams: dict[int, str] = dict(streams or {})
+        self._stream_of: dict[str, int] = {name: stream for stream, name in self.streams.items()}
+
+    def _records(self, file: BinaryIO) -> Iterator[tuple[int, float, int]]:
+        """
+        Yield `(offset, timestamp, length)`, leaving the file positioned at the packet data
+        """
+        header = file.read(24)
+        if len(header) < 24 or header[:4] not in PCAP_MAGIC:
+            raise ValueError(f"{self.path} is not a pcap file")
+        order, self._unit = PCAP_MAGIC[header[:4]]
+        self._linktype, = struct.unpack(order + "I", header[20:24])
+        record_header = struct.Struct(order + "IIII")
+        file.seek(max(self.start, 24))
+        while self.end is None or file.tell() < self.end:
+            offset = file.tell()
+            if len(header := file.read(record_header.size)) < record_header.size:
+                return
+            seconds, fraction, length, _ = record_header.unpack(header)
+            yield offset, seconds + fraction * self._unit, length
+
+    def _udp_payload(self, frame: bytes) -> Optional[tuple[str, str, bytes]]:
+        if self._linktype == LINKTYPE_ETHERNET:
+            ethertype, offset = struct.unpack("!H", frame[12:14])[0], 14
+            if ethertype == 0x8100:  # 802.1Q VLAN tag
+                ethertype, offset = struct.unpack("!H", frame[16:18])[0], 18
+        elif self._linktype == LINKTYPE_LINUX_SLL:
+            ethertype, offset = struct.unpack("!H", frame[14:16])[0], 16
+        elif self._linktype == LINKTYPE_RAW:
+            ethertype, offset = 0x0800, 0
+        else:
+            raise ValueError(f"Unsupported pcap link type {self._linktype}")
+        if ethertype != 0x0800 or len(frame) < offset + 20:
+            return None
+        ip = frame[offset:]
+        header_length = (ip[0] & 0x0F) * 4
+        fragment, = struct.unpack("!H", ip[6:8])
+        if ip[9] != 17 or fragment & 0x3FFF:  # UDP, unfragmented
+            return None
+        source_port, destination_port, udp_length = struct.unpack("!HHH", ip[header_length:header_length + 6])
+        payload = ip[header_length + 8:header_length + udp_length]
+        source = f"{'.'.join(map(str, ip[12:16]))}:{source_port}"
+        destination = f"{'.'.join(map(str, ip[16:20]))}:{destination_port}"
+        return source, destination, payload
+
+    def _stream(self, name: str) -> int:
+        if (stream := self._stream_of.get(name)) is None:
+            stream = self._stream_of[name] = len(self._stream_of)
+            self.streams[stream] = name
+        return stream
+
+    def __iter__(self) -> Iterator[CaptureRecord]:
+        with open(self.path, "rb") as file:
+            for _, timestamp, length in self._records(file):
+                frame = file.read(length)
+                if len(frame) < length:
+                    break
+                if (udp := self._udp_payload(frame)) is None:
+                    continue
+                source, destination, payload = udp
+                if len(payload) < 10 or payload[0] != 0x3B:
+                    continue  # Not OCP.1
+                if payload[7] in OCP1_COMMAND_TYPES:
+                    kind, device = RecordKind.SENT, destination
+                elif payload[7] != 4 or source in self._stream_of:  # 4: `MessageType.KEEPALIVE`
+                    kind, device = RecordKind.RECEIVED, source
+                elif destination in self._stream_of:
+                    kind, device = RecordKind.SENT, destination
+                elif int(source.rsplit(":", 1)[1]) < int(destination.rsplit(":", 1)[1]):
+                    kind, device = RecordKind.RECEIVED, source
+                else:
+                    kind, device = RecordKind.SENT, destination
+                yield CaptureRecord(timestamp, kind, self._stream(device), payload)
+
+    def chunks(self, chunk_size: int) -> list[tuple[int, Optional[int]]]:
+        """
+        Split the file at packet boundaries into `(start, end)` ranges of about `chunk_size` bytes
+        """
+        chunks = []
+        start = 24
+        with open(self.path, "rb") as file:
+            for offset, _, length in self._records(file):
+                if offset - start >= chunk_size:
+                    chunks.append((start, offset))
+                    start = offset
+                file.seek(length, 1)
+        chunks.append((start, None))
+        return chunks
+
+    def stream_name(self, stream: int) -> Optional[str]:
+        return self.streams.get(stream)
+
+
+def open_capture(
+    path: str,
+    start: int = 0,
+    end: Optional[int] = None,
+    streams: Optional[dict[int, str]] = None
+) -> Union[CaptureReader, PcapReader]:
+    """
+    Open a capture file or a pcap file, chosen by its magic number
+    """
+    with open(path, "rb") as file:
+        magic = file.read(len(CAPTURE_MAGIC))
+    if magic[:4] in PCAP_MAGIC:
+        return PcapReader(path, start, end, streams)
+    return CaptureReader(path, start, end, streams)
@@ -0,0 +1,450 @@
+"""
+Host OCC objects as an AES70 device over OCP.1/UDP, and optionally OCP.1 over WebSocket
+
+Commands are dispatched through a table keyed by `(ONo, def_level, method_index)`, built once
+when an object is added. Every command in a received PDU is handled before replying, and
+the responses go back together in multi-message response PDUs.
+
+Methods are served by an explicit handler when one is given, otherwise `get_<field>` and
+`set_<field>` methods read and write the `<field>` attribute of the object. A handler that
+takes an `addr` argument is also given the address of the calling controller. Setters emit a
+PropertyChanged event when the class defines `<field>_property_id`. Events are batched and
+sent by a `NotificationFanout`.
+
+Usage:
+    server = OcaDeviceServer([OcaGain(object_number=OcaONo(0x1001), ..., gain=OcaDB(0.0))])
+    await server.start("0.0.0.0", 50000)
+    await server.start_websocket("0.0.0.0", 50001)
+"""
+
+import asyncio
+import inspect
+import logging
+import struct
+import time
+from typing import Any, Callable, Iterable, Optional
+
+from ocacore.ocp1 import *
+from ocacore.occ.root import OcaRoot, Method
+from ocacore.occ.manager import OcaSubscriptionManager
+from ocacomms.OcaNotificationFanout import NotificationFanout, T_NOTIFICATION_WINDOW_S
+from ocacomms.OcaWebSocket import OcaWebSocket, accept
+
+
+MAX_PDU_SIZE: int = 1400  # bytes
+SUBSCRIPTION_MANAGER_ONO: int = 0x4
+T_SESSION_CHECK_S: float = 1.0  # seconds between checks for silent controllers
+MISSED_KEEPALIVES: int = 3  # a controller silent for this many heartbeats is dropped
+
+PDU_HEADER = struct.Struct("!BHIBH")
+COMMAND_HEADER = struct.Struct("!IIIHH")
+RESPONSE_HEADER = struct.Struct("!IIB")
+EVENT = struct.Struct("!IHH")
+PROPERTY_ID = struct.Struct("!HH")
+
+Address = tuple[str, int]
+DispatchKey = tuple[int, int, int]  # (ONo, def_level, method_index)
+Decoder = Callable[[bytes, int], tuple[Any, int]]
+Handler = Callable[..., Optional[OCCBase]]
+
+
+class OcaMethodError(Exception):
+    """ Raised by a handler to answer with a specific status """
+    def __init__(self, status: OcaStatus, message: str = "") -> None:
+        super().__init__(message or status.name)
+        self.status: OcaStatus = status
+
+
+# == == == == == Argument decoding
+
+def _decode_string(data: bytes, offset: int) -> tuple[OcaString, int]:
+    value, consumed = OcaString.unpack_from(data, offset)
+    return value, offset + consumed
+
+
+def _decode_blob(data: bytes, offset: int) -> tuple[OcaBlob, int]:
+    value, consumed = OcaBlob.unpack_from(data, offset)
+    return value, offset + consumed
+
+
+def _decode_event(data: bytes, offset: int) -> tuple[OcaEvent, int]:
+    ono, def_level, event_index = EVENT.unpack_from(data, offset)
+    event_id = OcaEventID(def_level=OcaUint16(def_level), event_index=OcaUint16(event_index))
+    return OcaEvent(emitter_ono=OcaONo(ono), event_id=event_id), offset + EVENT.size
+
+
+def _decode_method(data: bytes, offset: int) -> tuple[OcaMethod, int]:
+    ono, def_level, method_index = EVENT.unpack_from(data, offset)
+    method_id = OcaMethodID(def_level=def_level, method_index=method_index)
+    return OcaMethod(ono=OcaONo(ono), method_id=method_id), offset + EVENT.size
+
+
+DECODERS: dict[type, Decoder] = {
+    OcaString: _decode_string,
+    OcaBlob: _decode_blob,
+    OcaEvent: _decode_event,
+    OcaMethod: _decode_method,
+}
+
+
+def decoder_for(value_type: type) -> Optional[Decoder]:
+    """
+    Build a decoder returning `(value, next offset)` for an argument type, None if unsupported
+    """
+    if (decoder := DECODERS.get(value_type)) is not None:
+        return decoder
+    if issubclass(value_type, OcaValueBase) and isinstance(value_type.__dict__.get("_format"), str):
+        fixed = struct.Struct("!" + value_type._format)
+        def decode_fixed(data: bytes, offset: int) -> tuple[Any, int]:
+            return value_type(fixed.unpack_from(data, offset)[0]), offset + fixed.size
+        return decode_fixed
+    return None
+
+
+# == == == == == Dispatch
+
+class Dispatch:
+    """ One entry of the dispatch table """
+    __slots__ = ("handler", "decoders", "with_addr")
+
+    def __init__(self, handler: Optional[Handler], decoders: Optional[list[Decoder]]) -> None:
+        self.handler: Optional[Handler] = handler
+        self.decoders: Optional[list[Decoder]] = decoders  # None if an argument type cannot be decoded
+        # Handlers taking an `addr` argument are also given the controller's address
+        self.with_addr: bool = handler is not None and "addr" in inspect.signature(handler).parameters
+
+
+def class_methods(cls: type) -> dict[str, Method]:
+    """ Every `Method` declared on `cls` and its bases, by attribute name """
+    return {name: attr for name in dir(cls) if isinstance(attr := getattr(cls, name, None), Method)}
+
+
+class _ServerProtocol(asyncio.DatagramProtocol):
+    def __init__(self, server: "OcaDeviceServer") -> None:
+        self.server = server
+
+    def connection_made(self, transport: asyncio.DatagramTransport) -> None:
+        self.server.transport = transport
+
+    def datagram_received(self, data: bytes, addr: Address) -> None:
+        try:
+            self.server.handle_datagram(data, addr)
+        except Exception as exc:
+            logging.warning("Could not handle datagram from %s: %s", addr, exc)
+
+    def error_received(self, exc: Exception) -> None:
+        logging.warning("Device server error: %s", exc)
+
+
+class OcaDeviceServer:
+    """
+    Args:
+        objects:                Objects to host, keyed by their `object_number`
+        notification_window:    Seconds notifications are held to be batched, see `NotificationFanout`
+    """
+    def __init__(self, objects: Iterable[OcaRoot] = (), notification_window: float = T_NOTIFICATION_WINDOW_S) -> None:
+        self.objects: dict[int, OcaRoot] = {}
+        self.dispatch: dict[DispatchKey, Dispatch] = {}
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        # Controllers connected over WebSocket, by address. Everyone else is over UDP.
+        self.websockets: dict[Address, OcaWebSocket] = {}
+        self._websocket_server: Optional[asyncio.AbstractServer] = None
+        self._reaper: Optional[asyncio.Task] = None
+
+        # Controller address -> (last heard from, heartbeat seconds)
+        self.sessions: dict[Address, tuple[float, float]] = {}
+        self._keepalives: dict[int, bytes] = {}
+        self.notifications = NotificationFanout(self._send, notification_window)
+
+        self._add_subscription_manager()
+        for obj in objects:
+            self.add_object(obj)
+
+
+    # == == == == == Object tree
+
+    def add_object(self, obj: OcaRoot, handlers: Optional[dict[str, Handler]] = None) -> None:
+        """
+        Host `obj` and add its methods to the dispatch table.
+
+        Args:
+            obj:        The object, addressed by its `object_number`
+            handlers:   Handlers by method name, e.g. `"set_gain"`, called with the decoded arguments
+                        instead of the default getter or setter. A handler returns the response
+                        value, or None.
+        """
+        ono = int(obj.object_number)
+        handlers = handlers or {}
+        self.objects[ono] = obj
+        for name, method in class_methods(type(obj)).items():
+            handler = handlers.get(name) or self._default_handler(obj, name)
+            arg_types = list((method.kwargs or {}).values())
+            decoders = [decoder_for(arg_type) for arg_type in arg_types]
+            self.dispatch[(ono, int(method.method_id.def_level), int(method.method_id.method_index))] = Dispatch(
+                handler, None if None in decoders else decoders
+            )
+
+    def remove_object(self, ono: int) -> None:
+        self.objects.pop(ono, None)
+        for key in [key for key in self.dispatch if key[0] == ono]:
+            del self.dispatch[key]
+
+    def _default_handler(self, obj: OcaRoot, name: str) -> Optional[Handler]:
+        verb, _, field = name.partition("_")
+        if field not in obj.__fields__:
+            return None
+        if verb == "get":
+            return lambda: getattr(obj, field)
+        if verb == "set":
+            return lambda value: self.set_property(int(obj.object_number), field, value)
+        return None
+
+    def _add_subscription_manager(self) -> None:
+        manager = OcaSubscriptionManager(
+            object_number=OcaONo(SUBSCRIPTION_MANAGER_ONO),
+            lockable=OcaBoolean(False),
+            role=OcaString("SubscriptionManager"),
+        )
+        self.add_object(manager, {
+            "add_subscription": self._add_subscription,
+            "remove_subscription": self._remove_subscription,
+        })
+
+
+    # == == == == == Properties & events
+
+    def set_property(self, ono: int, field: str, value: OCCBase) -> None:
+        """
+        Change a property of a hosted object, notifying subscribers if it has a property ID
+        """
+        obj = self.objects[ono]
+        setattr(obj, field, value)
+        if (property_id := getattr(type(obj), f"{field}_property_id", None)) is not None:
+            self.property_changed(ono, property_id, value)
+
+    def property_changed(
+        self,
+        ono: int,
+        property_id: OcaPropertyID,
+        value: OCCBase,
+        change_type: OcaPropertyChangeType = OcaPropertyChangeType.CurrentChanged
+    ) -> None:
+        event_id = OcaRoot.property_changed_event
+        key = (ono, int(event_id.def_level), int(event_id.event_index))
+        if not self.notifications.has_subscribers(key):
+            return
+        property_key = (int(property_id.def_level), int(property_id.property_index))
+        event_data = PROPERTY_ID.pack(*property_key) + value.bytes + bytes([change_type.value])
+        # Only a newer current value makes a waiting one obsolete, item and limit changes are all delivered
+        supersede = property_key if change_type is OcaPropertyChangeType.CurrentChanged else None
+        self.notifications.publish(key, event_data, supersede)
+
+    def emit(self, event: DispatchKey, event_data: bytes) -> None:
+        """
+        Send an event to each of its subscribers
+        """
+        self.notifications.publish(event, event_data)
+
+    @property
+    def subscriptions(self) -> dict[DispatchKey, dict[tuple[Address, int, int, int], bytes]]:
+        return self.notifications.subscriptions
+
+    def _add_subscription(
+        self,
+        event: OcaEvent,
+        subscriber: OcaMethod,
+        subscriber_context: OcaBlob,
+        notification_delivery_mode: OcaUint8,
+        destination_information: OcaBlob,
+        addr: Address
+    ) -> None:
+        key = (int(event.emitter_ono), int(event.event_id.def_level), int(event.event_id.event_index))
+        subscriber_key = (addr, int(subscriber.ono), int(subscriber.method_id.def_level), int(subscriber.method_id.method_index))
+        self.notifications.subscribe(key, subscriber_key, bytes(subscriber_context.data))
+
+    def _remove_subscription(self, event: OcaEvent, subscriber: OcaMethod, addr: Address) -> None:
+        key = (int(event.emitter_ono), int(event.event_id.def_level), int(event.event_id.event_index))
+        subscriber_key = (addr, int(subscriber.ono), int(subscriber.method_id.def_level), int(subscriber.method_id.method_index))
+        self.notifications.unsubscribe(key, subscriber_key)
+
+    def drop_session(self, addr: Address) -> None:
+        """ Forget a controller and its subscriptions """
+        self.sessions.pop(addr, None)
+        self.notifications.drop(addr)
+
+
+    # == == == == == Protocol
+
+    def handle_datagram(self, data: bytes, addr: Address) -> None:
+        """
+        Handle every PDU in a datagram from `addr`
+        """
+        now = time.monotonic()
+        _, heartbeat = self.sessions.get(addr, (now, 0))
+        offset = 0
+        while len(data) - offset >= PDU_HEADER.size:
+            sync, _, message_size, message_type, message_count = PDU_HEADER.unpack_from(data, offset)
+            if sync != SYNC_VAL:
+                logging.warning("Bad sync from %s", addr)
+                return
+            body = offset + PDU_HEADER.size
+            end = offset + 1 + message_size
+            if message_type == MessageType.KEEPALIVE.value:
+                heartbeat, = struct.unpack_from("!H", data, body)
+                self._sendto(self._keepalive_pdu(heartbeat), addr)
+            elif message_type in (MessageType.COMMAND.value, MessageType.COMMAND_RESPONSE_REQUIRED.value):
+                self._commands_received(data, body, message_count, addr, message_type == MessageType.COMMAND_RESPONSE_REQUIRED.value)
+            offset = end
+        self.sessions[addr] = (now, heartbeat)
+
+    def _commands_received(self, data: bytes, offset: int, count: int, addr: Address, response_required: bool) -> None:
+        """
+        Handle the commands of one PDU and reply. Subclasses that cannot answer straight
+        away, such as `controller_cli.proxy.OcaProxy`, reply later instead.
+        """
+        responses = self._handle_commands(data, offset, count, addr)
+        if response_required:
+            self._send(addr, MessageType.RESPONSE, responses)
+
+    def _handle_commands(self, data: bytes, offset: int, count: int, addr: Address) -> list[bytes]:
+        responses = []
+        for _ in range(count):
+            command_size, handle, ono, def_level, method_index = COMMAND_HEADER.unpack_from(data, offset)
+            status, result = self._call(data, offset + COMMAND_HEADER.size, offset + command_size, (ono, def_level, method_index), addr)
+            parameters = b"\x00" if result is None else b"\x01" + result.bytes
+            responses.append(RESPONSE_HEADER.pack(RESPONSE_HEADER.size + len(parameters), handle, status.value) + parameters)
+            offset += command_size
+        return responses
+
+    def _call(self, data: bytes, offset: int, end: int, key: DispatchKey, addr: Address) -> tuple[OcaStatus, Optional[OCCBase]]:
+        if (entry := self.dispatch.get(key)) is None:
+            # AES70-1: BadMethod for a method the object's class does not define
+            return (OcaStatus.BadONo if key[0] not in self.objects else OcaStatus.BadMethod), None
+        if entry.handler is None or entry.decoders is None:
+            # Defined by the class, but this server cannot run it
+            return OcaStatus.NotImplemented, None
+        try:
+            count = data[offset] if offset < end else 0
+            if count != len(entry.decoders):
+                return OcaStatus.BadFormat, None
+            arguments = []
+            offset += 1
+            for decode in entry.decoders:
+                value, offset = decode(data, offset)
+                arguments.append(value)
+            if offset > end:
+                return OcaStatus.BadFormat, None
+        except (struct.error, ValueError, IndexError):
+            return OcaStatus.BadFormat, None
+        try:
+            if entry.with_addr:
+                return OcaStatus.OK, entry.handler(*arguments, addr=addr)
+            return OcaStatus.OK, entry.handler(*arguments)
+        except OcaMethodError as exc:
+            return exc.status, None
+        except Exception as exc:
+            logging.warning("Handler for %s.%s.%s failed: %s", *key, exc)
+            return OcaStatus.ProcessingFailed, None
+
+    def _send(self, addr: Address, message_type: MessageType, messages: list[bytes]) -> None:
+        """
+        Send `messages` to `addr`, packed into as few PDUs of `message_type` as fit in `MAX_PDU_SIZE`
+        """
+        if not messages:
+            return
+        batch = []
+        size = PDU_HEADER.size
+        for message in messages:
+            if batch and size + len(message) > MAX_PDU_SIZE:
+                self._send_pdu(addr, message_type, batch)
+                batch = []
+                size = PDU_HEADER.size
+            batch.append(message)
+            size += len(message)
+        self._send_pdu(addr, message_type, batch)
+
+    def _send_pdu(self, addr: Address, message_type: MessageType, messages: list[bytes]) -> None:
+        pdu = bytearray(PDU_HEADER_TEMPLATES[message_type])
+        for message in messages:
+            pdu += message
+        patch_header(pdu, 0, len(pdu) - 1, len(messages))
+        self._sendto(pdu, addr)
+
+    def _sendto(self, pdu: bytes, addr: Address) -> None:
+        if (websocket := self.websockets.get(addr)) is not None:
+            # Packed into one message with the other PDUs sent to it in this loop iteration
+            websocket.send(pdu)
+        elif self.transport is not None:
+            self.transport.sendto(pdu, addr)
+
+    def _keepalive_pdu(self, heartbeat: int) -> bytes:
+        """ The echo of a keepalive, encoded once per heartbeat interval """
+        if (pdu := self._keepalives.get(heartbeat)) is None:
+            pdu = self._keepalives[heartbeat] = KEEPALIVE.pack(
+                SYNC_VAL, 1, KEEPALIVE.size - 1, MessageType.KEEPALIVE.value, 1, heartbeat
+            )
+        return pdu
+
+
+    # == == == == == Lifecycle
+
+    async def start(self, host: str = "0.0.0.0", port: int = 50000) -> asyncio.DatagramTransport:
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: _ServerProtocol(self), local_addr=(host, port))
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap())
+        return transport
+
+    async def start_websocket(self, host: str = "0.0.0.0", port: int = 50001) -> asyncio.AbstractServer:
+        """ Also accept controllers over WebSocket """
+        self._websocket_server = await asyncio.start_server(self._serve_websocket, host, port)
+        if self._reaper is None:
+            self._reaper = asyncio.create_task(self._reap())
+        return self._websocket_server
+
+    async def _serve_websocket(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            websocket = await accept(reader, writer)
+        except (ConnectionError, asyncio.TimeoutError) as exc:
+            logging.warning("Rejected WebSocket connection: %s", exc)
+            return
+        addr = websocket.peer
+        self.websockets[addr] = websocket
+        try:
+            while True:
+                message = await websocket.recv()
+                try:
+                    self.handle_datagram(message, addr)
+                except Exception as exc:
+                    logging.warning("Could not handle message from %s: %s", addr, exc)
+        except ConnectionError:
+            pass
+        finally:
+            websocket.close()
+            if self.websockets.get(addr) is websocket:
+                del self.websockets[addr]
+                self.drop_session(addr)
+
+    async def _reap(self) -> None:
+        while True:
+            await asyncio.sleep(T_SESSION_CHECK_S)
+            now = time.monotonic()
+            for addr, (last_seen, heartbeat) in list(self.sessions.items()):
+                if heartbeat and now - last_seen > MISSED_KEEPALIVES * heartbeat:
+                    logging.info("Controller %s:%s went silent, dropping its subscriptions", *addr)
+                    self.drop_session(addr)
+
+    def close(self) -> None:
+        self.notifications.close()
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        if self._websocket_server is not None:
+            self._websocket_server.close()
+            self._websocket_server = None
+        for websocket in self.websockets.values():
+            websocket.close()
+        self.websockets.clear()
@@ -1,62 +1,190 @@
 """
-Discover registered OCA devices 
+Discover registered OCA devices
 """
 
-from zeroconf import ServiceBrowser, Zeroconf, ServiceInfo
-from typing import Union
+from typing import TYPE_CHECKING, Optional, Union
+import asyncio
 import logging
 
+# zeroconf is only imported once discovery is actually used, it is slow to import
+if TYPE_CHECKING:
+    from zeroconf import ServiceInfo, ServiceStateChange, Zeroconf
+    from zeroconf.asyncio import AsyncServiceBrowser, AsyncZeroconf
+
+
+T_RESOLVE_MS: int = 3000  # Timeout for resolving a single service
+
+# mDNS service type for each OCP.1 transport
+SERVICE_TYPES: dict[str, str] = {
+    "udp": "_oca._udp.local.",
+    "tcp": "_oca._tcp.local.",
+    "websocket": "_ocaws._tcp.local.",
+}
+
+
+def normalise_name(name: str, service_type: str) -> str:
+    """
+    Strip the service type from an mDNS instance name, e.g. `"Amp-1._oca._udp.local."` -> `"amp-1"`
+    """
+    if name.endswith(service_type):
+        name = name[:-len(service_type)]
+    return name.rstrip(".").lower()
+
+
 class OcaListener:
     """
-    Callback definitions to handle mDNS events
+    Indexed registry of resolved services, fed by mDNS events.
+    Services are indexed by normalised device name and by address, so lookups are O(1).
     """
-    def __init__(self: object) -> None:
-        self.services: list[ServiceInfo] = []
+    def __init__(self: object, service_type: str) -> None:
+        self.service_type: str = service_type
+        self.services: dict[str, "ServiceInfo"] = {}
+        self.addresses: dict[str, "ServiceInfo"] = {}
+        self._waiters: dict[str, list[asyncio.Future]] = {}
+        self._resolving: set[asyncio.Task] = set()
 
-    def remove_service(self: object, zeroconf: Zeroconf, type: str, name: str) -> None:
-        info = zeroconf.get_service_info(type, name)
-        if info in self.services:
-            self.services[self.services.index(info)].remove()
+    def _log(self: object, action: str, info: "ServiceInfo") -> None:
+        if not logging.root.isEnabledFor(logging.DEBUG):
+            return
+        address = info.parsed_addresses()[0] if info.addresses else ""
         logging.debug(
-            f"{'[Browser] Removed':<20}" + 
-            f"{info.type:<20}{info.parsed_addresses()[0]:<16}{info.port:<7}{name.strip(info.type)}"
+            f"{'[Browser] ' + action:<20}" +
+            f"{info.type:<20}{address:<16}{info.port or '':<7}{normalise_name(info.name, self.service_type)}"
         )
 
-    def add_service(self: object, zeroconf: Zeroconf, type, name: str) -> None:
-        info = zeroconf.get_service_info(type, name)
-        if info not in self.services:
-            self.services.append(info)
-        logging.debug(
-            f"{'[Browser] Added':<20}" + 
-            f"{info.type:<20}{info.parsed_addresses()[0]:<16}{info.port:<7}{name.strip(info.type)}"
-        )
+    def add_service(self: object, info: "ServiceInfo") -> None:
+        name = normalise_name(info.name, self.service_type)
+        if (previous := self.services.get(name)) is not None:
+            self._drop_addresses(previous)
+        self.services[name] = info
+        for address in info.parsed_addresses():
+            self.addresses[address] = info
+        for waiter in self._waiters.pop(name, []):
+            if not waiter.done():
+                waiter.set_result(info)
+        self._log("Added" if previous is None else "Updated", info)
+
+    def remove_service(self: object, name: str) -> None:
+        if (info := self.services.pop(normalise_name(name, self.service_type), None)) is None:
+            return
+        self._drop_addresses(info)
+        self._log("Removed", info)
+
+    def _drop_addresses(self: object, info: "ServiceInfo") -> None:
+        for address in info.parsed_addresses():
+            if self.addresses.get(address) is info:
+                del self.addresses[address]
+
+    def on_service_state_change(
+        self: object,
+        zeroconf: "Zeroconf",
+        service_type: str,
+        name: str,
+        state_change: "ServiceStateChange"
+    ) -> None:
+        """
+        `AsyncServiceBrowser` handler, runs on the event loop. Resolution is started as a
+        task so that many services are resolved concurrently.
+        """
+        from zeroconf import ServiceStateChange
+
+        if state_change is ServiceStateChange.Removed:
+            self.remove_service(name)
+            return
+        task = asyncio.ensure_future(self._resolve(zeroconf, service_type, name))
+        self._resolving.add(task)
+        task.add_done_callback(self._resolving.discard)
+
+    async def _resolve(self: object, zeroconf: "Zeroconf", service_type: str, name: str) -> None:
+        from zeroconf.asyncio import AsyncServiceInfo
+
+        info = AsyncServiceInfo(service_type, name)
+        if not await info.async_request(zeroconf, T_RESOLVE_MS):
+            logging.debug("%-20s%-20s%s", "[Browser] Unresolved", service_type, name)
+            return
+        self.add_service(info)
+
+    async def wait_for(self: object, device_name: str) -> "ServiceInfo":
+        if (info := self.services.get(device_name.lower())) is not None:
+            return info
+        name = device_name.lower()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(name, []).append(waiter)
+        try:
+            return await waiter
+        finally:
+            # Resolved waiters are popped by `add_service()`, drop those timed out or cancelled
+            if (waiters := self._waiters.get(name)) is not None and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[name]
+
+    def cancel(self: object) -> None:
+        for task in self._resolving:
+            task.cancel()
+        for waiters in self._waiters.values():
+            for waiter in waiters:
+                waiter.cancel()
+        self._waiters.clear()
 
-    def update_service(self: object, zeroconf: Zeroconf, type, name: str) -> None:
-        info = zeroconf.get_service_info(type, name)
-        if info in self.services:
-            self.services[self.services.index(info)] = info
-        logging.debug(
-            f"{'[Browser] Updated':<20}" + 
-            f"{info.type:<20}{info.parsed_addresses()[0]:<16}{info.port:<7}{name.strip(info.type)}"
-        )
 
-    
 class OcaDiscovery:
+    """
+    Browse for OCA services of one protocol, e.g. `_oca._udp.local.`, on the running event loop.
+
+    Usage:
+        async with OcaDiscovery("udp") as discovery:
+            service = await discovery.wait_for("amp-1", timeout=5)
+    """
     def __init__(self: object, protocol: str) -> None:
         self.protocol:  str = protocol.lower()
-        assert self.protocol in ["udp", "tcp"]
-        self.listener = OcaListener()
+        assert self.protocol in SERVICE_TYPES
+        self.service_type: str = SERVICE_TYPES[self.protocol]
+        self.listener = OcaListener(self.service_type)
+
+        self.aiozc:     Optional["AsyncZeroconf"] = None
+        self.browser:   Optional["AsyncServiceBrowser"] = None
+
+    async def start(self: object) -> None:
+        from zeroconf.asyncio import AsyncServiceBrowser, AsyncZeroconf
+
+        self.aiozc = AsyncZeroconf()
+        self.browser = AsyncServiceBrowser(
+            self.aiozc.zeroconf,
+            self.service_type,
+            handlers=[self.listener.on_service_state_change]
+        )
+
+    async def close(self: object) -> None:
+        self.listener.cancel()
+        if self.browser is not None:
+            await self.browser.async_cancel()
+        if self.aiozc is not None:
+            await self.aiozc.async_close()
+        self.browser = self.aiozc = None
+
+    async def __aenter__(self: object) -> "OcaDiscovery":
+        await self.start()
+        return self
+
+    async def __aexit__(self: object, *exc_info) -> None:
+        await self.close()
 
-        self.zeroconf:  Zeroconf = Zeroconf()
-        self.browser:   ServiceBrowser = ServiceBrowser(self.zeroconf, f"_oca._{self.protocol}.local.", self.listener)
-    
     @property
-    def services(self) -> list[ServiceInfo]:
-        return self.listener.services
-    
-    def find(self, device_name) -> Union[ServiceInfo, None]:
-        for service in self.services:
-            if service.name.split("._oca._udp.local.")[0].lower() == device_name.lower():
-                return service
+    def services(self) -> list["ServiceInfo"]:
+        return list(self.listener.services.values())
+
+    def find(self, device_name: str) -> Union["ServiceInfo", None]:
+        return self.listener.services.get(device_name.lower())
+
+    def find_address(self, address: str) -> Union["ServiceInfo", None]:
+        return self.listener.addresses.get(address)
 
+    async def wait_for(self, device_name: str, timeout: Optional[float] = None) -> "ServiceInfo":
+        """
+        Wait until `device_name` has been discovered and resolved.
 
+        Raises:
+            asyncio.TimeoutError: if the device is not found within `timeout` seconds
+        """
+        return await asyncio.wait_for(self.listener.wait_for(device_name), timeout)
@@ -0,0 +1,212 @@
+"""
+Persistent cache of discovered OCA devices, used to connect without waiting for mDNS
+"""
+
+from pydantic import BaseModel
+from typing import TYPE_CHECKING, Optional
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+
+from ocacomms.OcaDiscovery import normalise_name
+
+try:
+    import fcntl
+except ImportError:  # Windows, saves are still atomic but may race
+    fcntl = None
+
+if TYPE_CHECKING:
+    from zeroconf import ServiceInfo
+
+
+DEFAULT_CACHE_PATH: str = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "aes70", "discovery.json"
+)
+DEFAULT_TTL_S: int = 24 * 60 * 60  # seconds
+
+
+class CachedService(BaseModel):
+    """
+    The parts of a resolved mDNS service needed to reconnect to a device.
+
+    Args:
+        name:       Normalised device name
+        protocol:   "udp" | "tcp" | "websocket"
+        addresses:  Parsed IP addresses, in the order advertised
+        port:       Service port
+        properties: Decoded TXT record
+        updated:    Unix time the entry was last confirmed by mDNS
+    """
+    name: str
+    protocol: str
+    addresses: list[str]
+    port: int
+    properties: dict[str, Optional[str]] = {}
+    updated: float
+
+    @property
+    def endpoint(self) -> tuple[str, int]:
+        return (self.addresses[0], self.port)
+
+    @classmethod
+    def from_service_info(cls, info: "ServiceInfo", protocol: str) -> "CachedService":
+        return cls(
+            name=normalise_name(info.name, info.type),
+            protocol=protocol,
+            addresses=info.parsed_addresses(),
+            port=info.port,
+            properties={
+                key.decode("UTF-8", "replace"): None if value is None else value.decode("UTF-8", "replace")
+                for key, value in info.properties.items()
+            },
+            updated=time.time()
+        )
+
+
+class OcaDiscoveryCache:
+    """
+    JSON file backed map of `(protocol, device name)` to the last known `CachedService`.
+    Entries older than `ttl` seconds are not returned, and must be rediscovered. Several
+    processes may share one file.
+
+    Changes are saved straight away, or in a worker thread when made on a running event loop
+    so that file locking and writing never stall it. Await `flush()` for those to finish.
+    """
+    def __init__(self: object, path: str = DEFAULT_CACHE_PATH, ttl: float = DEFAULT_TTL_S) -> None:
+        self.path: str = path
+        self.ttl: float = ttl
+        self.entries: dict[str, CachedService] = {}
+        # Removed since the last save, so that merging does not bring them back
+        self._invalidated: set[str] = set()
+        # A save running in a worker thread, and whether changes since need another
+        self._saving: Optional[asyncio.Future] = None
+        self._dirty: bool = False
+        self.load()
+
+    @staticmethod
+    def _key(device_name: str, protocol: str) -> str:
+        return f"{protocol.lower()}/{device_name.lower()}"
+
+    def _read(self: object) -> dict[str, CachedService]:
+        try:
+            with open(self.path) as f:
+                raw = json.load(f)
+            return {key: CachedService.parse_obj(entry) for key, entry in raw.items()}
+        except FileNotFoundError:
+            return {}
+        except Exception as exc:
+            logging.warning("Ignoring unreadable discovery cache %s: %s", self.path, exc)
+            return {}
+
+    def load(self: object) -> None:
+        self.entries = self._read()
+        self._invalidated.clear()
+
+    def save(self: object) -> None:
+        """
+        Write the cache atomically, merged with what other processes sharing the file have
+        saved meanwhile, e.g. the supervisor's workers. The most recently confirmed entry for
+        each device wins.
+        """
+        entries, invalidated = dict(self.entries), set(self._invalidated)
+        self._invalidated.clear()
+        try:
+            merged = self._write(entries, invalidated)
+        except BaseException:
+            self._invalidated |= invalidated
+            raise
+        self._merge(merged, entries)
+
+    def _save_soon(self: object) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        if self._saving is not None:
+            # Coalesced into one more save once this one is done
+            self._dirty = True
+            return
+        entries, invalidated = dict(self.entries), set(self._invalidated)
+        self._invalidated.clear()
+        self._saving = loop.run_in_executor(None, self._write, entries, invalidated)
+        self._saving.add_done_callback(lambda future: self._saved(future, entries, invalidated))
+
+    def _saved(self: object, future: asyncio.Future, entries: dict[str, CachedService], invalidated: set[str]) -> None:
+        self._saving = None
+        error = asyncio.CancelledError() if future.cancelled() else future.exception()
+        if error is None:
+            self._merge(future.result(), entries)
+        else:
+            logging.warning("Could not save discovery cache %s: %r", self.path, error)
+            self._invalidated |= invalidated
+        if self._dirty:
+            self._dirty = False
+            self._save_soon()
+
+    async def flush(self: object) -> None:
+        """
+        Wait for saves running in a worker thread, including those coalesced behind them
+        """
+        while self._saving is not None:
+            await asyncio.wait({self._saving})
+
+    def _write(self: object, entries: dict[str, CachedService], invalidated: set[str]) -> dict[str, CachedService]:
+        """
+        Merge `entries` into the file, dropping `invalidated`. Safe to run in a worker thread.
+
+        Returns:
+            dict: Everything now in the file
+        """
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        with open(f"{self.path}.lock", "a") as lock:
+            # Read, merge and replace under the lock so that no process loses another's entries
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            merged = self._read()
+            for key in invalidated:
+                merged.pop(key, None)
+            for key, entry in entries.items():
+                if (saved := merged.get(key)) is None or saved.updated <= entry.updated:
+                    merged[key] = entry
+
+            # A temporary file of our own, so that concurrent saves never replace each other's
+            fd, tmp_path = tempfile.mkstemp(prefix=f"{os.path.basename(self.path)}.", suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump({key: entry.dict() for key, entry in merged.items()}, f, indent=2)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return merged
+
+    def _merge(self: object, merged: dict[str, CachedService], entries: dict[str, CachedService]) -> None:
+        """
+        Take in what a save of `entries` found in the file, except for devices changed here since
+        """
+        for key, entry in merged.items():
+            if self.entries.get(key) is entries.get(key) and key not in self._invalidated:
+                self.entries[key] = entry
+
+    def get(self: object, device_name: str, protocol: str) -> Optional[CachedService]:
+        entry = self.entries.get(self._key(device_name, protocol))
+        if entry is None or time.time() - entry.updated > self.ttl or not entry.addresses:
+            return None
+        return entry
+
+    def update(self: object, device_name: str, protocol: str, info: "ServiceInfo") -> CachedService:
+        entry = CachedService.from_service_info(info, protocol)
+        self.entries[self._key(device_name, protocol)] = entry
+        self._save_soon()
+        return entry
+
+    def invalidate(self: object, device_name: str, protocol: str) -> None:
+        key = self._key(device_name, protocol)
+        if self.entries.pop(key, None) is not None:
+            self._invalidated.add(key)
+            self._save_soon()
@@ -0,0 +1,116 @@
+"""
+Fan events out to subscribed controllers
+
+Each event is encoded once, whatever the number of subscribers. Every subscription holds its
+notification header, pre-encoded when the subscription is added, so a notification for one
+subscriber is a 4 byte size plus three joined byte strings.
+
+Notifications are held for a short window and then sent, grouped per controller into
+multi-message notification PDUs. While waiting, a newer value of the same property replaces
+the older one for each subscriber, so a controller only receives the latest meter reading.
+"""
+
+import asyncio
+import itertools
+import struct
+from typing import Callable, Hashable, Optional
+
+from ocacore.ocp1 import *
+
+
+T_NOTIFICATION_WINDOW_S: float = 0.01  # seconds notifications are held for batching
+
+NOTIFICATION_PREFIX = struct.Struct("!IHHBH")  # Notification header after the size field
+NOTIFICATION_SIZE = struct.Struct("!I")
+EVENT = struct.Struct("!IHH")
+
+Address = tuple[str, int]
+EventKey = tuple[int, int, int]  # (emitter ONo, event def_level, event index)
+SubscriberKey = tuple[Address, int, int, int]  # (controller, subscriber ONo, def_level, method_index)
+Sender = Callable[[Address, MessageType, list[bytes]], None]
+
+
+class NotificationFanout:
+    """
+    Args:
+        send:   Called with `(address, MessageType.NOTIFICATION, messages)` to send a batch,
+                packing the messages into as few PDUs as possible
+        window: Seconds to hold notifications before sending. With 0 they are still batched
+                within one pass of the event loop.
+    """
+    def __init__(self, send: Sender, window: float = T_NOTIFICATION_WINDOW_S) -> None:
+        self.send: Sender = send
+        self.window: float = window
+        # Event -> subscriber -> pre-encoded notification header (after the size) and context
+        self.subscriptions: dict[EventKey, dict[SubscriberKey, bytes]] = {}
+        # Controller -> (subscriber, event, supersede key) -> notification
+        self.pending: dict[Address, dict[tuple, bytes]] = {}
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._unique = itertools.count()
+
+        self.published: int = 0
+        self.superseded: int = 0
+        self.sent: int = 0
+
+    def subscribe(self, event: EventKey, subscriber: SubscriberKey, context: bytes) -> None:
+        _, ono, def_level, method_index = subscriber
+        prefix = NOTIFICATION_PREFIX.pack(ono, def_level, method_index, 2, len(context)) + context  # 2: context and event
+        self.subscriptions.setdefault(event, {})[subscriber] = prefix
+
+    def unsubscribe(self, event: EventKey, subscriber: SubscriberKey) -> None:
+        if (subscribers := self.subscriptions.get(event)) is not None:
+            subscribers.pop(subscriber, None)
+            if not subscribers:
+                del self.subscriptions[event]
+
+    def drop(self, addr: Address) -> None:
+        """ Remove every subscription of a controller, and anything waiting to be sent to it """
+        for event in list(self.subscriptions):
+            for subscriber in [subscriber for subscriber in self.subscriptions[event] if subscriber[0] == addr]:
+                self.unsubscribe(event, subscriber)
+        self.pending.pop(addr, None)
+
+    def has_subscribers(self, event: EventKey) -> bool:
+        return event in self.subscriptions
+
+    def publish(self, event: EventKey, event_data: bytes, supersede: Optional[Hashable] = None) -> None:
+        """
+        Queue an event for every subscriber.
+
+        Args:
+            event:      The emitting object and event ID
+            event_data: Encoded event data, shared by every subscriber
+            supersede:  Notifications of the same event with the same key replace each other while
+                        waiting, e.g. the property ID for PropertyChanged. None to always deliver.
+        """
+        if (subscribers := self.subscriptions.get(event)) is None:
+            return
+        self.published += 1
+        event_bytes = EVENT.pack(*event) + event_data
+        if supersede is None:
+            supersede = ("unique", next(self._unique))
+        for subscriber, prefix in subscribers.items():
+            pending = self.pending.setdefault(subscriber[0], {})
+            key = (subscriber, event, supersede)
+            if key in pending:
+                self.superseded += 1
+            pending[key] = NOTIFICATION_SIZE.pack(4 + len(prefix) + len(event_bytes)) + prefix + event_bytes
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.window, self.flush) if self.window else loop.call_soon(self.flush)
+
+    def flush(self) -> None:
+        """ Send everything waiting now """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self.pending = self.pending, {}
+        for addr, notifications in pending.items():
+            self.sent += len(notifications)
+            self.send(addr, MessageType.NOTIFICATION, list(notifications.values()))
+
+    def close(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.pending.clear()
@@ -0,0 +1,261 @@
+"""
+OCP.1 over WebSocket
+
+Just enough of RFC 6455 to carry OCP.1: binary messages, ping/pong and close, over asyncio
+streams, for both the controller and device ends. Each binary message holds one or more
+whole OCP.1 PDUs, back to back.
+
+PDUs passed to `OcaWebSocket.send()` in the same event loop iteration are packed into one
+message, up to `MAX_FRAME_BYTES`. This saves the per-message framing, masking and wakeups
+that otherwise limit how fast a browser panel or controller can refresh.
+
+Usage:
+    websocket = await connect("10.0.0.5", 65000)
+    websocket.send(pdu)
+    for pdu in split_pdus(await websocket.recv()):
+        ...
+"""
+
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import struct
+from typing import Optional
+
+
+MAX_FRAME_BYTES: int = 65536  # PDUs are packed into one message up to this size
+MAX_MESSAGE_BYTES: int = 1 << 22  # larger incoming messages close the connection
+T_HANDSHAKE_S: float = 5.0  # seconds
+
+SUBPROTOCOL: str = "oca"
+ACCEPT_GUID: bytes = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION: int = 0x0
+OP_BINARY: int = 0x2
+OP_CLOSE: int = 0x8
+OP_PING: int = 0x9
+OP_PONG: int = 0xA
+
+PDU_SIZE = struct.Struct("!BHI")  # sync, protocol version, message size
+
+
+class WebSocketError(ConnectionError):
+    """ A failed handshake or a protocol violation by the peer """
+
+
+def split_pdus(message: bytes) -> list[bytes]:
+    """
+    Split a message into the OCP.1 PDUs it carries
+
+    Raises:
+        WebSocketError: if the message does not hold whole PDUs
+    """
+    pdus = []
+    offset = 0
+    while offset < len(message):
+        if len(message) - offset < PDU_SIZE.size:
+            raise WebSocketError("Truncated PDU header")
+        _, _, message_size = PDU_SIZE.unpack_from(message, offset)
+        end = offset + 1 + message_size
+        if end > len(message) or message_size < PDU_SIZE.size - 1:
+            raise WebSocketError("Truncated PDU")
+        pdus.append(message[offset:end])
+        offset = end
+    return pdus
+
+
+def accept_key(key: bytes) -> bytes:
+    return base64.b64encode(hashlib.sha1(key + ACCEPT_GUID).digest())
+
+
+def mask(data: bytes, key: bytes) -> bytes:
+    # XOR as one big integer, far quicker than byte by byte
+    length = len(data)
+    repeated = (key * (length // 4 + 1))[:length]
+    return (int.from_bytes(data, "big") ^ int.from_bytes(repeated, "big")).to_bytes(length, "big")
+
+
+def encode_frame(opcode: int, payload: bytes, masked: bool) -> bytes:
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, (0x80 if masked else 0) | length)
+    elif length < 0x10000:
+        header = struct.pack("!BBH", 0x80 | opcode, (0x80 if masked else 0) | 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, (0x80 if masked else 0) | 127, length)
+    if not masked:
+        return header + payload
+    key = os.urandom(4)
+    return header + key + mask(payload, key)
+
+
+async def _read_headers(reader: asyncio.StreamReader) -> tuple[str, dict[str, str]]:
+    lines = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    return lines[0], headers
+
+
+class OcaWebSocket:
+    """
+    One end of an established WebSocket connection. Use `connect()` or `accept()`.
+
+    Args:
+        client: Frames from a client are masked, frames from a server are not
+    """
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, client: bool) -> None:
+        self.reader: asyncio.StreamReader = reader
+        self.writer: asyncio.StreamWriter = writer
+        self.client: bool = client
+        self.closed: bool = False
+        self._pending: bytearray = bytearray()
+        self._flush_scheduled: bool = False
+        self.frames_sent: int = 0
+
+    @property
+    def peer(self) -> tuple[str, int]:
+        return self.writer.get_extra_info("peername")[:2]
+
+    def send(self, pdu: bytes) -> None:
+        """
+        Queue a PDU. It goes out with any others sent in this event loop iteration.
+        """
+        if self.closed:
+            return
+        if self._pending and len(self._pending) + len(pdu) > MAX_FRAME_BYTES:
+            self.flush()
+        self._pending += pdu
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self) -> None:
+        """ Send the queued PDUs now, as one binary message """
+        self._flush_scheduled = False
+        if not self._pending or self.closed:
+            return
+        self.writer.write(encode_frame(OP_BINARY, bytes(self._pending), self.client))
+        self._pending.clear()
+        self.frames_sent += 1
+
+    async def recv(self) -> bytes:
+        """
+        Wait for the next binary message, answering pings on the way
+
+        Raises:
+            ConnectionError: when the connection closes
+            WebSocketError: if the peer breaks the protocol
+        """
+        fragments = []
+        size = 0
+        while True:
+            try:
+                first, second = await self.reader.readexactly(2)
+                length = second & 0x7F
+                if length == 126:
+                    length, = struct.unpack("!H", await self.reader.readexactly(2))
+                elif length == 127:
+                    length, = struct.unpack("!Q", await self.reader.readexactly(8))
+                key = await self.reader.readexactly(4) if second & 0x80 else None
+                if length > MAX_MESSAGE_BYTES or size + length > MAX_MESSAGE_BYTES:
+                    self.close(1009)
+                    raise WebSocketError(f"Message over {MAX_MESSAGE_BYTES} bytes")
+                payload = await self.reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                self.closed = True
+                raise ConnectionError("WebSocket closed")
+            if key is not None:
+                payload = mask(payload, key)
+            opcode = first & 0x0F
+            if opcode == OP_PING:
+                if not self.closed:
+                    self.writer.write(encode_frame(OP_PONG, payload, self.client))
+            elif opcode == OP_PONG:
+                pass
+            elif opcode == OP_CLOSE:
+                self.close()
+                raise ConnectionError("WebSocket closed by peer")
+            elif opcode in (OP_BINARY, OP_CONTINUATION):
+                fragments.append(payload)
+                size += length
+                if first & 0x80:
+                    return b"".join(fragments)
+            else:
+                self.close(1003)
+                raise WebSocketError(f"Unsupported opcode {opcode}")
+
+    def close(self, code: int = 1000) -> None:
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        try:
+            self.writer.write(encode_frame(OP_CLOSE, struct.pack("!H", code), self.client))
+        except (ConnectionError, RuntimeError):
+            pass
+        self.writer.close()
+
+
+async def connect(host: str, port: int, path: str = "/", timeout: float = T_HANDSHAKE_S) -> OcaWebSocket:
+    """
+    Open a WebSocket to a device
+
+    Raises:
+        WebSocketError: if the device refuses the upgrade
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    key = base64.b64encode(os.urandom(16))
+    writer.write(
+        f"GET {path} HTTP/1.1\r\n"
+        f"Host: {host}:{port}\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        f"Sec-WebSocket-Key: {key.decode()}\r\n"
+        "Sec-WebSocket-Version: 13\r\n"
+        f"Sec-WebSocket-Protocol: {SUBPROTOCOL}\r\n"
+        "\r\n".encode()
+    )
+    try:
+        status, headers = await asyncio.wait_for(_read_headers(reader), timeout)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError) as exc:
+        writer.close()
+        raise WebSocketError(f"Handshake failed: {exc}")
+    if status.split(" ")[1:2] != ["101"] or headers.get("sec-websocket-accept", "").encode() != accept_key(key):
+        writer.close()
+        raise WebSocketError(f"Upgrade refused: {status}")
+    return OcaWebSocket(reader, writer, client=True)
+
+
+async def accept(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, timeout: float = T_HANDSHAKE_S) -> OcaWebSocket:
+    """
+    Complete the handshake for a connection accepted by a server
+
+    Raises:
+        WebSocketError: if the request is not a WebSocket upgrade
+    """
+    try:
+        request, headers = await asyncio.wait_for(_read_headers(reader), timeout)
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError) as exc:
+        writer.close()
+        raise WebSocketError(f"Handshake failed: {exc}")
+    key = headers.get("sec-websocket-key")
+    if not request.startswith("GET ") or headers.get("upgrade", "").lower() != "websocket" or not key:
+        writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n")
+        writer.close()
+        raise WebSocketError(f"Not a WebSocket upgrade: {request}")
+    protocols = [protocol.strip() for protocol in headers.get("sec-websocket-protocol", "").split(",")]
+    response = (
+        "HTTP/1.1 101 Switching Protocols\r\n"
+        "Upgrade: websocket\r\n"
+        "Connection: Upgrade\r\n"
+        f"Sec-WebSocket-Accept: {accept_key(key.encode()).decode()}\r\n"
+    )
+    if SUBPROTOCOL in protocols:
+        response += f"Sec-WebSocket-Protocol: {SUBPROTOCOL}\r\n"
+    writer.write((response + "\r\n").encode())
+    return OcaWebSocket(reader, writer, client=False)
@@ -1,6 +1,7 @@
 from typing import ClassVar, Final, Any
-from ocacore.occ.root import OcaRoot
+from ocacore.occ.root import OcaRoot, Method
 from ocacore.occ.types import *
+from ocacore.occ.types.management import *
 
 class OcaManager(OcaRoot):
     local_id: ClassVar[int] = 3
@@ -31,7 +32,7 @@ class OcaDeviceManager(OcaManager):
     busy: OcaBoolean
     reset_cause: OcaResetCause
     message: OcaString
-    managers: OcaList[OcaManagerDescriptor]
+    managers: list[OcaManagerDescriptor]
     device_revision_id: OcaString
     
     @property
@@ -54,3 +55,95 @@ class OcaDeviceManager(OcaManager):
             OcaPropertyID(def_level=3, property_index=15): self.managers,
             OcaPropertyID(def_level=3, property_index=16): self.device_revision_id
         }
+
+    # Methods
+    get_oca_version: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=1),
+        response_type=OcaUint16
+    )
+    get_model_guid: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=2)
+    )
+    get_serial_number: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=3),
+        response_type=OcaString
+    )
+    get_device_name: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=4),
+        response_type=OcaString
+    )
+
+
+# = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - 
+
+class OcaSubscriptionManager(OcaManager):
+    local_id: ClassVar[int] = 4
+    class_version: ClassVar[OcaClassVersionNumber] = OcaClassVersionNumber(2)
+
+    @property
+    def local_properties(self) -> dict[str, Any]:
+        return {}
+
+    # Methods
+    add_subscription: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=1),
+        kwargs={
+            "event": OcaEvent,
+            "subscriber": OcaMethod,
+            "subscriber_context": OcaBlob,
+            "notification_delivery_mode": OcaUint8, # OcaNotificationDeliveryMode
+            "destination_information": OcaBlob
+        }
+    )
+    remove_subscription: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=2),
+        kwargs={"event": OcaEvent, "subscriber": OcaMethod}
+    )
+    disable_notifications: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=3)
+    )
+    re_enable_notifications: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=4)
+    )
+
+
+
+# = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - 
+
+class OcaFirmwareManager(OcaManager):
+    local_id: ClassVar[int] = 3
+    class_version: ClassVar[OcaClassVersionNumber] = OcaClassVersionNumber(2)
+
+    @property
+    def local_properties(self) -> dict[str, Any]:
+        return {}
+
+    # Methods
+    get_component_versions: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=1)
+    )
+    start_update_process: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=2)
+    )
+    begin_active_image_update: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=3),
+        kwargs={"component": OcaUint16} # OcaComponent
+    )
+    add_image_data: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=4),
+        kwargs={"id": OcaUint32, "image_data": OcaBlob}
+    )
+    verify_image: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=5),
+        kwargs={"verify_data": OcaBlob}
+    )
+    end_active_image_update: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=6)
+    )
+    begin_passive_component_update: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=7),
+        kwargs={"component": OcaUint16, "server_address": OcaBlob, "update_file_name": OcaString}
+    )
+    end_update_process: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=8)
+    )
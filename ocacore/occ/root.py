@@ -17,10 +17,14 @@ class Method(BaseModel):
         returns:    Method return type
     """
     method_id: OcaMethodID
-    kwargs: Optional[dict[str, OCCBase]]
+    kwargs: Optional[dict[str, type]]
     response_type: Optional[type]
     
 
+# Method tables by class, see `OcaRoot.method_table()`
+_method_tables: dict[type, dict[OcaMethodID, Method]] = {}
+
+
 class OcaRoot(BaseModel):
     # Properties
     @classmethod
@@ -45,25 +49,23 @@ class OcaRoot(BaseModel):
                 props = build_props(obj.__bases__[0], props)
             return props
 
-        return build_props(self)
+        return build_props(self, {})
     
+    @classmethod
+    def method_table(cls) -> dict[OcaMethodID, Method]:
+        """
+        Every method of the class and its bases, by ID. Built on first use and then shared
+        by every instance of the class, so it must not be modified.
+        """
+        if (table := _method_tables.get(cls)) is None:
+            table = _method_tables[cls] = {
+                attr.method_id: attr for name in dir(cls) if isinstance(attr := getattr(cls, name, None), Method)
+            }
+        return table
+
     @property
     def methods(self) -> dict[OcaMethodID, Method]:
-        def build_methods(obj: OcaRoot, enumerated_methods: dict[OcaMethodID, Method] = {}):
-            for attr_name in dir(obj):
-                if attr_name == "methods":
-                    continue
-                try:
-                    if isinstance(attr := getattr(obj, attr_name), Method):
-                        enumerated_methods[attr.method_id] = attr
-                except AttributeError:
-                    pass
-                
-            if not isinstance(obj, OcaRoot):
-                enumerated_methods = build_methods(obj.__bases__[0], enumerated_methods)
-            return enumerated_methods
-
-        return build_methods(self)
+        return self.method_table()
 
     local_id: ClassVar[int] = 1
     class_version: ClassVar[OcaClassVersionNumber] = OcaClassVersionNumber(2)
@@ -81,6 +83,9 @@ class OcaRoot(BaseModel):
             OcaPropertyID(def_level=1, property_index=5): self.role                         
         }
 
+    # Events
+    property_changed_event: ClassVar[OcaEventID] = OcaEventID(def_level=OcaUint16(1), event_index=OcaUint16(1))
+
     # Methods
     get_class_identification: ClassVar[Method] = Method(
         method_id=OcaMethodID(def_level=1, method_index=1),
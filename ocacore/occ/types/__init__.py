@@ -1,4 +1,21 @@
 from .base import *
 from .framework import *
-from .media import *
-from .worker import *
\ No newline at end of file
+from .worker import *
+
+# Loaded on first access, few sessions ever touch them
+_LAZY_MODULES = ("media",)
+
+
+def __getattr__(name: str):
+    import importlib
+
+    # `from ... import *` asks for `__all__`, which must not load everything
+    if name.startswith("__"):
+        raise AttributeError(name)
+    for module_name in _LAZY_MODULES:
+        module = importlib.import_module(f".{module_name}", __name__)
+        if hasattr(module, name):
+            value = getattr(module, name)
+            globals()[name] = value
+            return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
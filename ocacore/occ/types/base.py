@@ -1,12 +1,13 @@
 """
 """
 
-from typing import Union, ClassVar
+from typing import Union, ClassVar, Iterable
 from pydantic import BaseModel, validator, conint
 from enum import Enum
 from math import ceil
-from bitstring import BitArray
+import functools
 import struct
+import sys
 
 
 int8 = conint(ge=-0x80, le=0x7F)
@@ -19,12 +20,37 @@ uint32 = conint(ge=0, le=0xFF_FF_FF_FF)
 uint64 = conint(ge=0, le=0xFF_FF_FF_FF_FF_FF_FF_FF)
 
 
+@functools.lru_cache(maxsize=None)
+def fixed_struct(format: str) -> struct.Struct:
+    """ Compiled `struct.Struct` for a type's `_format`, built once per format """
+    return struct.Struct("!" + format.replace("!", ""))
+
+
 class OCCBase(BaseModel):
     """ Base type for all OCC classes. Does not implement anything, only used for typing """
     @property
     def _attr_order(self):
         raise NotImplementedError("_attr_order should be defined on the child class.")
 
+    @property
+    def encoded_size(self) -> int:
+        """
+        Size of `bytes`. Types that can work this out without encoding override it.
+        """
+        return len(self.bytes)
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        """
+        Write `bytes` into `buffer` at `offset`. Types that can pack in place override this.
+
+        Returns:
+            int: The offset just past the written value
+        """
+        data = self.bytes
+        end = offset + len(data)
+        buffer[offset:end] = data
+        return end
+
 
 class OcaValueBase(OCCBase):
     """ Base type for simple types to add dunder methods for the `value` field """
@@ -38,6 +64,9 @@ class OcaValueBase(OCCBase):
     def __int__(self) -> int:
         return int(self.value)
 
+    def __float__(self) -> float:
+        return float(self.value)
+
     def __index__(self) -> int:
         return int(self.value)
     
@@ -87,7 +116,6 @@ class OcaSerialisableBase(OCCBase):
         # Handle any extra processing to get a given type's bytes
         getters = {
             str: lambda value: value.encode("UTF-8"),
-            BitArray: lambda value: value.bytes
         }
         for i, value in enumerate(values):
             if (t := type(value)) in getters:
@@ -101,6 +129,15 @@ class OcaSerialisableBase(OCCBase):
         )
 
 
+    @property
+    def encoded_size(self) -> int:
+        return fixed_struct(self._format).size
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        packer = fixed_struct(self._format)
+        packer.pack_into(buffer, offset, *[getattr(self, attr) for attr in self._attr_order])
+        return offset + packer.size
+
     @classmethod
     def from_bytes(cls, data: bytes) -> "OcaSerialisableBase":
         """
@@ -117,7 +154,6 @@ class OcaSerialisableBase(OCCBase):
         if isinstance(cls._format, property):
             raise TypeError(f"Used inherited `from_bytes` from OcaSerialisableBase, but `_format` is a property. Implement `from_bytes` on {cls.__qualname__}!")
         values = struct.unpack(f"!{cls._format}", data)
-        print(f"{values=}\n{cls._attr_order=}")
         if len(values) > 1:
             return cls(**dict(zip(cls._attr_order, *values)))
         return cls(**dict(zip(cls._attr_order, values)))
@@ -185,19 +221,27 @@ class OcaUint64(OcaValueBase, OcaSerialisableBase):
     value: uint64
 
 
-class OcaFloat32(OcaValueBase):
+class OcaFloat32(OcaValueBase, OcaSerialisableBase):
     _attr_order: ClassVar[list] = ["value"]
     _format: ClassVar[str] = "f"
     value: float #TODO how to constrain floats?
 
 
-class OcaFloat64(OcaValueBase):
+class OcaFloat64(OcaValueBase, OcaSerialisableBase):
     _attr_order: ClassVar[list] = ["value"]
     _format: ClassVar[str] = "d"
     value: float #TODO how to constrain floats?
 
 
+LENGTH = struct.Struct("!H")  # Length prefix of strings, bit strings and blobs
+INTERN_MAX_LENGTH: int = 64  # code points, shorter decoded strings (roles, labels) are interned
+_UTF8_CONTINUATION = bytes(range(0x80, 0xC0))
+
+
 class OcaString(OcaValueBase, OcaSerialisableBase):
+    """
+    A UTF-8 string. As per AES70-3, the length prefix counts Unicode code points, not bytes.
+    """
     _attr_order: ClassVar[list[str]] = ["length", "value"]
 
     @property
@@ -208,62 +252,260 @@ class OcaString(OcaValueBase, OcaSerialisableBase):
 
     @property
     def _format(self) -> str:
-        return f"{OcaUint16._format}{len(self.value)}s"
-    
+        return f"{OcaUint16._format}{len(self.value.encode('UTF-8'))}s"
+
+    @property
+    def bytes(self) -> bytes:
+        return LENGTH.pack(len(self.value)) + self.value.encode("UTF-8")
+
+    @property
+    def encoded_size(self) -> int:
+        return LENGTH.size + (len(self.value) if self.value.isascii() else len(self.value.encode("UTF-8")))
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        encoded = self.value.encode("UTF-8")
+        LENGTH.pack_into(buffer, offset, len(self.value))
+        end = offset + LENGTH.size + len(encoded)
+        buffer[offset + LENGTH.size:end] = encoded
+        return end
+
+    @classmethod
+    def unpack_from(cls, data: bytes, offset: int = 0) -> tuple["OcaString", int]:
+        """
+        Decode a string starting at `offset` of `data`
+
+        Returns:
+            tuple: The string, and the number of bytes consumed
+
+        Raises:
+            struct.error: if `data` ends before the string does
+        """
+        length, = LENGTH.unpack_from(data, offset)
+        start = offset + LENGTH.size
+        end = start + length
+        raw = bytes(data[start:end])
+        missing = 0
+        if not raw.isascii():
+            # Multi-byte characters, extend until the slice holds `length` code points
+            while (missing := length - len(raw.translate(None, _UTF8_CONTINUATION))) > 0 and end < len(data):
+                end += missing
+                raw = bytes(data[start:end])
+            while end < len(data) and 0x80 <= data[end] < 0xC0:
+                end += 1
+            raw = bytes(data[start:end])
+        if end > len(data) or missing > 0:
+            raise struct.error(f"OcaString of {length} code points truncated")
+        value = raw.decode("UTF-8")
+        if length <= INTERN_MAX_LENGTH:
+            value = sys.intern(value)
+        return cls.construct(value=value), end - offset
+
     @classmethod
     def from_bytes(cls, data: bytes) -> "OcaString":
-        length, *_ = struct.unpack(f"!{OcaUint16._format}", data[:2])
-        value, *_ = struct.unpack(f"!{length}s", data[2:])
-        return cls(value.decode("UTF-8"))
+        return cls.unpack_from(data)[0]
 
 
 class OcaBitstring(OcaSerialisableBase):
-    _attr_order: ClassVar[list[str]] = ["num_bits", "bitstring"]
+    """
+    A string of `num_bits` bits, held packed in `data`. Bits are only unpacked when accessed,
+    the first bit being the most significant bit of the first byte.
+    """
+    _attr_order: ClassVar[list[str]] = ["num_bits", "data"]
+    num_bits: uint16
+    data: bytes
+
+    @validator("data")
+    def _whole_bytes(cls, value, values):
+        # `num_bits` is encoded as given, so it must describe exactly the bytes that follow it
+        if "num_bits" in values and len(value) != ceil(values["num_bits"] / 8):
+            raise ValueError(f"{values['num_bits']} bits need {ceil(values['num_bits'] / 8)} bytes, not {len(value)}")
+        return value
 
-    class Config:
-        arbitrary_types_allowed = True
-        
-    @property
-    def num_bits(self) -> OcaUint8:
-        return OcaUint16(len(self.bitstring))
+    @classmethod
+    def from_bits(cls, bits: Iterable[bool]) -> "OcaBitstring":
+        bits = list(bits)
+        return cls.from_int(sum(1 << i for i, bit in enumerate(reversed(bits)) if bit), len(bits))
 
-    bitstring: BitArray
+    @classmethod
+    def from_int(cls, value: int, num_bits: int) -> "OcaBitstring":
+        """ The bits of `value`, most significant first """
+        size = ceil(num_bits / 8)
+        return cls(num_bits=num_bits, data=(value << (size * 8 - num_bits)).to_bytes(size, "big"))
 
     def __len__(self) -> int:
         return self.num_bits
 
+    def __int__(self) -> int:
+        return int.from_bytes(self.data, "big") >> (len(self.data) * 8 - self.num_bits)
+
+    def __getitem__(self, index: int) -> bool:
+        if index < 0:
+            index += self.num_bits
+        if not 0 <= index < self.num_bits:
+            raise IndexError(f"Bit {index} of {self.num_bits}")
+        return bool(self.data[index >> 3] & (0x80 >> (index & 7)))
+
+    def bits(self) -> list[bool]:
+        return [self[i] for i in range(self.num_bits)]
+
     @property
     def _format(self) -> str:
-        return f"{OcaUint16._format}{ceil(self.num_bits / 8)}s"
-    
+        return f"{OcaUint16._format}{len(self.data)}s"
+
+    @property
+    def bytes(self) -> bytes:
+        return LENGTH.pack(self.num_bits) + self.data
+
+    @property
+    def encoded_size(self) -> int:
+        return LENGTH.size + len(self.data)
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        LENGTH.pack_into(buffer, offset, self.num_bits)
+        end = offset + LENGTH.size + len(self.data)
+        buffer[offset + LENGTH.size:end] = self.data
+        return end
+
+    @classmethod
+    def unpack_from(cls, data: bytes, offset: int = 0) -> tuple["OcaBitstring", int]:
+        """
+        Decode a bit string starting at `offset` of `data`
+
+        Returns:
+            tuple: The bit string, and the number of bytes consumed
+        """
+        num_bits, = LENGTH.unpack_from(data, offset)
+        end = offset + LENGTH.size + ceil(num_bits / 8)
+        if end > len(data):
+            raise struct.error(f"OcaBitstring of {num_bits} bits truncated")
+        return cls.construct(num_bits=num_bits, data=bytes(data[offset + LENGTH.size:end])), end - offset
+
     @classmethod
     def from_bytes(cls, data: bytes) -> "OcaBitstring":
-        length, *_ = struct.unpack(f"!{OcaUint16._format}", data[:2])
-        values, *_ = struct.unpack(f"!{ceil(length / 8)}s", data[2:])
-        return cls(num_bits=length, bitstring=BitArray(values))
+        return cls.unpack_from(data)[0]
 
 
-class OcaBlob(OCCBase):
+class OcaBlob(OcaSerialisableBase):
+    """
+    Opaque data, held as `bytes`. Decoding slices the data rather than building a value per
+    byte, and a blob decoded from a memoryview is a view of it.
+    """
     _attr_order: ClassVar[list[str]] = ["data_size", "data"]
-    data_size: OcaUint16
-    data: list[OcaUint8]
+    data: bytes
+
+    @validator("data", pre=True)
+    def _to_bytes(cls, value):
+        # Also accepts a list of byte values, or any buffer
+        return bytes(int(byte) for byte in value) if isinstance(value, list) else bytes(value)
+
+    @property
+    def data_size(self) -> int:
+        return len(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
 
     @property
     def _format(self) -> str:
-        return f"{self.data_size}{OcaUint8._format}"
+        return f"{OcaUint16._format}{len(self.data)}s"
+
+    @property
+    def bytes(self) -> bytes:
+        return LENGTH.pack(len(self.data)) + self.data
+
+    @property
+    def encoded_size(self) -> int:
+        return LENGTH.size + len(self.data)
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        LENGTH.pack_into(buffer, offset, len(self.data))
+        end = offset + LENGTH.size + len(self.data)
+        buffer[offset + LENGTH.size:end] = self.data
+        return end
+
+    @classmethod
+    def unpack_from(cls, data: bytes, offset: int = 0) -> tuple["OcaBlob", int]:
+        """
+        Decode a blob starting at `offset` of `data`
+
+        Returns:
+            tuple: The blob, and the number of bytes consumed
 
+        Raises:
+            struct.error: if `data` ends before the blob does
+        """
+        length, = LENGTH.unpack_from(data, offset)
+        end = offset + LENGTH.size + length
+        if end > len(data):
+            raise struct.error(f"OcaBlob of {length} bytes truncated")
+        return cls.construct(data=data[offset + LENGTH.size:end]), end - offset
 
-class OcaBlobFixedLen(OCCBase):
-    _attr_order: ClassVar[list[str]] = ["length", "data"]
-    data: list[OcaUint8]
-     
     @classmethod
-    def length(cls, l: int) -> "OcaBlobFixedLen":
-        class template(OcaBlobFixedLen):
+    def from_bytes(cls, data: bytes) -> "OcaBlob":
+        return cls.unpack_from(data)[0]
+
+
+class OcaBlobFixedLen(OcaSerialisableBase):
+    """
+    Opaque data of a fixed length, without a length prefix. Use the type for each length,
+    `OcaBlobFixedLen.length(n)`, which is built once and shared.
+    """
+    _attr_order: ClassVar[list[str]] = ["data"]
+    data: bytes
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def length(cls, l: int) -> type["OcaBlobFixedLen"]:
+        class template(cls):
             length: ClassVar[int] = l
-        
+            _format: ClassVar[str] = f"{l}s"
+
+        template.__name__ = template.__qualname__ = f"{cls.__name__}[{l}]"
         return template
 
+    @validator("data", pre=True)
+    def _to_bytes(cls, value):
+        value = bytes(int(byte) for byte in value) if isinstance(value, list) else bytes(value)
+        if isinstance(cls.length, int) and len(value) != cls.length:
+            raise ValueError(f"Expected {cls.length} bytes, not {len(value)}")
+        return value
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def bytes(self) -> bytes:
+        return bytes(self.data)
+
+    @property
+    def encoded_size(self) -> int:
+        return len(self.data)
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        end = offset + len(self.data)
+        buffer[offset:end] = self.data
+        return end
+
+    @classmethod
+    def unpack_from(cls, data: bytes, offset: int = 0) -> tuple["OcaBlobFixedLen", int]:
+        """
+        Decode a blob of this type's length starting at `offset` of `data`
+
+        Returns:
+            tuple: The blob, and the number of bytes consumed
+
+        Raises:
+            struct.error: if `data` ends before the blob does
+        """
+        end = offset + cls.length
+        if end > len(data):
+            raise struct.error(f"OcaBlobFixedLen of {cls.length} bytes truncated")
+        return cls.construct(data=data[offset:end]), cls.length
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "OcaBlobFixedLen":
+        return cls.unpack_from(data)[0]
+
 
 class OcaList(OCCBase):
     _attr_order: ClassVar[list[str]] = ["template_type", "count", "items"]
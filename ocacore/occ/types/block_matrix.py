@@ -51,7 +51,7 @@ class OcaProtoObjectIdentification(OCCBase):
 
 
 class OcaProtoPortID(OCCBase):
-    _format: ClassVar[str] = f"{OcaPortMode._format}{OcaUint16._format}"
+    _format: ClassVar[str] = f"B{OcaUint16._format}"
     mode: OcaPortMode
     index: OcaUint16
 
@@ -89,6 +89,14 @@ class OcaMethodID(OCCBase):
             self.method_index
         )
 
+    @property
+    def encoded_size(self) -> int:
+        return 4
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        fixed_struct(self._format).pack_into(buffer, offset, self.def_level, self.method_index)
+        return offset + 4
+
     def __hash__(self):
         return hash((self.def_level, self.method_index))
     
@@ -122,6 +130,63 @@ class OcaEventID(OCCBase):
     event_index: OcaUint16
 
 
+class OcaEvent(OCCBase):
+    _format: ClassVar[str] = f"{OcaONo._format}{OcaEventID._format}"
+    emitter_ono: OcaONo
+    event_id: OcaEventID
+
+    @property
+    def bytes(self) -> struct.Struct:
+        return struct.pack(
+            f"!{self._format}",
+            self.emitter_ono,
+            self.event_id.def_level,
+            self.event_id.event_index
+        )
+
+    @property
+    def encoded_size(self) -> int:
+        return 8
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        fixed_struct(self._format).pack_into(
+            buffer, offset, self.emitter_ono, self.event_id.def_level, self.event_id.event_index
+        )
+        return offset + 8
+
+
+class OcaMethod(OCCBase):
+    _format: ClassVar[str] = f"{OcaONo._format}{OcaMethodID._format[1:]}"
+    ono: OcaONo
+    method_id: OcaMethodID
+
+    @property
+    def bytes(self) -> struct.Struct:
+        return struct.pack(f"!{OcaONo._format}", self.ono) + self.method_id.bytes
+
+    @property
+    def encoded_size(self) -> int:
+        return 8
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        fixed_struct(self._format).pack_into(buffer, offset, self.ono, self.method_id.def_level, self.method_id.method_index)
+        return offset + 8
+
+
+class OcaNotificationDeliveryMode(Enum):
+    Reliable = 1
+    Fast = 2
+
+
+class OcaPropertyChangeType(Enum):
+    CurrentChanged = 1
+    MinChanged = 2
+    MaxChanged = 3
+    ItemAdded = 4
+    ItemChanged = 5
+    ItemDeleted = 6
+
+
 class OcaPropertyDescriptor(OCCBase):
     _format: ClassVar[str] = f"{OcaPropertyID._format}B{OcaMethodID._format}{OcaMethodID._format}"
     property_id: OcaPropertyID
@@ -32,7 +32,7 @@ class OcaManagerDefaultObjectNumbers(OCCBase):
     diagnostic_manager: OcaONo
 
 
-class OcaModelGUID:
+class OcaModelGUID(OCCBase):
     reserved: OcaBlobFixedLen.length(1)
     manufacturer_code: OcaBlobFixedLen.length(3)
     model_code: OcaBlobFixedLen.length(4)
@@ -52,6 +52,16 @@ class OcaComponent(Enum):
     Bootloader = 0
 
 
+OcaDeviceState = OcaUint16 # Bitset, see AES70-2 OcaDeviceState
+
+
+class OcaResetCause(Enum):
+    POWER_ON = 0
+    INTERNAL_ERROR = 1
+    UPGRADE = 2
+    EXTERNAL_REQUEST = 3
+
+
 class OcaPowerState(Enum):
     NONE = 0
     WORKING = 1
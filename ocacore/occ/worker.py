@@ -0,0 +1,153 @@
+from typing import ClassVar, Any, Optional
+from ocacore.occ.root import OcaRoot, Method
+from ocacore.occ.types import *
+from ocacore.occ.types.block_matrix import OcaMatrixCoordinate
+
+
+class OcaWorker(OcaRoot):
+    local_id: ClassVar[int] = 1
+    class_version: ClassVar[OcaClassVersionNumber] = OcaClassVersionNumber(2)
+    enabled: Optional[OcaBoolean]
+    label: Optional[OcaString]
+    owner: Optional[OcaONo]
+
+    @property
+    def local_properties(self) -> dict[OcaPropertyID, Any]:
+        return {
+            OcaPropertyID(def_level=2, property_index=1): self.enabled,
+            OcaPropertyID(def_level=2, property_index=3): self.label,
+            OcaPropertyID(def_level=2, property_index=4): self.owner
+        }
+
+    # Methods
+    get_enabled: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=2, method_index=1),
+        response_type=OcaBoolean
+    )
+    set_enabled: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=2, method_index=2),
+        kwargs={"enabled": OcaBoolean}
+    )
+    get_label: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=2, method_index=8),
+        response_type=OcaString
+    )
+    set_label: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=2, method_index=9),
+        kwargs={"label": OcaString}
+    )
+    get_owner: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=2, method_index=10),
+        response_type=OcaONo
+    )
+
+
+# = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = -
+
+class OcaActuator(OcaWorker):
+    local_id: ClassVar[int] = 1
+    class_version: ClassVar[OcaClassVersionNumber] = OcaClassVersionNumber(2)
+
+
+class OcaMute(OcaActuator):
+    local_id: ClassVar[int] = 2
+    class_version: ClassVar[OcaClassVersionNumber] = OcaClassVersionNumber(2)
+    state: Optional[OcaUint8] # OcaMuteState
+
+    state_property_id: ClassVar[OcaPropertyID] = OcaPropertyID(def_level=4, property_index=1)
+
+    @property
+    def local_properties(self) -> dict[OcaPropertyID, Any]:
+        return {
+            self.state_property_id: self.state
+        }
+
+    # Methods
+    get_state: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=4, method_index=1),
+        response_type=OcaUint8
+    )
+    set_state: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=4, method_index=2),
+        kwargs={"state": OcaUint8}
+    )
+
+
+class OcaGain(OcaActuator):
+    local_id: ClassVar[int] = 5
+    class_version: ClassVar[OcaClassVersionNumber] = OcaClassVersionNumber(2)
+    gain: Optional[OcaDB]
+
+    gain_property_id: ClassVar[OcaPropertyID] = OcaPropertyID(def_level=4, property_index=1)
+
+    @property
+    def local_properties(self) -> dict[OcaPropertyID, Any]:
+        return {
+            self.gain_property_id: self.gain
+        }
+
+    # Methods
+    get_gain: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=4, method_index=1),
+        response_type=OcaDB
+    )
+    set_gain: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=4, method_index=2),
+        kwargs={"gain": OcaDB}
+    )
+
+
+# = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = - = -
+
+class OcaMatrix(OcaWorker):
+    """
+    A rectangular array of identical member objects (AES70-2 OcaMatrix).
+    Members are addressed through the proxy object after selecting them with `set_current_xy`.
+    """
+    local_id: ClassVar[int] = 5
+    class_version: ClassVar[OcaClassVersionNumber] = OcaClassVersionNumber(2)
+    x_size: Optional[OcaMatrixCoordinate]
+    y_size: Optional[OcaMatrixCoordinate]
+    proxy: Optional[OcaONo]
+
+    @property
+    def local_properties(self) -> dict[OcaPropertyID, Any]:
+        return {
+            OcaPropertyID(def_level=3, property_index=3): self.x_size,
+            OcaPropertyID(def_level=3, property_index=4): self.y_size,
+            OcaPropertyID(def_level=3, property_index=6): self.proxy
+        }
+
+    # Methods
+    get_current_xy: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=1),
+        response_type=OcaMatrixCoordinate
+    )
+    set_current_xy: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=2),
+        kwargs={"x": OcaMatrixCoordinate, "y": OcaMatrixCoordinate}
+    )
+    get_size: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=3),
+        response_type=OcaMatrixCoordinate
+    )
+    get_member: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=7),
+        kwargs={"x": OcaMatrixCoordinate, "y": OcaMatrixCoordinate},
+        response_type=OcaONo
+    )
+    set_member: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=8),
+        kwargs={"x": OcaMatrixCoordinate, "y": OcaMatrixCoordinate, "member_ono": OcaONo}
+    )
+    get_proxy: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=9),
+        response_type=OcaONo
+    )
+    set_current_xy_lock: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=15),
+        kwargs={"x": OcaMatrixCoordinate, "y": OcaMatrixCoordinate}
+    )
+    unlock_current: ClassVar[Method] = Method(
+        method_id=OcaMethodID(def_level=3, method_index=16)
+    )
@@ -6,16 +6,26 @@ This contains the data structure definitions for OCP.1
 """
 
 from pydantic import BaseModel
-from typing import Any, Union, ClassVar, Optional, TypedDict
+from typing import Any, Union, ClassVar, NamedTuple, Optional, TypedDict
 from ocacore.occ.types import *
 from ocacore.utils import *
+from array import array
+from collections.abc import Callable, Iterator, Mapping, MutableMapping
 import enum
 import struct
+import sys
 
 # AES70-3 5.6.1.1
 SYNC_VAL = 0x3B
 
-HandleRegistry = dict[uint32, "Ocp1Command"]
+HandleRegistry = Mapping[int, "Ocp1Command"]
+HANDLE_SLOT_BITS: int = 16  # log2 of the most commands a `HandleTable` holds at once
+
+PDU_HEADER = struct.Struct("!BHIBH")  # Sync, protocol version, message size, message type, message count
+MESSAGE_SIZE = struct.Struct("!I")  # At offset 3 of a PDU
+MESSAGE_COUNT = struct.Struct("!H")  # At offset 8 of a PDU
+COMMAND_HEADER = struct.Struct("!IIIHH")  # Command size, handle, target ONo, method ID
+KEEPALIVE = struct.Struct("!BHIBHH")  # PDU header and heartbeat
 
 class MessageType(enum.Enum):
     COMMAND = 0
@@ -25,6 +35,21 @@ class MessageType(enum.Enum):
     KEEPALIVE = 4
 
 
+# PDU headers with an empty size and count, see `patch_header()`
+PDU_HEADER_TEMPLATES: dict[MessageType, bytes] = {
+    message_type: PDU_HEADER.pack(SYNC_VAL, 1, 0, message_type.value, 0) for message_type in MessageType
+}
+
+
+def patch_header(buffer: bytearray, offset: int, message_size: int, message_count: int) -> None:
+    """
+    Set the message size and count of the PDU whose sync byte is at `offset` of `buffer`, in place.
+    For PDUs built from `PDU_HEADER_TEMPLATES`, so only the fields that change are packed.
+    """
+    MESSAGE_SIZE.pack_into(buffer, offset + 3, message_size)
+    MESSAGE_COUNT.pack_into(buffer, offset + 8, message_count)
+
+
 class Ocp1PDU(BaseModel):
     """
     Base class for OCP1 Protocol Data Units (AES70-3 5.6)
@@ -54,10 +79,11 @@ class Ocp1Header(BaseModel):
     def _cast_message_type(val: MessageType) -> uint8:
         return uint8(val.value)
 
+    _struct: ClassVar[struct.Struct] = struct.Struct(_format)
+
     @property
     def bytes(self) -> struct.Struct:
-        return struct.pack(
-            self._format,
+        return self._struct.pack(
             self.protocol_version,
             self.message_size,
             self.message_type,
@@ -104,14 +130,34 @@ class Ocp1Parameters(BaseModel):
 
     @property
     def bytes(self) -> struct.Struct:
+        buffer = bytearray(self.encoded_size)
+        self.pack_into(buffer, 0)
+        return bytes(buffer)
+
+    @property
+    def encoded_size(self) -> int:
         if self.parameters is None:
-            return struct.pack("!B", 0)
-        parameters_format = "".join(p.value._format for p in self.parameters)
-        return struct.pack(f"!B{parameters_format}", self.parameter_count, *[p.value for p in self.parameters])
+            return 1
+        return 1 + sum(p.value.encoded_size for p in self.parameters)
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        """
+        Write the parameter count and parameters into `buffer` at `offset`
+
+        Returns:
+            int: The offset just past the parameters
+        """
+        buffer[offset] = self.parameter_count
+        offset += 1
+        for p in self.parameters or ():
+            offset = p.value.pack_into(buffer, offset)
+        return offset
     
     @classmethod
     def from_bytes(cls, data: bytes, parameter_type: OCCBase, *args, **kwargs) -> "Ocp1Parameters":
-        parameter_count = struct.unpack("!B", data[:1])
+        parameter_count, = struct.unpack("!B", data[:1])
+        if not parameter_count:
+            return cls(parameters=None)
         #TODO - Parameters will be variable length according to the invoked method.
         #       This needs a way of knowing what the format should be for us to unpack correctly.
         #       For now, let's just store the byte array and deal with it Soon(tm)...
@@ -124,7 +170,7 @@ class Ocp1Parameters(BaseModel):
         return len(self.parameters)
     
     def __sizeof__(self) -> int:
-        return len(self.bytes)
+        return self.encoded_size
 
 
 class Ocp1Command(BaseModel):
@@ -132,10 +178,11 @@ class Ocp1Command(BaseModel):
     The Command struct represents an OCP.1 command.
 
     Args:
-        handle:     Command handle, used to match commands to responses
-        target_ono: The target OCA object number
-        method_id:  The target OCA method ID
-        parameters: Parameters to pass to the invoked method
+        handle:         Command handle, used to match commands to responses
+        target_ono:     The target OCA object number
+        method_id:      The target OCA method ID
+        parameters:     Parameters to pass to the invoked method
+        parameter_data: Undecoded parameters, including the parameter count, of a received command
     """
     class Config:
         arbitrary_types_allowed = True
@@ -144,6 +191,7 @@ class Ocp1Command(BaseModel):
     target_ono: uint32
     method_id: OcaMethodID
     parameters: Ocp1Parameters
+    parameter_data: bytes = b""
     
     def response_type(self, device_model: ControlledDevice) -> str:
         """
@@ -166,18 +214,51 @@ class Ocp1Command(BaseModel):
 
     @property
     def bytes(self) -> struct.Struct:
-        param_len = self.parameters.__sizeof__()
-        return struct.pack(
-            "!3i4s" + (f"{param_len}s" if param_len else ""),
-            self.parameters.__sizeof__() + 16,
-            self.handle,
-            self.target_ono,
-            self.method_id.bytes,
-            self.parameters.bytes
+        buffer = bytearray(self.encoded_size)
+        self.pack_into(buffer, 0)
+        return bytes(buffer)
+
+    @property
+    def encoded_size(self) -> int:
+        """ Size of the encoded command, worked out without encoding it """
+        if self.parameter_data:
+            return COMMAND_HEADER.size + len(self.parameter_data)
+        return COMMAND_HEADER.size + self.parameters.encoded_size
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        """
+        Write the command into `buffer` at `offset`. The parameters are written first and the
+        header filled in after, so nothing is encoded twice.
+
+        Returns:
+            int: The offset just past the command
+        """
+        start = offset + COMMAND_HEADER.size
+        if self.parameter_data:
+            end = start + len(self.parameter_data)
+            buffer[start:end] = self.parameter_data
+        else:
+            end = self.parameters.pack_into(buffer, start)
+        COMMAND_HEADER.pack_into(
+            buffer, offset,
+            end - offset, self.handle, self.target_ono, self.method_id.def_level, self.method_id.method_index
         )
+        return end
     
     def __sizeof__(self) -> int:
-        return len(self.bytes)
+        return self.encoded_size
+
+    @classmethod
+    def from_bytes(cls, data: bytes, *args, **kwargs) -> "Ocp1Command":
+        # Parameter types depend on the invoked method, so they are left in `parameter_data`
+        command_size, handle, target_ono, def_level, method_index = COMMAND_HEADER.unpack_from(data)
+        return cls(
+            handle=handle,
+            target_ono=target_ono,
+            method_id=OcaMethodID(def_level=def_level, method_index=method_index),
+            parameters=Ocp1Parameters(parameters=None),
+            parameter_data=data[16:command_size]
+        )
 
 
 class Ocp1CommandPdu(Ocp1PDU):
@@ -187,22 +268,148 @@ class Ocp1CommandPdu(Ocp1PDU):
 
     @property
     def bytes(self) -> struct.Struct:
-        return struct.pack(
-            f"!B9s{sum([len(command.bytes) for command in self.commands])}s",
-            self.sync_val,
-            self.header.bytes,
-            *[c.bytes for c in self.commands]
+        buffer = bytearray(self.encoded_size)
+        self.pack_into(buffer, 0)
+        return bytes(buffer)
+
+    @property
+    def encoded_size(self) -> int:
+        return PDU_HEADER.size + sum(command.encoded_size for command in self.commands)
+
+    def pack_into(self, buffer: bytearray, offset: int) -> int:
+        """
+        Write the PDU into `buffer` at `offset`, which must have room for `encoded_size` bytes.
+        The message size in the header is the size actually written.
+
+        Returns:
+            int: The offset just past the PDU
+        """
+        end = offset + PDU_HEADER.size
+        for command in self.commands:
+            end = command.pack_into(buffer, end)
+        PDU_HEADER.pack_into(
+            buffer, offset,
+            self.sync_val, self.header.protocol_version, end - offset - 1, self.header.message_type, len(self.commands)
         )
+        return end
     
     @classmethod
     def from_bytes(cls, data: bytes, *args, **kwargs) -> "Ocp1CommandPdu":
-        pass
-        
-    
+        header = Ocp1Header.from_bytes(data[1:10])
+        data = data[10:] # strip header bytes
+
+        commands = []
+        offset = 0
+        for command_i in range(header.message_count):
+            command_size, = struct.unpack("!I", data[offset:offset + 4])
+            commands.append(Ocp1Command.from_bytes(data[offset:offset + command_size]))
+            offset += command_size
+
+        return cls(
+            header = header,
+            commands = commands
+        )
+
+
+
+class Ocp1Notification(BaseModel):
+    """
+    The Notification struct represents an OCP.1 event notification (AES70-3 5.6.3).
+
+    Args:
+        notification_size:  Size of this notification in bytes, including the size field
+        target_ono:         The subscriber object number given when subscribing
+        method_id:          The subscriber method ID given when subscribing
+        context:            Opaque context given when subscribing
+        event:              The emitting object and event ID
+        event_data:         Undecoded event data, see `property_changed()`
+    """
+    class Config:
+        arbitrary_types_allowed = True
 
-class Ocp1NotificationPdu:
-    def __init__(self):
-        raise NotImplementedError
+    _format: ClassVar[str] = "!IIHHBH"
+
+    notification_size: uint32
+    target_ono: uint32
+    method_id: OcaMethodID
+    context: bytes
+    event: OcaEvent
+    event_data: bytes
+
+    def property_changed(self, value_type: OCCBase) -> tuple[OcaPropertyID, OCCBase, OcaPropertyChangeType]:
+        """
+        Decode the event data of a PropertyChanged (1.1) event.
+        Only fixed-length `value_type`s are supported.
+
+        Returns:
+            tuple: The changed property ID, its new value and the change type
+        """
+        def_level, property_index = struct.unpack("!HH", self.event_data[:4])
+        value_end = 4 + struct.calcsize(f"!{value_type._format}")
+        return (
+            OcaPropertyID(def_level=def_level, property_index=property_index),
+            value_type.from_bytes(self.event_data[4:value_end]),
+            OcaPropertyChangeType(self.event_data[value_end])
+        )
+
+    @property
+    def bytes(self) -> struct.Struct:
+        return struct.pack(
+            self._format,
+            15 + len(self.context) + 8 + len(self.event_data),
+            self.target_ono,
+            self.method_id.def_level,
+            self.method_id.method_index,
+            2, # Context and event
+            len(self.context)
+        ) + self.context + self.event.bytes + self.event_data
+
+    @classmethod
+    def from_bytes(cls, data: bytes, *args, **kwargs) -> "Ocp1Notification":
+        (
+            notification_size,
+            target_ono,
+            def_level,
+            method_index,
+            parameter_count,
+            context_size
+        ) = struct.unpack(cls._format, data[:15])
+        event_start = 15 + context_size
+        emitter_ono, event_def_level, event_index = struct.unpack("!IHH", data[event_start:event_start + 8])
+        return cls(
+            notification_size=notification_size,
+            target_ono=target_ono,
+            method_id=OcaMethodID(def_level=def_level, method_index=method_index),
+            context=data[15:event_start],
+            event=OcaEvent(
+                emitter_ono=OcaONo(emitter_ono),
+                event_id=OcaEventID(def_level=OcaUint16(event_def_level), event_index=OcaUint16(event_index))
+            ),
+            event_data=data[event_start + 8:notification_size]
+        )
+
+
+class Ocp1NotificationPdu(Ocp1PDU):
+    sync_val: ClassVar[int] = SYNC_VAL
+    header: Ocp1Header
+    notifications: list[Ocp1Notification]
+
+    @classmethod
+    def from_bytes(cls, data: bytes, *args, **kwargs) -> "Ocp1NotificationPdu":
+        header = Ocp1Header.from_bytes(data[1:10])
+        data = data[10:] # strip header bytes
+
+        notifications = []
+        offset = 0
+        for notification_i in range(header.message_count):
+            notification = Ocp1Notification.from_bytes(data[offset:])
+            notifications.append(notification)
+            offset += notification.notification_size
+
+        return cls(
+            header = header,
+            notifications = notifications
+        )
 
 
 class Ocp1Response(BaseModel):
@@ -210,6 +417,8 @@ class Ocp1Response(BaseModel):
     handle: OcaUint32 # u32
     status_code: OcaStatus # OcaStatus
     parameters: Ocp1Parameters
+    parameter_data: bytes = b"" # Undecoded parameters, including the parameter count
+    values: Any = None # Compact decode of the parameters, see `unpack_responses()`
     
     @property
     def bytes(self) -> struct.Struct:
@@ -228,17 +437,27 @@ class Ocp1Response(BaseModel):
     
     @classmethod
     def from_bytes(cls, data: bytes, handle_registry: HandleRegistry, device_model: ControlledDevice, *args, **kwargs) -> "Ocp1Response":
-        response_size, handle, status_code = struct.unpack("!iiB", data[:9])
-        parameter_len = response_size - struct.calcsize("!iiB")
-        parameters_data = data[9:]
-        source_command = handle_registry[handle]
-        target_object = device_model.control_objects[source_command.target_ono]
-        response_type = target_object.methods[source_command.method_id].response_type
+        response_size, handle, status_code, parameter_count = struct.unpack("!IIBB", data[:10])
+        parameters_data = data[9:response_size]
+        # Responses without parameters (e.g. to setters) can be decoded without knowing the target object.
+        # If the target object or method is unknown, the parameters are left in `parameter_data`.
+        response_type = None
+        if parameter_count:
+            try:
+                source_command = handle_registry[handle]
+                target_object = device_model.control_objects[source_command.target_ono]
+                response_type = target_object.methods[source_command.method_id].response_type
+            except (KeyError, AttributeError):
+                pass
         return cls(
             response_size=OcaUint32(response_size),
             handle=OcaUint32(handle),
             status_code=OcaStatus(status_code),
-            parameters=Ocp1Parameters.from_bytes(data=parameters_data, parameter_type=response_type)
+            parameters=(
+                Ocp1Parameters(parameters=None) if response_type is None
+                else Ocp1Parameters.from_bytes(data=parameters_data, parameter_type=response_type)
+            ),
+            parameter_data=parameters_data
         )
 
 
@@ -266,9 +485,11 @@ class Ocp1ResponsePdu(Ocp1PDU):
         # The response format depends on the command it is responding to.
         # We can look this up using the `handle` number, bundled with the response.
         responses = []
+        offset = 0
         for response_i in range(header.message_count):
-            #TODO Handle multiple messages
-            responses.append(Ocp1Response.from_bytes(data, handle_registry=handle_registry, device_model=device_model))
+            response = Ocp1Response.from_bytes(data[offset:], handle_registry=handle_registry, device_model=device_model)
+            responses.append(response)
+            offset += int(response.response_size)
             
         return cls(
             sync_val = sync_val,
@@ -290,10 +511,12 @@ class Ocp1KeepAlivePdu(Ocp1PDU):
 
     @property
     def bytes(self) -> struct.Struct:
-        return struct.pack(
-            self._format,
+        return KEEPALIVE.pack(
             self.sync_val,
-            self.header.bytes,
+            self.header.protocol_version,
+            self.header.message_size,
+            self.header.message_type,
+            self.header.message_count,
             self.heartbeat
         )
     
@@ -307,6 +530,205 @@ class Ocp1KeepAlivePdu(Ocp1PDU):
         ) 
 
 
+class Ocp1PduTemplate(NamedTuple):
+    """
+    A PDU that never changes, such as a keepalive, encoded once. Queue it in place of the PDU
+    and it is sent as is.
+    """
+    pdu: Ocp1PDU
+    bytes: bytes
+
+    @classmethod
+    def of(cls, pdu: Ocp1PDU) -> "Ocp1PduTemplate":
+        return cls(pdu, bytes(pdu.bytes))
+
+    @property
+    def encoded_size(self) -> int:
+        return len(self.bytes)
+
+
+class Ocp1Encoder:
+    """
+    Encodes PDUs into one buffer, reused for every PDU of a session. Sizes are worked out
+    first without encoding, then the PDU is written once with `pack_into()`.
+
+    Args:
+        size:   Initial buffer size in bytes, grown when a larger PDU comes along
+    """
+    def __init__(self, size: int = 1500) -> None:
+        self.buffer: bytearray = bytearray(size)
+
+    def encode(self, pdu: Ocp1PDU) -> Union[memoryview, bytes]:
+        """
+        Returns:
+            memoryview: The encoded PDU, a view of the buffer only valid until the next `encode()`.
+                        Templates, and PDUs without `pack_into()`, are returned as their `bytes`.
+        """
+        if not hasattr(pdu, "pack_into"):
+            return pdu.bytes
+        size = pdu.encoded_size
+        if size > len(self.buffer):
+            # A new buffer, so views handed out earlier stay intact
+            self.buffer = bytearray(max(size, 2 * len(self.buffer)))
+        end = pdu.pack_into(self.buffer, 0)
+        return memoryview(self.buffer)[:end]
+
+
+class HandleTableFull(RuntimeError):
+    """ Every handle of a `HandleTable` is in use """
+
+
+class HandleTable(MutableMapping):
+    """
+    Handles of commands awaiting a response, and the commands, in a bounded number of slots.
+    Allocating, looking up and releasing a handle are O(1), and memory does not grow however
+    many commands a session sends. Slots are added as needed, up to `capacity`.
+
+    A handle is `generation << slot_bits | slot`, so the slot is found from its low bits. Each
+    time a slot is reused its generation moves on, wrapping within uint32, so a late response
+    to a released handle does not resolve to the slot's next command. Handles are never 0.
+
+    Handles from elsewhere, e.g. a capture, can be stored with `table[handle] = command`. Such
+    a handle takes over its slot from any other.
+
+    Args:
+        slot_bits:  log2 of `capacity`, the most handles in use at once
+    """
+    def __init__(self, slot_bits: int = HANDLE_SLOT_BITS) -> None:
+        if not 1 <= slot_bits <= 24:
+            raise ValueError(f"slot_bits must be 1 to 24, not {slot_bits}")
+        self.slot_bits: int = slot_bits
+        self.capacity: int = 1 << slot_bits
+        self._slot_mask: int = self.capacity - 1
+        self._generation_mask: int = 0xFFFFFFFF >> slot_bits
+        self._slots: int = 0
+        self._handles: array = array("I")  # last handle held by each slot
+        self._used: bytearray = bytearray()
+        self._commands: list[Optional["Ocp1Command"]] = []
+        # Free slots, as a stack. A slot taken by `__setitem__` stays listed and is skipped.
+        self._free: array = array("I")
+        self._listed: bytearray = bytearray()
+        self._size: int = 0
+
+    def _grow(self, slots: int) -> None:
+        added = min(self.capacity, max(slots, 2 * self._slots, 64)) - self._slots
+        self._handles.frombytes(bytes(4 * added))
+        self._used += bytes(added)
+        self._commands += [None] * added
+        self._free.extend(range(self._slots + added - 1, self._slots - 1, -1))
+        self._listed += b"\x01" * added
+        self._slots += added
+
+    def allocate(self, command: Optional["Ocp1Command"] = None) -> int:
+        """
+        Take a free slot, for `command` or one stored later with `table[handle] = command`
+
+        Raises:
+            HandleTableFull: if every slot is in use
+        """
+        free = self._free
+        while True:
+            if not free:
+                if self._slots == self.capacity:
+                    raise HandleTableFull(f"All {self.capacity} handles are in use")
+                self._grow(self._slots + 1)
+            slot = free.pop()
+            self._listed[slot] = 0
+            if not self._used[slot]:
+                break
+        generation = ((self._handles[slot] >> self.slot_bits) + 1) & self._generation_mask or 1
+        handle = generation << self.slot_bits | slot
+        self._handles[slot] = handle
+        self._used[slot] = 1
+        self._commands[slot] = command
+        self._size += 1
+        return handle
+
+    def release(self, handle: int) -> Optional["Ocp1Command"]:
+        """
+        Free `handle`'s slot. Stale and unknown handles are ignored.
+
+        Returns:
+            Ocp1Command: The command that held the handle, if any
+        """
+        slot = handle & self._slot_mask
+        if slot >= self._slots or not self._used[slot] or self._handles[slot] != handle:
+            return None
+        command = self._commands[slot]
+        self._commands[slot] = None
+        self._used[slot] = 0
+        self._size -= 1
+        if not self._listed[slot]:
+            self._listed[slot] = 1
+            self._free.append(slot)
+        return command
+
+    def reclaim(self, in_use: Callable[[int], bool]) -> int:
+        """
+        Release every handle holding a command for which `in_use(handle)` is false, e.g. the
+        commands whose responses never came. Handles allocated without a command yet are kept.
+
+        Returns:
+            int: The number of handles released
+        """
+        released = 0
+        for slot in range(self._slots):
+            if self._used[slot] and self._commands[slot] is not None and not in_use(self._handles[slot]):
+                self.release(self._handles[slot])
+                released += 1
+        return released
+
+    def get(self, handle: int, default: Any = None) -> Any:
+        slot = handle & self._slot_mask
+        if slot < self._slots and self._used[slot] and self._handles[slot] == handle:
+            return self._commands[slot]
+        return default
+
+    def __getitem__(self, handle: int) -> Optional["Ocp1Command"]:
+        slot = handle & self._slot_mask
+        if slot < self._slots and self._used[slot] and self._handles[slot] == handle:
+            return self._commands[slot]
+        raise KeyError(handle)
+
+    def __setitem__(self, handle: int, command: "Ocp1Command") -> None:
+        handle = int(handle)
+        if not 0 <= handle <= 0xFFFFFFFF:
+            raise ValueError(f"Handle {handle} is not a uint32")
+        slot = handle & self._slot_mask
+        if slot >= self._slots:
+            self._grow(slot + 1)
+        if not self._used[slot]:
+            self._used[slot] = 1
+            self._size += 1
+        self._handles[slot] = handle
+        self._commands[slot] = command
+
+    def __delitem__(self, handle: int) -> None:
+        if handle not in self:
+            raise KeyError(handle)
+        self.release(handle)
+
+    def __contains__(self, handle: object) -> bool:
+        if not isinstance(handle, int):
+            return False
+        slot = handle & self._slot_mask
+        return slot < self._slots and bool(self._used[slot]) and self._handles[slot] == handle
+
+    def __iter__(self) -> Iterator[int]:
+        for slot in range(self._slots):
+            if self._used[slot]:
+                yield self._handles[slot]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def clear(self) -> None:
+        """ Release every handle. Generations carry on, so handles from before stay stale. """
+        for slot in range(self._slots):
+            if self._used[slot]:
+                self.release(self._handles[slot])
+
+
 # == == == == ==
 
 PDU_CLASSES = {
@@ -334,3 +756,63 @@ def marshal(data: bytes, handle_registry: HandleRegistry, device_model: Controll
     header = Ocp1Header.from_bytes(data[header_offset : header_end])
     pdu_type = PDU_CLASSES[header.message_type]
     return pdu_type.from_bytes(data, handle_registry, device_model)
+
+
+
+# == == == == == Compact decoding
+
+# `struct` item formats that `array` can hold directly
+_ARRAY_TYPECODES = {
+    code: code for code in "bBhHiIlLqQfd"
+    if array(code).itemsize == struct.calcsize(f"!{code}")
+}
+
+
+def _unpack_values(data: bytes, offset: int, value_format: str) -> Any:
+    if not value_format.startswith("*"):
+        return struct.unpack_from(f"!{value_format}", data, offset)
+    # A uint16 count followed by that many items
+    item_format = value_format[1:]
+    count, = struct.unpack_from("!H", data, offset)
+    end = offset + 2 + count * struct.calcsize(f"!{item_format}")
+    if end > len(data):
+        raise struct.error(f"List of {count} items overruns the parameters")
+    if (typecode := _ARRAY_TYPECODES.get(item_format)) is not None:
+        items = array(typecode, data[offset + 2:end])
+        if sys.byteorder == "little":
+            items.byteswap()
+        return items
+    return tuple(struct.iter_unpack(f"!{item_format}", data[offset + 2:end]))
+
+
+def unpack_responses(data: bytes, formats: Optional[dict[int, str]] = None) -> list[tuple[int, int, bytes, Any]]:
+    """
+    Decode a response PDU into plain tuples rather than models, so that it can be decoded in
+    another process or thread and handed back cheaply.
+
+    Args:
+        data:       The whole PDU, including the sync byte
+        formats:    `struct` formats of the first parameter, by handle. A format starting with
+                    `*` reads a uint16 count followed by that many items, returned as an `array`
+                    when the item is a single number.
+
+    Returns:
+        list: `(handle, status, parameter_data, values)` per response, `values` is None without
+              a format or if the parameters do not match it
+    """
+    formats = formats or {}
+    message_count, = struct.unpack_from("!H", data, 8)
+    responses = []
+    offset = 10
+    for _ in range(message_count):
+        response_size, handle, status = struct.unpack_from("!IIB", data, offset)
+        parameter_data = data[offset + 9:offset + response_size]
+        values = None
+        if (value_format := formats.get(handle)) is not None and parameter_data[:1] not in (b"", b"\x00"):
+            try:
+                values = _unpack_values(parameter_data, 1, value_format)
+            except struct.error:
+                pass
+        responses.append((handle, status, parameter_data, values))
+        offset += response_size
+    return responses
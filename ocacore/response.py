@@ -0,0 +1,318 @@
+"""
+Filter responses
+----------------
+
+Magnitude and phase of a chain of EQ bands and classical filters, worked out locally from
+their parameters, so that a UI can draw curves without asking the device for transfer
+functions.
+
+Each stage is evaluated over the whole log-spaced frequency grid at once with NumPy. A
+`ResponseChain` keeps every stage's response and their sum in dB and degrees, so changing
+one band costs one stage's evaluation however long the chain is.
+
+Stages are analog prototypes. Given a sample rate, frequencies are warped as by the
+bilinear transform with the stage's frequency prewarped, which gives the response of the
+usual (RBJ cookbook) biquads a DSP runs.
+
+NumPy is only needed by this module, and is an optional dependency: `pip install aes70[response]`.
+
+Usage:
+    chain = ResponseChain(log_frequencies(20, 20000, 256), sample_rate=48000)
+    chain.append(ParametricEQ(OcaParametricEQShape.PEQ, 1000, gain=-6, q=2))
+    chain.append(ClassicalFilter(OcaClassicalFilterShape.LINKWITZ_RILEY, OcaFilterPassband.HIGH_PASS, 80, order=4))
+    chain[0] = chain[0]._replace(gain=-3)
+    draw(chain.frequencies, chain.magnitude, chain.phase)
+"""
+
+import functools
+import math
+from typing import Iterable, NamedTuple, Optional, Union
+
+import numpy as np
+
+from ocacore.occ.types.worker import OcaClassicalFilterShape, OcaFilterPassband, OcaParametricEQShape
+
+
+FLOOR_DB: float = -300.0  # dB, stands in for the zero of a notch so that sums stay finite
+
+
+def log_frequencies(start: float = 20.0, stop: float = 20000.0, points: int = 256) -> np.ndarray:
+    """ A grid of `points` frequencies in Hz, evenly spaced on a log scale """
+    return np.geomspace(start, stop, points)
+
+
+# == == == == == Stages
+
+class ParametricEQ(NamedTuple):
+    """
+    One band of a parametric EQ, as `OcaFilterParametric`
+
+    Args:
+        shape:      The band's shape. Tone controls are shelves.
+        frequency:  Centre or corner frequency in Hz
+        gain:       dB, for the peak and shelf shapes
+        q:          Quality factor, also the slope of shelves
+    """
+    shape: OcaParametricEQShape
+    frequency: float
+    gain: float = 0.0
+    q: float = math.sqrt(0.5)
+
+    def response(self, chain: "ResponseChain") -> np.ndarray:
+        shape = self.shape
+        if shape is OcaParametricEQShape.NONE:
+            return np.ones(len(chain.frequencies), complex)
+        s = chain.s(self.frequency)
+        s2 = s * s
+        q = self.q
+        a = 10 ** (self.gain / 40)
+        if shape is OcaParametricEQShape.PEQ:
+            return (s2 + s * (a / q) + 1) / (s2 + s / (a * q) + 1)
+        if shape in (
+            OcaParametricEQShape.LOW_SHELF,
+            OcaParametricEQShape.TONE_CONTROL_LOW_FIXED,
+            OcaParametricEQShape.TONE_CONTROL_LOW_SLIDING,
+        ):
+            slope = math.sqrt(a) / q
+            return a * (s2 + s * slope + a) / (a * s2 + s * slope + 1)
+        if shape in (
+            OcaParametricEQShape.HIGH_SHELF,
+            OcaParametricEQShape.TONE_CONTROL_HIGH_FIXED,
+            OcaParametricEQShape.TONE_CONTROL_HIGH_SLIDING,
+        ):
+            slope = math.sqrt(a) / q
+            return a * (a * s2 + s * slope + 1) / (s2 + s * slope + a)
+        denominator = s2 + s / q + 1
+        if shape is OcaParametricEQShape.LOW_PASS:
+            return 1 / denominator
+        if shape is OcaParametricEQShape.HIGH_PASS:
+            return s2 / denominator
+        if shape is OcaParametricEQShape.BAND_PASS:
+            return (s / q) / denominator
+        if shape is OcaParametricEQShape.ALL_PASS:
+            return (s2 - s / q + 1) / denominator
+        if shape is OcaParametricEQShape.NOTCH:
+            return (s2 + 1) / denominator
+        raise ValueError(f"Unsupported shape {shape}")
+
+
+class ClassicalFilter(NamedTuple):
+    """
+    A classical filter, as `OcaFilterClassical`
+
+    Args:
+        shape:      The filter family. Linkwitz-Riley orders must be even.
+        passband:   Which frequencies pass
+        frequency:  Corner frequency in Hz, or the centre for band pass and band reject
+        order:      Order of the low pass prototype, 1 to 24
+        parameter:  Passband ripple in dB for Chebyshev filters
+        q:          Quality factor for band pass and band reject
+    """
+    shape: OcaClassicalFilterShape
+    passband: OcaFilterPassband
+    frequency: float
+    order: int = 2
+    parameter: float = 1.0
+    q: float = 1.0
+
+    def response(self, chain: "ResponseChain") -> np.ndarray:
+        poles, gain = prototype(self.shape, self.order, self.parameter)
+        s = chain.s(self.frequency)
+        passband = self.passband
+        if passband is OcaFilterPassband.ALL_PASS:
+            # D(-s) / D(s), unit magnitude with the prototype's phase
+            return np.prod((-s[:, None] - poles) / (s[:, None] - poles), axis=1)
+        if passband is OcaFilterPassband.LOW_PASS:
+            x = s
+        elif passband is OcaFilterPassband.HIGH_PASS:
+            x = 1 / s
+        elif passband is OcaFilterPassband.BAND_PASS:
+            x = self.q * (s + 1 / s)
+        elif passband is OcaFilterPassband.BAND_REJECT:
+            x = 1 / (self.q * (s + 1 / s))
+        else:
+            raise ValueError(f"Unsupported passband {passband}")
+        return gain / np.prod(x[:, None] - poles, axis=1)
+
+
+class Tabulated(NamedTuple):
+    """
+    A response known at some frequencies, e.g. the contents of an `OcaTransferFunction` or
+    `OcaFrequencyResponse` read once from the device. Interpolated onto the grid on a log
+    frequency scale, and held constant beyond the first and last frequencies.
+
+    Args:
+        frequencies:    Hz, ascending
+        gain:           dB at each frequency
+        phase:          Degrees at each frequency, or None for zero phase
+    """
+    frequencies: tuple[float, ...]
+    gain: tuple[float, ...]
+    phase: Optional[tuple[float, ...]] = None
+
+    @classmethod
+    def from_frequency_response(cls, response: dict[float, float]) -> "Tabulated":
+        """ From an `OcaFrequencyResponse`, dB by frequency """
+        frequencies = tuple(sorted(response))
+        return cls(frequencies, tuple(response[frequency] for frequency in frequencies))
+
+    def response(self, chain: "ResponseChain") -> np.ndarray:
+        x = np.log(chain.frequencies)
+        points = np.log(self.frequencies)
+        magnitude = 10 ** (np.interp(x, points, self.gain) / 20)
+        if self.phase is None:
+            return magnitude.astype(complex)
+        return magnitude * np.exp(1j * np.deg2rad(np.interp(x, points, self.phase)))
+
+
+Stage = Union[ParametricEQ, ClassicalFilter, Tabulated]
+
+
+@functools.lru_cache(maxsize=256)
+def _prototype(shape: OcaClassicalFilterShape, order: int, parameter: float) -> tuple[tuple[complex, ...], float]:
+    n = order
+    if shape is OcaClassicalFilterShape.BUTTERWORTH:
+        poles = [complex(math.cos(angle), math.sin(angle)) for angle in (math.pi * (2 * k + n - 1) / (2 * n) for k in range(1, n + 1))]
+    elif shape is OcaClassicalFilterShape.LINKWITZ_RILEY:
+        if n % 2:
+            raise ValueError(f"Linkwitz-Riley filters have an even order, not {n}")
+        # Two Butterworth filters of half the order in series
+        half, _ = _prototype(OcaClassicalFilterShape.BUTTERWORTH, n // 2, parameter)
+        poles = list(half) * 2
+    elif shape is OcaClassicalFilterShape.BESSEL:
+        # Roots of the reverse Bessel polynomial, normalised for phase as by scipy.signal.bessel
+        coefficients = [math.factorial(2 * n - k) / (2 ** (n - k) * math.factorial(k) * math.factorial(n - k)) for k in range(n, -1, -1)]
+        poles = list(np.roots(coefficients) / coefficients[-1] ** (1 / n))
+    elif shape is OcaClassicalFilterShape.CHEBYSHEV:
+        epsilon = math.sqrt(10 ** (parameter / 10) - 1)
+        mu = math.asinh(1 / epsilon) / n
+        poles = [
+            complex(-math.sinh(mu) * math.sin(theta), math.cosh(mu) * math.cos(theta))
+            for theta in (math.pi * (2 * k - 1) / (2 * n) for k in range(1, n + 1))
+        ]
+    else:
+        raise ValueError(f"Unsupported shape {shape}")
+    gain = np.prod([-pole for pole in poles]).real
+    if shape is OcaClassicalFilterShape.CHEBYSHEV and n % 2 == 0:
+        # Even orders start the passband at the bottom of the ripple
+        gain /= math.sqrt(1 + epsilon ** 2)
+    return tuple(complex(pole) for pole in poles), float(gain)
+
+
+def prototype(shape: OcaClassicalFilterShape, order: int, parameter: float = 1.0) -> tuple[np.ndarray, float]:
+    """
+    Poles of the low pass prototype with a corner at 1 rad/s, and the gain for unity at DC
+
+    Raises:
+        ValueError: for an unsupported shape or order
+    """
+    if not 1 <= order <= 24:
+        raise ValueError(f"Order must be 1 to 24, not {order}")
+    poles, gain = _prototype(shape, order, parameter if shape is OcaClassicalFilterShape.CHEBYSHEV else 1.0)
+    return np.array(poles), gain
+
+
+# == == == == == Chain
+
+class ResponseChain:
+    """
+    The combined response of stages in series, updated in place as stages change
+
+    Args:
+        frequencies:    Hz, e.g. from `log_frequencies()`. Share one array between chains.
+        sample_rate:    Hz, to match digital filters, or None for analog responses. Every
+                        frequency must be below half of it.
+        stages:         Initial stages
+    """
+    def __init__(
+        self,
+        frequencies: Optional[np.ndarray] = None,
+        sample_rate: Optional[float] = None,
+        stages: Iterable[Stage] = (),
+    ) -> None:
+        self.frequencies: np.ndarray = log_frequencies() if frequencies is None else np.asarray(frequencies, float)
+        self.sample_rate: Optional[float] = sample_rate
+        if sample_rate is None:
+            self._axis: np.ndarray = self.frequencies
+        else:
+            if self.frequencies.max() >= sample_rate / 2:
+                raise ValueError(f"Frequencies must be below {sample_rate / 2} Hz")
+            self._axis = np.tan(np.pi * self.frequencies / sample_rate)
+        self._stages: list[Stage] = []
+        self._gains: list[np.ndarray] = []  # dB, by stage
+        self._phases: list[np.ndarray] = []  # degrees, by stage
+        self._gain: np.ndarray = np.zeros(len(self.frequencies))
+        self._phase: np.ndarray = np.zeros(len(self.frequencies))
+        for stage in stages:
+            self.append(stage)
+
+    def s(self, frequency: float) -> np.ndarray:
+        """ The grid as complex frequency, normalised to `frequency` """
+        if self.sample_rate is None:
+            return 1j * self._axis / frequency
+        return 1j * self._axis / math.tan(math.pi * frequency / self.sample_rate)
+
+    def _evaluate(self, stage: Stage) -> tuple[np.ndarray, np.ndarray]:
+        response = stage.response(self)
+        with np.errstate(divide="ignore"):
+            gain = np.maximum(20 * np.log10(np.abs(response)), FLOOR_DB)
+        return gain, np.angle(response, deg=True)
+
+    # Stages
+
+    def __len__(self) -> int:
+        return len(self._stages)
+
+    def __getitem__(self, index: int) -> Stage:
+        return self._stages[index]
+
+    def __setitem__(self, index: int, stage: Stage) -> None:
+        if stage == self._stages[index]:
+            return
+        gain, phase = self._evaluate(stage)
+        self._gain += gain - self._gains[index]
+        self._phase += phase - self._phases[index]
+        self._stages[index], self._gains[index], self._phases[index] = stage, gain, phase
+
+    def __delitem__(self, index: int) -> None:
+        self._gain -= self._gains.pop(index)
+        self._phase -= self._phases.pop(index)
+        del self._stages[index]
+
+    def append(self, stage: Stage) -> None:
+        gain, phase = self._evaluate(stage)
+        self._gain += gain
+        self._phase += phase
+        self._stages.append(stage)
+        self._gains.append(gain)
+        self._phases.append(phase)
+
+    def recompute(self) -> None:
+        """ Sum the stages afresh, dropping rounding error built up by many updates """
+        self._gain = np.sum(self._gains, axis=0) if self._gains else np.zeros(len(self.frequencies))
+        self._phase = np.sum(self._phases, axis=0) if self._phases else np.zeros(len(self.frequencies))
+
+    # Response
+
+    @property
+    def magnitude(self) -> np.ndarray:
+        """ dB at each frequency, a read-only view updated as stages change """
+        view = self._gain.view()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def phase(self) -> np.ndarray:
+        """ Degrees at each frequency, wrapped to [-180, 180) """
+        return (self._phase + 180) % 360 - 180
+
+    def stage_magnitude(self, index: int) -> np.ndarray:
+        """ dB of one stage, e.g. to draw a band's own curve """
+        return self._gains[index]
+
+    def complex_response(self) -> np.ndarray:
+        return 10 ** (self._gain / 20) * np.exp(1j * np.deg2rad(self._phase))
+
+    def frequency_response(self) -> dict[float, float]:
+        """ The magnitude as an `OcaFrequencyResponse`, dB by frequency """
+        return dict(zip(self.frequencies.tolist(), self._gain.tolist()))
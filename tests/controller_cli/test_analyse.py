@@ -0,0 +1,98 @@
+import struct
+from controller_cli.analyse import TrafficReport, analyse, analyse_records
+from controller_cli.connect import OCAController, KEEPALIVE_PDU
+from ocacomms.OcaCapture import CaptureReader, CaptureWriter, PcapReader, RecordKind
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain
+
+
+def response_pdu(*handles: int) -> bytes:
+    responses = b"".join(struct.pack("!IIBB", 10, handle, 0, 0) for handle in handles)
+    return bytes([SYNC_VAL]) + struct.pack("!HIBH", 1, 9 + len(responses), MessageType.RESPONSE.value, len(handles)) + responses
+
+
+def notification_pdu(emitter_ono: int) -> bytes:
+    event_data = struct.pack("!HHfB", 4, 1, -6.0, 1)
+    notification = struct.pack("!IHHBH", 1055, 1, 1, 2, 0) + struct.pack("!IHH", emitter_ono, 1, 1) + event_data
+    notification = struct.pack("!I", 4 + len(notification)) + notification
+    return bytes([SYNC_VAL]) + struct.pack("!HIBH", 1, 9 + len(notification), MessageType.NOTIFICATION.value, 1) + notification
+
+
+def write_capture(path: str) -> None:
+    controller = OCAController("amp-1", "udp")
+    with CaptureWriter(path) as capture:
+        amp = capture.add_stream("amp-1")
+        for i in range(20):
+            commands = [controller.make_command(0x1000 + i % 2, OcaGain.get_gain) for _ in range(3)]
+            capture.write(RecordKind.SENT, amp, controller.create_commandrrq(commands).bytes)
+            capture.write(RecordKind.RECEIVED, amp, response_pdu(*(int(command.handle) for command in commands)))
+            # Two PDUs in one datagram
+            capture.write(RecordKind.RECEIVED, amp, notification_pdu(0x2000) + KEEPALIVE_PDU.bytes)
+        capture.write(RecordKind.RECEIVED, amp, response_pdu(9999))
+        capture.write(RecordKind.RECEIVED, amp, b"\x00garbage")
+
+
+def check(report: TrafficReport) -> None:
+    assert report.pdus == 82
+    assert report.errors == 1
+    assert report.message_types == {"COMMAND_RESPONSE_REQUIRED": 20, "RESPONSE": 21, "NOTIFICATION": 20, "KEEPALIVE": 20}
+    assert report.objects[("amp-1", 0x1000)].count == 30
+    assert report.methods[("amp-1", 0x2000, "event 1.1")].count == 20
+    assert report.latency[("amp-1", 0x1001, "4.1")].count == 30
+    assert report.unmatched == 1
+    assert not report.pending
+
+
+def test_analyse(tmp_path) -> None:
+    path = str(tmp_path / "traffic.ocap")
+    write_capture(path)
+    report = analyse(path)
+    check(report)
+    assert report.top(report.objects, 1)[0][0] in (("amp-1", 0x2000), ("amp-1", 0x1000))
+
+
+def test_analyse_chunks(tmp_path) -> None:
+    path = str(tmp_path / "traffic.ocap")
+    write_capture(path)
+    reader = CaptureReader(path)
+    # Small enough that commands and their responses land in different chunks
+    chunks = reader.chunks(100)
+    assert len(chunks) > 10
+    report = TrafficReport()
+    for start, end in chunks:
+        report.merge(analyse_records(CaptureReader(path, start, end, reader.streams)))
+    report.finish()
+    check(report)
+
+    check(analyse(path, workers=2, chunk_size=1000))
+
+
+def test_pcap(tmp_path) -> None:
+    def frame(source: int, destination: int, payload: bytes) -> bytes:
+        # Host 1 is the controller on an ephemeral port, host 2 the device on port 50000
+        ports = {1: 55123, 2: 50000}
+        udp = struct.pack("!HHHH", ports[source], ports[destination], 8 + len(payload), 0) + payload
+        ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(udp), 0, 0x4000, 64, 17, 0, bytes([10, 0, 0, source]), bytes([10, 0, 0, destination])) + udp
+        return b"\xff" * 12 + b"\x08\x00" + ip
+
+    controller = OCAController("amp-1", "udp")
+    command = controller.make_command(0x1000, OcaGain.get_gain)
+    frames = [
+        (1.0, frame(1, 2, KEEPALIVE_PDU.bytes)),
+        (1.5, frame(1, 2, controller.create_commandrrq([command]).bytes)),
+        (1.75, frame(2, 1, response_pdu(int(command.handle)))),
+        (2.0, frame(2, 1, KEEPALIVE_PDU.bytes)),
+    ]
+    path = tmp_path / "traffic.pcap"
+    with open(path, "wb") as file:
+        file.write(struct.pack("<IHHiIII", 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1))
+        for timestamp, data in frames:
+            file.write(struct.pack("<IIII", int(timestamp), int(timestamp % 1 * 1e6), len(data), len(data)) + data)
+
+    reader = PcapReader(str(path))
+    assert [record.kind for record in reader] == [RecordKind.SENT, RecordKind.SENT, RecordKind.RECEIVED, RecordKind.RECEIVED]
+    assert list(reader.streams.values()) == ["10.0.0.2:50000"]
+
+    report = analyse(str(path))
+    assert report.pdus == 4
+    assert report.latency[("10.0.0.2:50000", 0x1000, "4.1")].mean == 0.25
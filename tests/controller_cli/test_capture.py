@@ -0,0 +1,78 @@
+import asyncio
+import struct
+from controller_cli.capture import replay
+from controller_cli.connect import OCAClientProtocol, OCAController, KEEPALIVE_PDU
+from controller_cli.metrics import Metrics
+from ocacomms.OcaCapture import CaptureReader, CaptureWriter, RecordKind
+from ocacore.ocp1 import *
+from ocacore.occ.manager import OcaDeviceManager
+
+
+class Transport:
+    def __init__(self) -> None:
+        self.sent = []
+
+    def sendto(self, data: bytes) -> None:
+        self.sent.append(data)
+
+
+def response_pdu(handle: int) -> bytes:
+    return bytes([SYNC_VAL]) + struct.pack("!HIBH", 1, 9 + 10, MessageType.RESPONSE.value, 1) + struct.pack("!IIBB", 10, handle, 0, 0)
+
+
+def test_protocol_records_traffic(tmp_path) -> None:
+    path = str(tmp_path / "traffic.ocap")
+    with CaptureWriter(path) as capture:
+        stream = capture.add_stream("amp-1")
+        protocol = OCAClientProtocol(asyncio.Queue(), capture, stream)
+        protocol.connection_made(Transport())
+        protocol.send(KEEPALIVE_PDU.bytes)
+        protocol.datagram_received(KEEPALIVE_PDU.bytes, ("127.0.0.1", 50000))
+
+    reader = CaptureReader(path)
+    records = list(reader)
+    assert [record.kind for record in records] == [RecordKind.SENT, RecordKind.RECEIVED]
+    assert all(record.data == KEEPALIVE_PDU.bytes for record in records)
+    assert reader.stream_name(stream) == "amp-1"
+
+    # A record cut short by an interrupted writer is ignored
+    with open(path, "ab") as file:
+        file.write(b"\x00" * 5)
+    assert len(list(CaptureReader(path))) == 2
+
+
+def test_replay(tmp_path) -> None:
+    path = str(tmp_path / "traffic.ocap")
+    controller = OCAController("amp-1", "udp")
+    command = controller.make_command(1, OcaDeviceManager.get_serial_number)
+    with CaptureWriter(path) as capture:
+        amp, dsp = capture.add_stream("amp-1"), capture.add_stream("dsp-1")
+        capture.write(RecordKind.SENT, amp, controller.create_commandrrq([command]).bytes)
+        capture.write(RecordKind.RECEIVED, amp, response_pdu(int(command.handle)))
+        capture.write(RecordKind.RECEIVED, amp, KEEPALIVE_PDU.bytes)
+        capture.write(RecordKind.RECEIVED, dsp, b"\x3b\x00")
+
+    metrics = Metrics()
+    controllers = asyncio.run(replay(path, metrics=metrics))
+    assert [c.device_name for c in controllers.values()] == ["amp-1", "dsp-1"]
+    amp_controller, dsp_controller = controllers.values()
+    snapshot = metrics.snapshot()
+    labels = amp_controller.metric_labels
+    assert dict(labels)["device"] == "amp-1"
+    assert snapshot["oca_packets_sent_total"][labels] == 1
+    assert snapshot["oca_packets_received_total"][labels] == 2
+    assert snapshot["oca_rtt_seconds"][labels]["count"] == 1
+    # The recorded command was registered, then its handle released by the response
+    assert int(command.handle) not in amp_controller.handle_registry
+    assert amp_controller.session_active.is_set()
+    assert dsp_controller._decode_errors.value == 1
+
+
+def test_command_round_trip() -> None:
+    controller = OCAController("amp-1", "udp")
+    command = controller.make_command(0x1001, OcaDeviceManager.get_serial_number)
+    pdu = controller.create_commandrrq([command, command])
+    decoded = Ocp1CommandPdu.from_bytes(pdu.bytes)
+    assert len(decoded.commands) == 2
+    assert decoded.commands[0].target_ono == 0x1001
+    assert decoded.bytes == pdu.bytes
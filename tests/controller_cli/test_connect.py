@@ -0,0 +1,348 @@
+import asyncio
+import socket
+import struct
+import time
+import pytest
+from zeroconf import ServiceInfo
+from controller_cli.connect import OCAController, State, start_controllers, KEEPALIVE_TEMPLATE
+from controller_cli.keepalive import KeepaliveScheduler
+from ocacomms.OcaDiscoveryCache import OcaDiscoveryCache, CachedService
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain, OcaMute
+from tests.helpers import CommandDevice, KeepaliveDevice
+
+
+class Session:
+    def __init__(self) -> None:
+        self.due = 0
+
+    def keepalive_due(self) -> None:
+        self.due += 1
+
+
+def test_scheduler_spreads_sessions() -> None:
+    async def main() -> None:
+        scheduler = KeepaliveScheduler(interval=0.05, slots=10)
+        sessions = [Session() for _ in range(25)]
+        for session in sessions:
+            scheduler.register(session)
+        assert sorted(len(slot) for slot in scheduler.wheel) == [2] * 5 + [3] * 5
+        await asyncio.sleep(0.12)
+        for session in sessions:
+            scheduler.unregister(session)
+        assert len(scheduler) == 0
+        assert all(session.due >= 1 for session in sessions)
+
+    asyncio.run(main())
+
+
+def test_keepalive_skipped_with_traffic() -> None:
+    controller = OCAController("Device", "udp")
+    controller.last_receive = controller.last_transmit = time.monotonic()
+    controller.keepalive_due()
+    assert controller.transmit_queue.empty()
+
+    controller.last_receive = 0
+    controller.keepalive_due()
+    assert controller.transmit_queue.get_nowait() is KEEPALIVE_TEMPLATE
+    assert controller.unanswered_keepalives == 1
+
+
+def test_unanswered_keepalives_disconnect() -> None:
+    controller = OCAController("Device", "udp")
+    controller.state = State.CONNECTED
+    for _ in range(4):
+        controller.keepalive_due()
+    assert controller.state is State.DISCONNECTED
+
+
+def test_lost_session_keeps_queued_handles() -> None:
+    async def main() -> None:
+        controller = OCAController("Device", "udp")
+        sent = controller.make_command(0x1001, OcaGain.get_gain)
+        controller.create_commandrrq([sent])
+        future = controller._pending[int(sent.handle)] = asyncio.get_running_loop().create_future()
+        queued = controller.make_command(0x1001, OcaGain.set_gain, OcaDB(-3.0))
+        await controller.send_commands([queued])
+
+        controller._stop_session()
+        assert isinstance(future.exception(), ConnectionError)
+        assert controller.handle_registry.get(int(sent.handle)) is None
+        # Still goes out once the session is back, so its response must find it
+        assert controller.handle_registry.get(int(queued.handle)) is queued
+
+    asyncio.run(main())
+
+
+def test_silent_device_is_retried() -> None:
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        # Never answers, like a device that is switched off
+        transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, local_addr=("127.0.0.1", 0))
+        scheduler = KeepaliveScheduler(interval=0.05, slots=10)
+        controller = OCAController("Device", "udp", scheduler=scheduler, endpoint=transport.get_extra_info("sockname"))
+        states = []
+        controller.state_handlers.append(states.append)
+        session = asyncio.create_task(controller.start())
+        await asyncio.sleep(1.5)
+        # Unanswered keepalives end the first attempt, and the backoff leads to another
+        assert states[:3] == [State.CONNECTING, State.DISCONNECTED, State.CONNECTING]
+        controller._stop_session()
+        session.cancel()
+        transport.close()
+
+    asyncio.run(main())
+
+
+def test_parallel_warm_start(tmp_path) -> None:
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(KeepaliveDevice, local_addr=("127.0.0.1", 0))
+        port = transport.get_extra_info("sockname")[1]
+
+        cache = OcaDiscoveryCache(str(tmp_path / "discovery.json"))
+        controllers = []
+        for i in range(8):
+            cache.entries[f"udp/device-{i}"] = CachedService(
+                name=f"device-{i}", protocol="udp", addresses=["127.0.0.1"], port=port, updated=time.time()
+            )
+            controllers.append(OCAController(f"device-{i}", "udp", discovery_cache=cache))
+            controllers[-1]._revalidate = lambda: asyncio.sleep(0)  # No mDNS here
+
+        tasks = await start_controllers(controllers, max_concurrent=3, timeout=2)
+        assert all(controller.state is State.CONNECTED for controller in controllers)
+        for controller in controllers:
+            controller._stop_session()
+        for task in tasks:
+            task.cancel()
+        transport.close()
+
+    asyncio.run(main())
+
+
+def test_slow_bring_up_keeps_its_slot() -> None:
+    async def main() -> None:
+        starting = []
+        most = 0
+
+        def slow_start(controller: OCAController):
+            async def start() -> None:
+                nonlocal most
+                starting.append(controller)
+                most = max(most, len(starting))
+                await asyncio.sleep(0.05)
+                starting.remove(controller)
+                controller.connected.set()
+                await asyncio.Event().wait()
+            return start
+
+        controllers = [OCAController(f"device-{i}", "udp", endpoint=("127.0.0.1", 1)) for i in range(6)]
+        for controller in controllers:
+            controller.start = slow_start(controller)
+        tasks = await start_controllers(controllers, max_concurrent=2, timeout=0.01)
+        # Each timed out, yet no more than two were ever connecting at once
+        assert most == 2
+        await asyncio.sleep(0.1)
+        assert all(controller.connected.is_set() for controller in controllers)
+        for task in tasks:
+            task.cancel()
+
+    asyncio.run(main())
+
+
+class MovedDiscovery:
+    """ Stand-in for `OcaDiscovery` that sees the device at `port` once `moved` is set """
+    def __init__(self, port: int) -> None:
+        self.port = port
+        self.moved = asyncio.Event()
+
+    async def wait_for(self, device_name: str, timeout: float = None) -> ServiceInfo:
+        await self.moved.wait()
+        return ServiceInfo(
+            "_oca._udp.local.", f"{device_name}._oca._udp.local.",
+            addresses=[socket.inet_aton("127.0.0.1")], port=self.port,
+        )
+
+
+def test_own_browsers_are_closed(monkeypatch, tmp_path) -> None:
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        transport, _ = await loop.create_datagram_endpoint(lambda: CommandDevice({}), local_addr=("127.0.0.1", 0))
+        browsers = []
+
+        class Browser:
+            """ Stand-in for `OcaDiscovery` that finds only "device" """
+            def __init__(self, protocol: str) -> None:
+                self.closed = False
+                browsers.append(self)
+
+            async def start(self) -> None:
+                pass
+
+            async def close(self) -> None:
+                self.closed = True
+
+            async def wait_for(self, device_name: str, timeout: float = None) -> ServiceInfo:
+                if device_name != "device":
+                    await asyncio.Event().wait()
+                return ServiceInfo(
+                    "_oca._udp.local.", f"{device_name}._oca._udp.local.",
+                    addresses=[socket.inet_aton("127.0.0.1")], port=transport.get_extra_info("sockname")[1],
+                )
+
+        monkeypatch.setattr("controller_cli.connect.OcaDiscovery", Browser)
+        found = OCAController("device", "udp")
+        session = asyncio.create_task(found.start())
+        await asyncio.wait_for(found.connected.wait(), 2)
+        assert found.discovery is None and browsers[0].closed
+
+        missing = OCAController("missing", "udp")
+        missing_session = asyncio.create_task(missing.start())
+        await asyncio.sleep(0.01)
+        assert not browsers[1].closed
+        await missing.close()
+        assert browsers[1].closed
+
+        # Revalidating a warm start uses a browser of its own, and closes it when done
+        cache = OcaDiscoveryCache(str(tmp_path / "discovery.json"))
+        cache.entries["udp/device"] = CachedService(
+            name="device", protocol="udp", addresses=["127.0.0.1"],
+            port=transport.get_extra_info("sockname")[1], updated=time.time()
+        )
+        warm = OCAController("device", "udp", discovery_cache=cache)
+        warm_session = asyncio.create_task(warm.start())
+        await asyncio.wait_for(warm.connected.wait(), 2)
+        await warm.revalidate_task
+        assert warm.discovery is None and browsers[2].closed
+
+        for controller in (found, warm):
+            await controller.close()
+        for task in (session, missing_session, warm_session):
+            task.cancel()
+        transport.close()
+
+    asyncio.run(main())
+
+
+def test_shared_browsers_belong_to_the_caller(monkeypatch) -> None:
+    async def main() -> None:
+        started = []
+
+        class Browser:
+            """ Stand-in for `OcaDiscovery` that never finds anything """
+            def __init__(self, protocol: str) -> None:
+                self.closed = False
+                started.append(self)
+
+            async def start(self) -> None:
+                pass
+
+            async def close(self) -> None:
+                self.closed = True
+
+            async def wait_for(self, device_name: str, timeout: float = None) -> ServiceInfo:
+                await asyncio.Event().wait()
+
+        monkeypatch.setattr("controller_cli.connect.OcaDiscovery", Browser)
+        controllers = [OCAController(f"device-{i}", "udp") for i in range(3)]
+        browsers = {}
+        tasks = await start_controllers(controllers, timeout=0.01, browsers=browsers)
+        assert started == [browsers["udp"]]
+        assert all(controller.discovery is browsers["udp"] for controller in controllers)
+        for controller in controllers:
+            await controller.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.sleep(0)
+        # Left for the caller to close
+        assert not browsers["udp"].closed
+
+    asyncio.run(main())
+
+
+def test_revalidation_follows_moved_device(tmp_path) -> None:
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        old, _ = await loop.create_datagram_endpoint(lambda: CommandDevice({}), local_addr=("127.0.0.1", 0))
+        new, _ = await loop.create_datagram_endpoint(lambda: CommandDevice({}), local_addr=("127.0.0.1", 0))
+        old_port, new_port = (transport.get_extra_info("sockname")[1] for transport in (old, new))
+
+        cache = OcaDiscoveryCache(str(tmp_path / "discovery.json"))
+        cache.entries["udp/device"] = CachedService(
+            name="device", protocol="udp", addresses=["127.0.0.1"], port=old_port, updated=time.time()
+        )
+        discovery = MovedDiscovery(new_port)
+        controller = OCAController("device", "udp", discovery_cache=cache, discovery=discovery)
+        states = []
+        controller.state_handlers.append(states.append)
+        session = asyncio.create_task(controller.start())
+        await asyncio.wait_for(controller.connected.wait(), 2)
+        assert controller.device_endpoint == ("127.0.0.1", old_port)
+
+        states.clear()
+        discovery.moved.set()
+        await controller.revalidate_task
+        await asyncio.wait_for(controller.connected.wait(), 2)
+        assert states == [State.CONNECTING, State.CONNECTED]
+        assert controller.device_endpoint == ("127.0.0.1", new_port)
+        await cache.flush()
+        assert OcaDiscoveryCache(cache.path).get("device", "udp").port == new_port
+
+        controller._stop_session()
+        session.cancel()
+        old.close()
+        new.close()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("replaced", [False, True])
+def test_reconnect_resyncs_changed_reads(tmp_path, replaced: bool) -> None:
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        device = CommandDevice({
+            (0x1, "3.2"): b"\x01\x00\x01\x02\x03\x04\x05\x06\x07",
+            (0x1, "3.3"): b"\x01\x00\x03ABC",
+            (0x1000, "4.1"): b"\x01" + struct.pack("!f", -6.0),
+            (0x1001, "4.1"): b"\x01\x02",
+        })
+        transport, _ = await loop.create_datagram_endpoint(lambda: device, local_addr=("127.0.0.1", 0))
+
+        cache = OcaDiscoveryCache(str(tmp_path / "discovery.json"))
+        cache.entries["udp/device"] = CachedService(
+            name="device", protocol="udp", addresses=["127.0.0.1"],
+            port=transport.get_extra_info("sockname")[1], updated=time.time()
+        )
+        controller = OCAController("device", "udp", discovery_cache=cache)
+        controller._revalidate = lambda: asyncio.sleep(0)  # No mDNS here
+        resynced = []
+        controller.resync_handlers.append(lambda command, response: resynced.append(command.target_ono))
+
+        session = asyncio.create_task(controller.start())
+        await asyncio.wait_for(controller.connected.wait(), 2)
+        await controller.probe_task
+        await controller.subscribe(0x1000)
+        await controller.read(0x1000, OcaGain.get_gain)
+        await controller.read(0x1001, OcaMute.get_state)
+
+        device.values[(0x1000, "4.1")] = b"\x01" + struct.pack("!f", -3.0)
+        if replaced:
+            device.values[(0x1, "3.3")] = b"\x01\x00\x03XYZ"
+        device.received.clear()
+        controller._state_transition(State.DISCONNECTED)
+        await asyncio.wait_for(controller.connected.wait(), 2)
+
+        assert device.received.count((0x4, "3.1")) == 1
+        assert controller._rtt_seconds.count >= 4
+        if replaced:
+            assert resynced == []
+            assert controller.read_cache == {}
+        else:
+            assert resynced == [0x1000]
+            assert (0x1001, "4.1") in device.received
+
+        controller._stop_session()
+        session.cancel()
+        transport.close()
+
+    asyncio.run(main())
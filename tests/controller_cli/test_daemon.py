@@ -0,0 +1,86 @@
+import asyncio
+import struct
+from controller_cli.connect import State
+from controller_cli.daemon import ControllerDaemon, DaemonClient, DaemonError, OP_CALL, frame, pack_call, unpack_call
+from ocacomms.OcaDeviceServer import OcaDeviceServer
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain
+from tests.helpers import KeepaliveDevice, gain
+
+
+def test_call_framing() -> None:
+    commands = [(0x1001, OcaGain.get_gain.method_id, b"\x00"), (0x1001, OcaGain.set_gain.method_id, b"\x01" + OcaDB(-3.0).bytes)]
+    assert unpack_call(pack_call("dsp", commands)) == ("dsp", commands)
+    assert frame(7, OP_CALL, b"abc") == struct.pack("!IIB", 8, 7, OP_CALL) + b"abc"
+    try:
+        unpack_call(pack_call("dsp", commands)[:-1])
+    except struct.error:
+        pass
+    else:
+        raise AssertionError("Truncated call accepted")
+
+
+def test_daemon_serves_warm_sessions(tmp_path) -> None:
+    async def main() -> None:
+        server = OcaDeviceServer([gain(0x1001, -6.0), gain(0x1002, 0.0)])
+        transport = await server.start("127.0.0.1", 0)
+        daemon = ControllerDaemon(str(tmp_path / "daemon.sock"), connect_timeout=2)
+        daemon.add_device("dsp", endpoint=transport.get_extra_info("sockname"))
+        await daemon.start()
+
+        async with DaemonClient(daemon.socket_path) as client:
+            status, data = await client.get("dsp", 0x1001, OcaGain.get_gain)
+            assert status == OcaStatus.OK
+            assert OcaDB.from_bytes(data[1:]) == -6.0
+
+            # Concurrent calls share the connection and the session
+            results = await asyncio.gather(
+                client.set("dsp", 0x1002, OcaGain.set_gain, OcaDB(-1.5)),
+                client.batch("dsp", [(0x1001, OcaGain.get_role), (0x9999, OcaGain.get_gain)]),
+            )
+            assert results[0] == OcaStatus.OK
+            assert results[1] == [(OcaStatus.OK, b"\x01" + OcaString("Gain 4097").bytes), (OcaStatus.BadONo, b"\x00")]
+            assert float(server.objects[0x1002].gain) == -1.5
+            assert len(server.sessions) == 1
+
+            devices = await client.status()
+            assert devices["dsp"][0].name == "CONNECTED"
+
+            try:
+                await client._send(99)
+            except DaemonError as error:
+                assert "Unknown op" in str(error)
+            else:
+                raise AssertionError("Unknown op accepted")
+
+        await daemon.close()
+        server.close()
+
+    asyncio.run(main())
+
+
+def test_call_fails_when_session_drops(tmp_path) -> None:
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        # Answers keepalives but never commands
+        transport, _ = await loop.create_datagram_endpoint(KeepaliveDevice, local_addr=("127.0.0.1", 0))
+        daemon = ControllerDaemon(str(tmp_path / "daemon.sock"), connect_timeout=2)
+        daemon.add_device("dsp", endpoint=transport.get_extra_info("sockname"))
+        await daemon.start()
+
+        async with DaemonClient(daemon.socket_path) as client:
+            await client.status()
+            call = asyncio.ensure_future(client.get("dsp", 0x1001, OcaGain.get_gain))
+            await asyncio.sleep(0.1)
+            daemon.controllers["dsp"]._state_transition(State.DISCONNECTED)
+            try:
+                await asyncio.wait_for(call, 1)
+            except DaemonError as error:
+                assert "lost" in str(error)
+            else:
+                raise AssertionError("Call answered after the session was lost")
+
+        await daemon.close()
+        transport.close()
+
+    asyncio.run(main())
@@ -0,0 +1,155 @@
+import asyncio
+import struct
+import pytest
+from typing import Awaitable, Container
+from controller_cli.connect import OCAController
+from controller_cli.matrix import CrosspointMatrix, WILDCARD
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain, OcaMatrix, OcaMute
+
+
+MATRIX_ONO = 0x1000
+PROXY_ONO = 0x1001
+
+
+async def answered(controller: OCAController, operation: Awaitable, reject: Container[int] = ()) -> list[Ocp1CommandPdu]:
+    """
+    Run `operation`, answering each PDU it sends as a device would, failing the commands
+    to the object numbers in `reject`
+
+    Returns:
+        list: The PDUs sent
+    """
+    pdus = []
+
+    async def device() -> None:
+        while True:
+            pdu = await controller.transmit_queue.get()
+            pdus.append(pdu)
+            for command in pdu.commands:
+                status = OcaStatus.ProcessingFailed if int(command.target_ono) in reject else OcaStatus.OK
+                controller._dispatch_response(Ocp1Response.construct(
+                    response_size=OcaUint32(10), handle=OcaUint32(int(command.handle)), status_code=status,
+                    parameters=Ocp1Parameters(parameters=None),
+                ), 0.0)
+
+    task = asyncio.create_task(device())
+    try:
+        await operation
+    finally:
+        task.cancel()
+    return pdus
+
+
+def sent_commands(controller: OCAController, operation: Awaitable, reject: Container[int] = ()) -> list[Ocp1Command]:
+    async def main() -> list[Ocp1CommandPdu]:
+        return await answered(controller, operation, reject)
+    return [command for pdu in asyncio.run(main()) for command in pdu.commands]
+
+
+def calls(commands: list[Ocp1Command]) -> list[tuple]:
+    return [
+        (cmd.target_ono, str(cmd.method_id), [p.value.value for p in cmd.parameters.parameters])
+        for cmd in commands
+    ]
+
+
+def test_unchanged_cells_are_not_sent() -> None:
+    controller = OCAController("Device", "udp")
+    matrix = CrosspointMatrix(controller, MATRIX_ONO, PROXY_ONO, 4, 4)
+    assert sent_commands(controller, matrix.set({(1, 1): 0.0})) == []
+
+
+def test_single_cell_via_proxy() -> None:
+    controller = OCAController("Device", "udp")
+    matrix = CrosspointMatrix(controller, MATRIX_ONO, PROXY_ONO, 4, 4)
+    assert calls(sent_commands(controller, matrix.set({(2, 3): -6.0}))) == [
+        (MATRIX_ONO, "3.2", [2, 3]),
+        (PROXY_ONO, "4.2", [-6.0]),
+    ]
+    assert matrix[2, 3] == -6.0
+
+
+def test_single_cell_via_member() -> None:
+    controller = OCAController("Device", "udp")
+    members = list(range(0x2000, 0x2000 + 16))
+    matrix = CrosspointMatrix(controller, MATRIX_ONO, PROXY_ONO, 4, 4, members=members)
+    assert calls(sent_commands(controller, matrix.set({(2, 3): -6.0}))) == [(members[14], "4.2", [-6.0])]
+
+
+@pytest.mark.parametrize(
+    "changes, expected",
+    [
+        (
+            {(x, 1): -10.0 for x in range(4)},
+            [(MATRIX_ONO, "3.2", [WILDCARD, 1]), (PROXY_ONO, "4.2", [-10.0])]
+        ),
+        (
+            {(2, y): -10.0 for y in range(4)},
+            [(MATRIX_ONO, "3.2", [2, WILDCARD]), (PROXY_ONO, "4.2", [-10.0])]
+        ),
+        (
+            {(x, y): -10.0 for x in range(4) for y in range(4)},
+            [(MATRIX_ONO, "3.2", [WILDCARD, WILDCARD]), (PROXY_ONO, "4.2", [-10.0])]
+        ),
+    ]
+)
+def test_uniform_changes_use_wildcards(changes: dict, expected: list) -> None:
+    controller = OCAController("Device", "udp")
+    matrix = CrosspointMatrix(controller, MATRIX_ONO, PROXY_ONO, 4, 4)
+    assert calls(sent_commands(controller, matrix.set(changes))) == expected
+
+
+def test_load_coalesces_into_few_pdus() -> None:
+    controller = OCAController("Device", "udp")
+    matrix = CrosspointMatrix(controller, MATRIX_ONO, PROXY_ONO, 128, 128, member_class=OcaMute)
+    grid = [[OcaMuteState.MUTED if x == y else OcaMuteState.UNMUTED for x in range(128)] for y in range(128)]
+    sent = matrix.load(grid)
+
+    async def main() -> list[Ocp1CommandPdu]:
+        nonlocal sent
+        load = asyncio.ensure_future(sent)
+        pdus = await answered(controller, load)
+        sent = load.result()
+        return pdus
+
+    pdus = asyncio.run(main())
+    assert sum(len(pdu.commands) for pdu in pdus) == sent
+    assert len(pdus) < sent / 2
+    for pdu in pdus:
+        assert len(pdu.bytes) <= 1400
+        # SetCurrentXY is always followed by its proxy setter in the same PDU
+        assert str(pdu.commands[-1].method_id) != "3.2"
+    assert matrix[5, 5] == OcaMuteState.MUTED.value
+    assert matrix[5, 6] == OcaMuteState.UNMUTED.value
+
+
+def test_rejected_cells_keep_their_value() -> None:
+    controller = OCAController("Device", "udp")
+    members = list(range(0x2000, 0x2000 + 4))
+    matrix = CrosspointMatrix(controller, MATRIX_ONO, PROXY_ONO, 2, 2, members=members)
+    sent_commands(controller, matrix.set({(0, 0): -3.0, (1, 1): -9.0}), reject={members[3]})
+    assert matrix[0, 0] == -3.0
+    assert matrix[1, 1] == 0.0
+
+    # A rejected proxy setter leaves the whole row unchanged
+    sent_commands(controller, matrix.set({(0, 1): -6.0, (1, 1): -6.0}), reject={PROXY_ONO})
+    assert (matrix[0, 1], matrix[1, 1]) == (0.0, 0.0)
+    assert not controller._pending and len(controller.handle_registry) == 0
+
+
+def test_notification_updates_member_value() -> None:
+    controller = OCAController("Device", "udp")
+    members = list(range(0x2000, 0x2000 + 4))
+    matrix = CrosspointMatrix(controller, MATRIX_ONO, PROXY_ONO, 2, 2, members=members)
+
+    event_data = struct.pack("!HHfB", 4, 1, -12.5, 1)
+    body = struct.pack("!IHHBH", 0x55, 1, 1, 2, 0) + struct.pack("!IHH", members[3], 1, 1) + event_data
+    notification = struct.pack("!I", len(body) + 4) + body
+    data = struct.pack("!BHIBH", SYNC_VAL, 1, 9 + len(notification), 2, 1) + notification
+
+    pdu = marshal(data, controller.handle_registry, controller.device_model)
+    for notification in pdu.notifications:
+        for handler in controller.notification_handlers:
+            handler(notification)
+    assert matrix[1, 1] == -12.5
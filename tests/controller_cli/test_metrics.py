@@ -0,0 +1,82 @@
+import asyncio
+import gc
+import weakref
+from controller_cli.connect import OCAController
+from controller_cli.metrics import Metrics, Histogram, serve_prometheus
+
+
+def test_histogram_buckets() -> None:
+    histogram = Histogram((0.001, 0.01, 0.1))
+    for value in (0.0005, 0.005, 0.005, 0.05, 1.0):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.count == 5
+    assert histogram.quantile(0.5) == 0.01
+    assert histogram.quantile(1.0) == float("inf")
+
+
+def test_families_share_children_by_labels() -> None:
+    metrics = Metrics()
+    a = metrics.counter("packets_total", "Packets").labels(device="a")
+    assert metrics.counter("packets_total", "Packets").labels(device="a") is a
+    a.inc()
+    a.inc(2)
+    metrics.counter("packets_total", "Packets").labels(device="b").inc()
+    assert metrics.snapshot()["packets_total"] == {(("device", "a"),): 3, (("device", "b"),): 1}
+
+    metrics.remove(device="a")
+    assert metrics.snapshot()["packets_total"] == {(("device", "b"),): 1}
+
+
+def test_prometheus_text() -> None:
+    metrics = Metrics()
+    metrics.counter("packets_total", "Packets").labels(device="a").inc(3)
+    metrics.gauge("queue_depth", "Queue").labels(device="a").set_function(lambda: 7)
+    metrics.histogram("rtt_seconds", "RTT", (0.01, 0.1)).labels(device="a").observe(0.05)
+    text = metrics.prometheus()
+    assert '# TYPE packets_total counter' in text
+    assert 'packets_total{device="a"} 3' in text
+    assert 'queue_depth{device="a"} 7' in text
+    assert 'rtt_seconds_bucket{device="a",le="0.01"} 0' in text
+    assert 'rtt_seconds_bucket{device="a",le="0.1"} 1' in text
+    assert 'rtt_seconds_bucket{device="a",le="+Inf"} 1' in text
+    assert 'rtt_seconds_count{device="a"} 1' in text
+
+
+def test_prometheus_endpoint() -> None:
+    async def main() -> bytes:
+        metrics = Metrics()
+        metrics.counter("packets_total", "Packets").labels().inc()
+        server = await serve_prometheus(metrics, port=0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.0\r\n\r\n")
+        response = await reader.read()
+        server.close()
+        return response
+
+    response = asyncio.run(main())
+    assert response.startswith(b"HTTP/1.0 200 OK")
+    assert response.endswith(b"packets_total 1\n")
+
+
+def test_prometheus_escapes_label_values() -> None:
+    metrics = Metrics()
+    metrics.counter("packets_total", "Packets").labels(device='Stage "A"\\B\nC').inc()
+    assert 'packets_total{device="Stage \\"A\\"\\\\B\\nC"} 1' in metrics.prometheus()
+
+
+def test_controllers_are_not_kept_by_the_registry() -> None:
+    metrics = Metrics()
+    controller = OCAController("Amp-1", "udp", metrics=metrics)
+    assert metrics.snapshot()["oca_pending_requests"] == {controller.metric_labels: 0}
+    # Another controller for the same device, e.g. a script next to the daemon, keeps its own series
+    other = OCAController("Amp-1", "udp", metrics=metrics)
+    asyncio.run(controller.close())
+    assert metrics.snapshot()["oca_pending_requests"] == {other.metric_labels: 0}
+    asyncio.run(other.close())
+    assert all(not values for values in metrics.snapshot().values())
+
+    collected = weakref.ref(OCAController("Amp-2", "udp", metrics=metrics))
+    gc.collect()
+    assert collected() is None
@@ -0,0 +1,79 @@
+import asyncio
+import struct
+import time
+from controller_cli.connect import OCAController
+from controller_cli.offload import DecodeOffload
+from ocacomms.OcaDiscoveryCache import OcaDiscoveryCache, CachedService
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain
+from tests.helpers import CommandDevice
+
+CURVE = [float(i) / 4 for i in range(1000)]
+CURVE_PARAMETERS = b"\x01" + struct.pack(f"!H{len(CURVE)}f", len(CURVE), *CURVE)
+GET_CURVE = OcaMethodID(def_level=4, method_index=9)
+
+
+def response_pdu(*responses: tuple[int, bytes]) -> bytes:
+    body = b"".join(struct.pack("!IIB", 9 + len(parameters), handle, 0) + parameters for handle, parameters in responses)
+    return bytes([SYNC_VAL]) + struct.pack("!HIBH", 1, 9 + len(body), MessageType.RESPONSE.value, len(responses)) + body
+
+
+def test_unpack_responses() -> None:
+    data = response_pdu((1, CURVE_PARAMETERS), (2, b"\x01" + struct.pack("!f", -6.0)), (3, b"\x00"), (4, b"\x01\x00"))
+    responses = unpack_responses(data, {1: "*f", 2: "f", 3: "f", 4: "*f"})
+    assert [(handle, status) for handle, status, _, _ in responses] == [(1, 0), (2, 0), (3, 0), (4, 0)]
+    assert list(responses[0][3]) == CURVE
+    assert responses[0][2] == CURVE_PARAMETERS
+    assert responses[1][3] == (-6.0,)
+    assert responses[2][3] is None  # No parameters
+    assert responses[3][3] is None  # Too short for the format
+
+
+def test_controller_offloads_large_responses(tmp_path) -> None:
+    async def main() -> None:
+        loop = asyncio.get_running_loop()
+        device = CommandDevice({(0x1000, "4.9"): CURVE_PARAMETERS, (0x1000, "4.1"): b"\x01" + struct.pack("!f", -6.0)})
+        transport, _ = await loop.create_datagram_endpoint(lambda: device, local_addr=("127.0.0.1", 0))
+        cache = OcaDiscoveryCache(str(tmp_path / "discovery.json"))
+        cache.entries["udp/device"] = CachedService(
+            name="device", protocol="udp", addresses=["127.0.0.1"],
+            port=transport.get_extra_info("sockname")[1], updated=time.time()
+        )
+        offload = DecodeOffload(threshold=1024, threads=True)
+        offload.formats[GET_CURVE] = "*f"
+        controller = OCAController("device", "udp", discovery_cache=cache, offload=offload)
+        controller._revalidate = lambda: asyncio.sleep(0)  # No mDNS here
+        session = asyncio.create_task(controller.start())
+        await asyncio.wait_for(controller.connected.wait(), 2)
+
+        curve = await controller.request(
+            Ocp1Command(handle=controller.next_handle, target_ono=0x1000, method_id=GET_CURVE, parameters=Ocp1Parameters(parameters=None))
+        )
+        assert curve.status_code == OcaStatus.OK
+        assert list(curve.values) == CURVE
+        assert curve.parameter_data == CURVE_PARAMETERS
+        assert controller._offloaded.value == 1
+
+        # Small enough to decode on the loop
+        gain = await controller.request(controller.make_command(0x1000, OcaGain.get_gain))
+        assert gain.parameter_data == b"\x01" + struct.pack("!f", -6.0)
+        assert controller._offloaded.value == 1
+
+        controller._stop_session()
+        session.cancel()
+        transport.close()
+        offload.close()
+
+    asyncio.run(main())
+
+
+def test_process_pool() -> None:
+    async def main() -> None:
+        offload = DecodeOffload(threshold=0)
+        try:
+            (_, _, _, values), = await offload.decode(response_pdu((7, CURVE_PARAMETERS)), {7: "*f"})
+        finally:
+            offload.close()
+        assert list(values) == CURVE
+
+    asyncio.run(main())
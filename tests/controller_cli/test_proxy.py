@@ -0,0 +1,102 @@
+import asyncio
+from controller_cli.connect import OCAController, State
+from controller_cli.proxy import OcaProxy
+from ocacomms.OcaDeviceServer import OcaDeviceServer
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain
+from tests.helpers import connect, gain
+
+
+async def client(endpoint: tuple[str, int], name: str) -> tuple[OCAController, asyncio.Task]:
+    controller = OCAController(name, "udp", endpoint=endpoint)
+    session = asyncio.create_task(controller.start())
+    await asyncio.wait_for(controller.connected.wait(), 2)
+    return controller, session
+
+
+def test_proxy_shares_one_session(tmp_path) -> None:
+    async def main() -> None:
+        device = OcaDeviceServer([gain(0x1001, -6.0), gain(0x1002, 0.0)])
+        upstream, upstream_session = await connect(device, tmp_path)
+        proxy = OcaProxy(upstream, cache_ttl=10)
+        endpoint = (await proxy.start("127.0.0.1", 0)).get_extra_info("sockname")
+        clients = [await client(endpoint, f"ui-{i}") for i in range(3)]
+        await asyncio.sleep(0.05)  # Let the clients' own model probes settle
+        forwarded = proxy.forwarded
+
+        # Concurrent identical reads become one upstream read, later ones come from the cache
+        get_gain = [ui.request(ui.make_command(0x1001, OcaGain.get_gain)) for ui, _ in clients]
+        responses = await asyncio.gather(*get_gain)
+        assert [OcaDB.from_bytes(response.parameter_data[1:]) for response in responses] == [-6.0] * 3
+        assert proxy.forwarded - forwarded == 1
+        ui, _ = clients[0]
+        response = await ui.request(ui.make_command(0x1001, OcaGain.get_gain))
+        assert OcaDB.from_bytes(response.parameter_data[1:]) == -6.0
+        assert proxy.forwarded - forwarded == 1 and proxy.cache_hits >= 1
+
+        # A setter goes through and invalidates the cached read
+        ui, _ = clients[1]
+        response = await ui.request(ui.make_command(0x1001, OcaGain.set_gain, OcaDB(-2.0)))
+        assert response.status_code == OcaStatus.OK
+        assert float(device.objects[0x1001].gain) == -2.0
+        ui, _ = clients[2]
+        response = await ui.request(ui.make_command(0x1001, OcaGain.get_gain))
+        assert OcaDB.from_bytes(response.parameter_data[1:]) == -2.0
+        unknown = await ui.request(ui.make_command(0x9999, OcaGain.get_gain))
+        assert unknown.status_code == OcaStatus.BadONo
+
+        # Every client is notified through the proxy's single upstream subscription
+        received = [[] for _ in clients]
+        for (ui, _), notifications in zip(clients, received):
+            ui.notification_handlers.append(notifications.append)
+            assert (await ui.subscribe(0x1002)).status_code == OcaStatus.OK
+        await asyncio.sleep(0.05)
+        device.set_property(0x1002, "gain", OcaDB(-4.5))
+        await asyncio.sleep(0.05)
+        for notifications in received:
+            assert [notification.property_changed(OcaDB)[1] for notification in notifications] == [-4.5]
+        assert len(device.sessions) == 1
+        assert sum(len(subscribers) for subscribers in device.subscriptions.values()) == 1
+
+        for ui, session in clients:
+            ui._stop_session()
+            session.cancel()
+        proxy.close()
+        upstream._stop_session()
+        upstream_session.cancel()
+        device.close()
+
+    asyncio.run(main())
+
+
+def test_proxy_drops_cached_reads_when_upstream_drops(tmp_path) -> None:
+    async def main() -> None:
+        device = OcaDeviceServer([gain(0x1001, -6.0)])
+        upstream, upstream_session = await connect(device, tmp_path)
+        proxy = OcaProxy(upstream, cache_ttl=10)
+        endpoint = (await proxy.start("127.0.0.1", 0)).get_extra_info("sockname")
+        ui, session = await client(endpoint, "ui")
+        assert (await ui.subscribe(0x1001)).status_code == OcaStatus.OK
+        await asyncio.sleep(0.05)
+
+        # Subscribed reads stay cached until a notification says otherwise...
+        response = await ui.request(ui.make_command(0x1001, OcaGain.get_gain))
+        assert OcaDB.from_bytes(response.parameter_data[1:]) == -6.0
+        assert [expires for _, _, expires in proxy.cache.values()] == [None]
+
+        # ...which cannot arrive while the upstream session is down
+        upstream._state_transition(State.DISCONNECTED)
+        assert not proxy.cache
+        device.set_property(0x1001, "gain", OcaDB(-1.0))
+        await asyncio.wait_for(upstream.connected.wait(), 5)
+        response = await ui.request(ui.make_command(0x1001, OcaGain.get_gain))
+        assert OcaDB.from_bytes(response.parameter_data[1:]) == -1.0
+
+        ui._stop_session()
+        session.cancel()
+        proxy.close()
+        await upstream.close()
+        upstream_session.cancel()
+        device.close()
+
+    asyncio.run(main())
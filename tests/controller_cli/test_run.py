@@ -0,0 +1,53 @@
+import asyncio
+from controller_cli.run import BatchRunner, parse_operation
+from ocacomms.OcaDeviceServer import OcaDeviceServer
+from ocacore.ocp1 import *
+from tests.helpers import connect, gain
+
+
+def test_parse_operation() -> None:
+    assert parse_operation(1, "  # comment") is None
+    assert parse_operation(2, "") is None
+    operation = parse_operation(3, "'Main Gain' OcaGain.set_gain -6.5")
+    assert (operation.target, operation.method, operation.arguments) == ("Main Gain", "OcaGain.set_gain", ("-6.5",))
+
+
+def test_runner_pipelines_script(tmp_path) -> None:
+    async def main() -> None:
+        server = OcaDeviceServer([gain(0x1000 + i, 0.0) for i in range(200)])
+        controller, session = await connect(server, tmp_path)
+        sent = []
+        send_commands = controller.send_commands
+
+        async def record(commands, *args):
+            sent.append(len(commands))
+            assert len(controller._pending) <= 50
+            await send_commands(commands, *args)
+
+        controller.send_commands = record
+
+        script = ["# venue setup", ""]
+        script += [f"{0x1000 + i:#x} OcaGain.set_gain {-i / 2}" for i in range(200)]
+        script += ["Master OcaGain.get_gain", "0x1001 OcaGain.get_role", "0x9999 OcaGain.get_gain", "0x1000 OcaGain.nope"]
+        runner = BatchRunner(controller, roles={"Master": 0x1007}, window=50, batch=16)
+        results = [result async for result in runner.run(script)]
+
+        assert len(results) == 204
+        by_line = {result.operation.line: result for result in results}
+        assert all(by_line[line].ok for line in range(3, 203))
+        assert [float(server.objects[0x1000 + i].gain) for i in range(200)] == [-i / 2 for i in range(200)]
+        assert str(by_line[203]).split("\t") == ["203", "OK", "-3.5"]
+        assert str(by_line[204]) == "204\tOK\tGain 4097"
+        assert by_line[205].response.status_code == OcaStatus.BadONo
+        assert "no method 'nope'" in by_line[206].error
+        # Coalesced, and never more than the window in flight
+        assert len(sent) < 50 and max(sent) <= 16
+        assert controller._pending == {}
+        # Every handle was released once answered, the model probes' as well
+        assert len(controller.handle_registry) == 0
+
+        controller._stop_session()
+        session.cancel()
+        server.close()
+
+    asyncio.run(main())
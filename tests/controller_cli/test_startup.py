@@ -0,0 +1,45 @@
+import pathlib
+import subprocess
+import sys
+
+ROOT = pathlib.Path(__file__).parents[2]
+LOAD_CLI = (
+    "import importlib.util; "
+    f"spec = importlib.util.spec_from_file_location('aes70', {str(ROOT / '__init__.py')!r}); "
+    "spec.loader.exec_module(importlib.util.module_from_spec(spec))"
+)
+
+
+def import_profile(statement: str) -> tuple[set[str], int]:
+    """
+    Run `statement` in a fresh interpreter with `-X importtime`
+
+    Returns:
+        tuple: Every module imported, and the total import time in microseconds
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement], cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    modules, total = set(), 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.add(name.strip())
+        if not name.startswith("  "):  # Top level imports only, the rest are included in these
+            total += int(cumulative)
+    return modules, total
+
+
+def test_cli_imports_commands_lazily() -> None:
+    cli_modules, cli_time = import_profile(LOAD_CLI)
+    assert not {"zeroconf", "pydantic", "ocacore.ocp1", "controller_cli.connect"} & cli_modules
+
+    connect_modules, connect_time = import_profile("import controller_cli.connect")
+    assert "zeroconf" not in connect_modules  # Only once discovery starts
+    assert "ocacore.occ.types.media" not in connect_modules
+    # Relative rather than absolute, to hold on slow machines too
+    assert cli_time < connect_time / 2
+
+    discover_modules, _ = import_profile("import controller_cli.discover")
+    assert not {"zeroconf", "pydantic"} & discover_modules
@@ -0,0 +1,152 @@
+import asyncio
+import pickle
+from controller_cli.connect import State
+from controller_cli.supervisor import FRAME, ControllerSupervisor, ShardRing, _Worker, read_message
+from ocacomms.OcaDeviceServer import OcaDeviceServer
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain
+from tests.helpers import gain
+
+
+def test_shard_ring() -> None:
+    names = [f"device-{i}" for i in range(1000)]
+    ring = ShardRing(4)
+    shards = [ring.shard_for(name) for name in names]
+    assert all(150 < shards.count(shard) < 350 for shard in range(4))
+    assert ring.shard_for("Device-1") == ring.shard_for("device-1")
+
+    # Adding a worker only moves devices onto it
+    grown = ShardRing(5)
+    moved = [name for name, shard in zip(names, shards) if grown.shard_for(name) != shard]
+    assert all(grown.shard_for(name) == 4 for name in moved)
+    assert len(moved) < 350
+
+
+def test_supervisor() -> None:
+    async def main() -> None:
+        servers = {}
+        supervisor = ControllerSupervisor(workers=2)
+        for i in range(4):
+            server = OcaDeviceServer([gain(0x1001, -float(i))])
+            transport = await server.start("127.0.0.1", 0)
+            name = f"dsp-{i}"
+            servers[name] = server
+            supervisor.add_device(name, ("127.0.0.1", transport.get_extra_info("sockname")[1]))
+        assert {controller.shard for controller in supervisor.controllers.values()} == {0, 1}
+
+        await supervisor.start()
+        try:
+            controllers = list(supervisor.controllers.values())
+            await asyncio.wait_for(asyncio.gather(*(controller.connected.wait() for controller in controllers)), 10)
+            assert all(controller.state is State.CONNECTED for controller in controllers)
+
+            # Same API as a local controller
+            dsp = supervisor.controller("dsp-3")
+            set_gain = dsp.make_command(0x1001, OcaGain.set_gain, OcaDB(-1.5))
+            response = await dsp.request(set_gain)
+            assert response.status_code == OcaStatus.OK
+            assert response.handle == set_gain.handle
+            assert float(servers["dsp-3"].objects[0x1001].gain) == -1.5
+            read = await dsp.read(0x1001, OcaGain.get_gain)
+            assert OcaDB.from_bytes(read.parameter_data[1:]) == -1.5
+
+            notifications = []
+            dsp.notification_handlers.append(notifications.append)
+            assert (await dsp.subscribe(0x1001)).status_code == OcaStatus.OK
+            servers["dsp-3"].set_property(0x1001, "gain", OcaDB(-9.0))
+            for _ in range(100):
+                if notifications:
+                    break
+                await asyncio.sleep(0.02)
+            assert notifications[0].property_changed(OcaDB)[1] == -9.0
+
+            results = await supervisor.fan_out(0x1001, OcaGain.get_gain)
+            values = {name: OcaDB.from_bytes(result.parameter_data[1:]) for name, result in results.items()}
+            assert values == {"dsp-0": 0.0, "dsp-1": -1.0, "dsp-2": -2.0, "dsp-3": -9.0}
+        finally:
+            await supervisor.close()
+            for server in servers.values():
+                server.close()
+
+    asyncio.run(main())
+
+
+class Writer:
+    """ Stand-in for the `asyncio.StreamWriter` of one side of the worker connection """
+    def __init__(self) -> None:
+        self.data = b""
+
+    def is_closing(self) -> bool:
+        return False
+
+    def write(self, data: bytes) -> None:
+        self.data += data
+
+    def close(self) -> None:
+        pass
+
+
+def frame(message: tuple) -> bytes:
+    data = pickle.dumps(message)
+    return FRAME.pack(len(data)) + data
+
+
+def messages(data: bytes) -> list:
+    async def read() -> list:
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        result = []
+        while not reader.at_eof():
+            result.append(await read_message(reader))
+        return result
+
+    return asyncio.run(read())
+
+
+def test_worker_answers_unpicklable_results() -> None:
+    class Controller:
+        async def read(self, *args) -> object:
+            return lambda: None
+
+        async def subscribe(self, *args) -> object:
+            raise ValueError(lambda: None)
+
+    worker = _Worker(0, "", "udp", None)
+    worker.writer = Writer()
+    worker.controllers["dsp"] = Controller()
+    asyncio.run(worker.call(1, "dsp", "read", (), {}))
+    asyncio.run(worker.call(2, "dsp", "subscribe", (), {}))
+    replies = messages(worker.writer.data)
+    assert [reply[:2] for reply in replies] == [("error", 1), ("error", 2)]
+    assert all(isinstance(reply[2], RuntimeError) for reply in replies)
+
+
+def test_supervisor_survives_unreadable_replies(monkeypatch) -> None:
+    async def main() -> None:
+        monkeypatch.setattr("controller_cli.supervisor.T_CALL_S", 0.05)
+        supervisor = ControllerSupervisor(workers=1)
+        reader = asyncio.StreamReader()
+        accept = asyncio.create_task(supervisor._accept(reader, Writer()))
+        reader.feed_data(frame(("hello", 0, 1)))
+        await asyncio.sleep(0)
+
+        dsp = supervisor.add_device("dsp", ("127.0.0.1", 1))
+        lost = asyncio.ensure_future(dsp.request(dsp.make_command(0x1001, OcaGain.get_gain), timeout=0))
+        answered = asyncio.ensure_future(dsp.send_commands([]))
+        await asyncio.sleep(0)
+        # The reply to the first call cannot be unpickled, the one to the second still gets through
+        unreadable = b"\x80\x05not a pickle"
+        reader.feed_data(FRAME.pack(len(unreadable)) + unreadable + frame(("result", 1, None)))
+        assert await asyncio.wait_for(answered, 1) is None
+        try:
+            await lost
+        except asyncio.TimeoutError:
+            pass
+        else:
+            raise AssertionError("Unanswered call did not time out")
+
+        reader.feed_eof()
+        await accept
+
+    asyncio.run(main())
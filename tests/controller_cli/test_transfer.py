@@ -0,0 +1,73 @@
+import asyncio
+from controller_cli.transfer import FIRMWARE_MANAGER_ONO, TransferError, open_image, upload_many
+from ocacomms.OcaDeviceServer import OcaDeviceServer, OcaMethodError
+from ocacore.ocp1 import *
+from ocacore.occ.manager import OcaFirmwareManager
+from tests.helpers import connect
+
+
+def firmware_server(fail: dict[int, OcaStatus]) -> tuple[OcaDeviceServer, dict]:
+    """ A device storing uploaded chunks by ID, failing each chunk in `fail` once """
+    device = {"steps": [], "chunks": {}}
+
+    def step(name: str):
+        return lambda *arguments: device["steps"].append(name)
+
+    def add_image_data(id: OcaUint32, image_data: OcaBlob) -> None:
+        if (status := fail.pop(int(id), None)) is not None:
+            raise OcaMethodError(status)
+        device["chunks"][int(id)] = bytes(image_data.data)
+
+    server = OcaDeviceServer()
+    server.add_object(
+        OcaFirmwareManager(object_number=OcaONo(FIRMWARE_MANAGER_ONO), lockable=OcaBoolean(False), role=OcaString("FirmwareManager")),
+        {
+            "start_update_process": step("start"),
+            "begin_active_image_update": step("begin"),
+            "add_image_data": add_image_data,
+            "verify_image": step("verify"),
+            "end_active_image_update": step("end"),
+            "end_update_process": step("finish"),
+        },
+    )
+    return server, device
+
+
+def test_upload_many(tmp_path) -> None:
+    image_path = tmp_path / "image.bin"
+    image_path.write_bytes(bytes(range(256)) * 20)
+
+    async def main() -> None:
+        amp, amp_device = firmware_server({3: OcaStatus.ProcessingFailed})
+        dsp, dsp_device = firmware_server({})
+        controllers, sessions = zip(await connect(amp, tmp_path, "amp"), await connect(dsp, tmp_path, "dsp"))
+        updates = []
+
+        image = open_image(str(image_path))
+        errors = await upload_many(controllers, image, b"sha", chunk_size=100, window=8, progress=updates.append)
+
+        assert errors == {"amp": None, "dsp": None}
+        for device in (amp_device, dsp_device):
+            assert device["steps"] == ["start", "begin", "verify", "end", "finish"]
+            assert sorted(device["chunks"]) == list(range(1, 53))
+            assert b"".join(device["chunks"][id] for id in range(1, 53)) == image
+        amp_updates = [update for update in updates if update.device == "amp"]
+        assert amp_updates[-1].done == amp_updates[-1].total == len(image)
+        assert amp_updates[-1].retries == 1
+        assert all(update.retries == 0 for update in updates if update.device == "dsp")
+
+        # A chunk that keeps failing stops that device's upload only
+        amp_device["chunks"].clear()
+        bad, _ = firmware_server({5: OcaStatus.BadFormat})
+        bad_controller, bad_session = await connect(bad, tmp_path, "bad")
+        errors = await upload_many([controllers[0], bad_controller], image, retries=0, chunk_size=100)
+        assert errors["amp"] is None
+        assert isinstance(errors["bad"], TransferError) and errors["bad"].status == OcaStatus.BadFormat
+        assert errors["bad"].step == "Chunk 4"
+
+        for controller, session, server in zip((*controllers, bad_controller), (*sessions, bad_session), (amp, dsp, bad)):
+            controller._stop_session()
+            session.cancel()
+            server.close()
+
+    asyncio.run(main())
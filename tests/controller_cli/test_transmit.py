@@ -0,0 +1,60 @@
+import asyncio
+from controller_cli.connect import OCAController, KEEPALIVE_TEMPLATE
+from controller_cli.transmit import TransmitClass, TransmitQueue
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain
+
+
+def drain(queue: TransmitQueue) -> list:
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+def test_weighted_rounds() -> None:
+    queue = TransmitQueue()
+    for i in range(20):
+        queue.put_nowait(("bulk", i), TransmitClass.BULK)
+        queue.put_nowait(("interactive", i), TransmitClass.INTERACTIVE)
+        queue.put_nowait(("notification", i), TransmitClass.NOTIFICATION)
+    queue.put_nowait("keepalive", TransmitClass.KEEPALIVE)
+
+    items = drain(queue)
+    assert items[0] == "keepalive"
+    first_round = [cls for cls, _ in items[1:14]]
+    assert first_round == ["interactive"] * 8 + ["notification"] * 4 + ["bulk"]
+    # FIFO within each class
+    assert [i for cls, i in items[1:] if cls == "bulk"] == list(range(20))
+    assert queue.qsize() == 0
+
+
+def test_waiting_pdus_are_not_starved() -> None:
+    now = [0.0]
+    queue = TransmitQueue(weights={TransmitClass.INTERACTIVE: 100, TransmitClass.NOTIFICATION: 1, TransmitClass.BULK: 1}, max_wait=0.5, clock=lambda: now[0])
+    queue.put_nowait("snapshot", TransmitClass.BULK)
+    now[0] = 0.1
+    for i in range(50):
+        queue.put_nowait(i, TransmitClass.INTERACTIVE)
+    assert queue.get_nowait() == 0
+    now[0] = 0.55
+    assert queue.get_nowait() == "snapshot"
+    assert queue.promoted == 1
+
+
+def test_setters_overtake_enumeration() -> None:
+    async def main() -> None:
+        controller = OCAController("Device", "udp")
+        await controller.send_commands([controller.make_command(0x1000 + i, OcaGain.get_gain) for i in range(3000)])
+        bulk = controller.transmit_queue.qsize(TransmitClass.BULK)
+        await controller.send_commands([controller.make_command(0x1000, OcaGain.set_gain, OcaDB(-1.0))])
+        controller._send_keepalive()
+        assert controller.transmit_queue.qsize(TransmitClass.INTERACTIVE) == 1
+
+        pdus = drain(controller.transmit_queue)
+        assert bulk > 10 and len(pdus) == bulk + 2
+        assert pdus[0] is KEEPALIVE_TEMPLATE
+        setter = next(i for i, pdu in enumerate(pdus) if pdu is not KEEPALIVE_TEMPLATE and pdu.commands[0].method_id == OcaGain.set_gain.method_id)
+        assert setter <= 2
+
+    asyncio.run(main())
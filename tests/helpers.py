@@ -0,0 +1,63 @@
+"""
+Stand-in devices and session helpers shared by the test modules
+"""
+
+import asyncio
+import struct
+import time
+from controller_cli.connect import OCAController
+from ocacomms.OcaDeviceServer import OcaDeviceServer
+from ocacomms.OcaDiscoveryCache import OcaDiscoveryCache, CachedService
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain
+
+
+class KeepaliveDevice(asyncio.DatagramProtocol):
+    """ Stand-in device that echoes keepalives """
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if data[7] == MessageType.KEEPALIVE.value:
+            self.transport.sendto(data, addr)
+
+
+class CommandDevice(KeepaliveDevice):
+    """ Stand-in device that also answers commands from a table of raw parameter data """
+    def __init__(self, values: dict) -> None:
+        self.values = values
+        self.received = []
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if data[7] != MessageType.COMMAND_RESPONSE_REQUIRED.value:
+            return super().datagram_received(data, addr)
+        count, = struct.unpack("!H", data[8:10])
+        offset = 10
+        responses = b""
+        for _ in range(count):
+            size, handle, ono, def_level, method_index = struct.unpack("!IIIHH", data[offset:offset + 16])
+            self.received.append((ono, f"{def_level}.{method_index}"))
+            parameters = self.values.get((ono, f"{def_level}.{method_index}"), b"\x00")
+            responses += struct.pack("!IIB", 9 + len(parameters), handle, 0) + parameters
+            offset += size
+        header = struct.pack("!HIBH", 1, 9 + len(responses), MessageType.RESPONSE.value, count)
+        self.transport.sendto(struct.pack("!B", SYNC_VAL) + header + responses, addr)
+
+
+def gain(ono: int, value: float) -> OcaGain:
+    return OcaGain(object_number=OcaONo(ono), lockable=OcaBoolean(False), role=OcaString(f"Gain {ono}"), gain=OcaDB(value))
+
+
+async def connect(server: OcaDeviceServer, tmp_path, name: str = "dsp") -> tuple[OCAController, asyncio.Task]:
+    """ Start `server` on a free port and connect a controller to it, warm started from a cache """
+    transport = await server.start("127.0.0.1", 0)
+    cache = OcaDiscoveryCache(str(tmp_path / f"{name}.json"))
+    cache.entries[f"udp/{name}"] = CachedService(
+        name=name, protocol="udp", addresses=["127.0.0.1"],
+        port=transport.get_extra_info("sockname")[1], updated=time.time()
+    )
+    controller = OCAController(name, "udp", discovery_cache=cache)
+    controller._revalidate = lambda: asyncio.sleep(0)  # No mDNS here
+    session = asyncio.create_task(controller.start())
+    await asyncio.wait_for(controller.connected.wait(), 2)
+    return controller, session
@@ -0,0 +1,126 @@
+import asyncio
+import struct
+from ocacomms.OcaDeviceServer import OcaDeviceServer, OcaMethodError
+from ocacomms.OcaNotificationFanout import NotificationFanout
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain, OcaMute
+from tests.helpers import connect, gain
+
+
+def test_get_set_and_errors(tmp_path) -> None:
+    def set_state(state: OcaUint8) -> None:
+        if int(state) not in (1, 2):
+            raise OcaMethodError(OcaStatus.ParameterOutOfRange)
+
+    async def main() -> None:
+        server = OcaDeviceServer([gain(0x1001, -6.0)])
+        server.add_object(
+            OcaMute(object_number=OcaONo(0x1002), lockable=OcaBoolean(False), role=OcaString("Mute"), state=OcaUint8(2)),
+            {"set_state": set_state},
+        )
+        controller, session = await connect(server, tmp_path)
+
+        get_gain = controller.make_command(0x1001, OcaGain.get_gain)
+        set_gain = controller.make_command(0x1001, OcaGain.set_gain, OcaDB(-3.0))
+        get_role = controller.make_command(0x1001, OcaGain.get_role)
+        unknown = controller.make_command(0x9999, OcaGain.get_gain)
+        bad_state = controller.make_command(0x1002, OcaMute.set_state, OcaUint8(7))
+        responses = await controller.request_many([get_gain, set_gain, get_role, unknown, bad_state])
+
+        assert [response.status_code for response in responses] == [
+            OcaStatus.OK, OcaStatus.OK, OcaStatus.OK, OcaStatus.BadONo, OcaStatus.ParameterOutOfRange
+        ]
+        assert OcaDB.from_bytes(responses[0].parameter_data[1:]) == -6.0
+        assert responses[2].parameter_data == b"\x01" + OcaString("Gain 4097").bytes
+        assert float(server.objects[0x1001].gain) == -3.0
+
+        controller._stop_session()
+        session.cancel()
+        server.close()
+
+    asyncio.run(main())
+
+
+def test_unknown_and_unhandled_methods(tmp_path) -> None:
+    async def main() -> None:
+        server = OcaDeviceServer([gain(0x1001, -6.0)])
+        controller, session = await connect(server, tmp_path)
+
+        unknown = Ocp1Command(
+            handle=controller.next_handle,
+            target_ono=0x1001,
+            method_id=OcaMethodID(def_level=4, method_index=9),
+            parameters=Ocp1Parameters(parameters=None),
+        )
+        # Defined by OcaRoot, but the server has no handler for it
+        unhandled = controller.make_command(0x1001, OcaGain.get_class_identification)
+        responses = await controller.request_many([unknown, unhandled])
+        assert [response.status_code for response in responses] == [OcaStatus.BadMethod, OcaStatus.NotImplemented]
+
+        controller._stop_session()
+        session.cancel()
+        server.close()
+
+    asyncio.run(main())
+
+
+def test_notifications(tmp_path) -> None:
+    async def main() -> None:
+        server = OcaDeviceServer([gain(0x1001, -6.0)])
+        controller, session = await connect(server, tmp_path)
+        notifications = []
+        controller.notification_handlers.append(notifications.append)
+
+        response = await controller.subscribe(0x1001)
+        assert response.status_code == OcaStatus.OK
+        await controller.request(controller.make_command(0x1001, OcaGain.set_gain, OcaDB(-1.5)))
+        await asyncio.sleep(0.05)
+        # Values superseded within the notification window are never sent
+        for value in (-2.5, -3.5, -4.5):
+            server.set_property(0x1001, "gain", OcaDB(value))
+        await asyncio.sleep(0.05)
+
+        values = [notification.property_changed(OcaDB)[1] for notification in notifications]
+        assert values == [-1.5, -4.5]
+        assert notifications[0].target_ono == 1055
+
+        # Subscriptions go away with the controller
+        server.drop_session(next(iter(server.sessions)))
+        assert server.subscriptions == {}
+
+        controller._stop_session()
+        session.cancel()
+        server.close()
+
+    asyncio.run(main())
+
+
+def test_fanout_batches_per_controller() -> None:
+    async def main() -> None:
+        sent = []
+        fanout = NotificationFanout(lambda addr, message_type, messages: sent.append((addr, messages)), window=0.01)
+        meters = [(0x2000 + i, 1, 1) for i in range(4)]
+        controllers = [("10.0.0.1", 50000 + i) for i in range(10)]
+        for addr in controllers:
+            for meter in meters:
+                fanout.subscribe(meter, (addr, 1055, 1, 1), b"ctx")
+
+        for level in range(5):
+            for meter in meters:
+                fanout.publish(meter, struct.pack("!HHfB", 4, 1, -float(level), 1), supersede=(4, 1))
+        await asyncio.sleep(0.05)
+
+        assert fanout.published == 20
+        assert fanout.superseded == 16 * len(controllers)
+        assert sorted(addr for addr, _ in sent) == controllers
+        for _, messages in sent:
+            assert len(messages) == len(meters)
+            header = struct.pack("!BHIBH", SYNC_VAL, 1, 9 + sum(map(len, messages)), MessageType.NOTIFICATION.value, len(messages))
+            pdu = Ocp1NotificationPdu.from_bytes(header + b"".join(messages))
+            assert [n.context for n in pdu.notifications] == [b"ctx"] * 4
+            assert [n.property_changed(OcaFloat32)[1] for n in pdu.notifications] == [-4.0] * 4
+
+        fanout.drop(controllers[0])
+        assert all(len(subscribers) == 9 for subscribers in fanout.subscriptions.values())
+
+    asyncio.run(main())
@@ -0,0 +1,121 @@
+import asyncio
+import os
+import socket
+import threading
+import pytest
+from typing import Optional
+from zeroconf import ServiceInfo
+from ocacomms.OcaDiscovery import OcaDiscovery, OcaListener, normalise_name
+from ocacomms.OcaDiscoveryCache import OcaDiscoveryCache
+
+SERVICE_TYPE = "_oca._udp.local."
+
+
+def service(name: str, address: str, port: int = 65000, properties: Optional[dict] = None) -> ServiceInfo:
+    return ServiceInfo(
+        SERVICE_TYPE,
+        f"{name}.{SERVICE_TYPE}",
+        addresses=[socket.inet_aton(address)],
+        port=port,
+        properties=properties or {},
+    )
+
+
+@pytest.mark.parametrize(
+    "name, expected",
+    [
+        ("Amp-1._oca._udp.local.", "amp-1"),
+        ("Stage.Left._oca._udp.local.", "stage.left"),
+        ("plain", "plain"),
+    ]
+)
+def test_normalise_name(name: str, expected: str) -> None:
+    assert normalise_name(name, SERVICE_TYPE) == expected
+
+
+def test_registry_indexes_and_removes() -> None:
+    listener = OcaListener(SERVICE_TYPE)
+    info = service("Amp-1", "10.0.0.1")
+    listener.add_service(info)
+    assert listener.services["amp-1"] is info
+    assert listener.addresses["10.0.0.1"] is info
+
+    moved = service("Amp-1", "10.0.0.2")
+    listener.add_service(moved)
+    assert listener.services["amp-1"] is moved
+    assert "10.0.0.1" not in listener.addresses
+
+    listener.remove_service("Amp-1._oca._udp.local.")
+    assert listener.services == {}
+    assert listener.addresses == {}
+    listener.remove_service("Unknown._oca._udp.local.")
+
+
+def test_wait_for_resolves_on_add() -> None:
+    async def main() -> None:
+        discovery = OcaDiscovery("udp")
+        waiter = asyncio.ensure_future(discovery.wait_for("AMP-1", timeout=1))
+        await asyncio.sleep(0)
+        discovery.listener.add_service(service("Amp-1", "10.0.0.1"))
+        assert (await waiter).port == 65000
+        assert discovery.find("amp-1") is not None
+        assert discovery.find_address("10.0.0.1") is not None
+        with pytest.raises(asyncio.TimeoutError):
+            await discovery.wait_for("Amp-2", timeout=0.01)
+        # Waiters that time out are not kept until the name appears
+        assert discovery.listener._waiters == {}
+
+    asyncio.run(main())
+
+
+def test_cache_round_trip(tmp_path) -> None:
+    path = str(tmp_path / "discovery.json")
+    cache = OcaDiscoveryCache(path)
+    cache.update("Amp-1", "udp", service("Amp-1", "10.0.0.1", properties={b"txtvers": b"1"}))
+
+    reloaded = OcaDiscoveryCache(path)
+    entry = reloaded.get("AMP-1", "udp")
+    assert entry.endpoint == ("10.0.0.1", 65000)
+    assert entry.properties == {"txtvers": "1"}
+    assert reloaded.get("Amp-1", "tcp") is None
+
+    reloaded.invalidate("amp-1", "udp")
+    assert OcaDiscoveryCache(path).get("amp-1", "udp") is None
+
+
+def test_cache_expires_entries(tmp_path) -> None:
+    cache = OcaDiscoveryCache(str(tmp_path / "discovery.json"), ttl=60)
+    cache.update("Amp-1", "udp", service("Amp-1", "10.0.0.1"))
+    cache.entries["udp/amp-1"].updated -= 120
+    assert cache.get("amp-1", "udp") is None
+
+
+def test_cache_shared_between_processes(tmp_path) -> None:
+    path = str(tmp_path / "discovery.json")
+    first, second = OcaDiscoveryCache(path), OcaDiscoveryCache(path)
+    first.update("Amp-1", "udp", service("Amp-1", "10.0.0.1"))
+    second.update("Amp-2", "udp", service("Amp-2", "10.0.0.2"))
+    first.invalidate("Amp-1", "udp")
+
+    # Each save merges, rather than replacing, what the other saved
+    assert set(OcaDiscoveryCache(path).entries) == {"udp/amp-2"}
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_cache_saves_off_the_event_loop(tmp_path) -> None:
+    async def main() -> None:
+        path = str(tmp_path / "discovery.json")
+        cache = OcaDiscoveryCache(path)
+        threads = []
+        write = cache._write
+        cache._write = lambda *args: threads.append(threading.current_thread()) or write(*args)
+        for i in range(10):
+            cache.update(f"Amp-{i}", "udp", service(f"Amp-{i}", f"10.0.0.{i}"))
+        assert cache.get("amp-9", "udp") is not None
+
+        # One save in a worker thread, and one more for everything that changed meanwhile
+        await cache.flush()
+        assert len(threads) == 2 and threading.main_thread() not in threads
+        assert len(OcaDiscoveryCache(path).entries) == 10
+
+    asyncio.run(main())
@@ -0,0 +1,63 @@
+import asyncio
+import struct
+from controller_cli.connect import OCAController, State
+from ocacomms.OcaDeviceServer import OcaDeviceServer
+from ocacomms.OcaWebSocket import OP_BINARY, WebSocketError, encode_frame, mask, split_pdus
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain
+from tests.helpers import gain
+
+
+def test_framing() -> None:
+    keepalive = KEEPALIVE.pack(SYNC_VAL, 1, KEEPALIVE.size - 1, MessageType.KEEPALIVE.value, 1, 5)
+    assert split_pdus(keepalive * 3) == [keepalive] * 3
+    try:
+        split_pdus(keepalive + keepalive[:-1])
+    except WebSocketError:
+        pass
+    else:
+        raise AssertionError("Truncated PDU accepted")
+
+    key = b"\x01\x02\x03\x04"
+    assert mask(mask(b"hello world", key), key) == b"hello world"
+    frame = encode_frame(OP_BINARY, bytes(300), masked=True)
+    assert frame[:4] == struct.pack("!BBH", 0x80 | OP_BINARY, 0x80 | 126, 300)
+    assert mask(frame[8:], frame[4:8]) == bytes(300)
+
+
+def test_controller_over_websocket() -> None:
+    async def main() -> None:
+        server = OcaDeviceServer([gain(0x1000 + i, 0.0) for i in range(100)])
+        websocket_server = await server.start_websocket("127.0.0.1", 0)
+        controller = OCAController("panel", "websocket", endpoint=websocket_server.sockets[0].getsockname()[:2])
+        session = asyncio.create_task(controller.start())
+        await asyncio.wait_for(controller.connected.wait(), 2)
+
+        # Several PDUs each way, packed into fewer WebSocket messages
+        setters = [controller.make_command(0x1000 + i, OcaGain.set_gain, OcaDB(-i / 4)) for i in range(100)]
+        await asyncio.sleep(0.05)  # Let the session's own probes settle
+        device_end, = server.websockets.values()
+        sent_before, replied_before = controller.protocol.websocket.frames_sent, device_end.frames_sent
+        responses = await controller.request_many(setters)
+        assert [response.status_code for response in responses] == [OcaStatus.OK] * 100
+        assert [float(server.objects[0x1000 + i].gain) for i in range(100)] == [-i / 4 for i in range(100)]
+        assert len(controller.create_commandrrq_batches(setters)) > 1
+        assert controller.protocol.websocket.frames_sent - sent_before == 1
+        assert device_end.frames_sent - replied_before == 1
+
+        notifications = []
+        controller.notification_handlers.append(notifications.append)
+        await controller.subscribe(0x1001)
+        server.set_property(0x1001, "gain", OcaDB(-9.0))
+        await asyncio.sleep(0.05)
+        assert [notification.property_changed(OcaDB)[1] for notification in notifications] == [-9.0]
+
+        # A closed WebSocket is noticed straight away
+        server.close()
+        await asyncio.sleep(0.05)
+        assert controller.state in (State.DISCONNECTED, State.CONNECTING)
+
+        controller._stop_session()
+        session.cancel()
+
+    asyncio.run(main())
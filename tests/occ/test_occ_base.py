@@ -101,10 +101,16 @@ def test_OcaPrimitives(
             [b"Toast"]
         ),
         (OcaBitstring, {
-            b"\x00\x10\x00\x01": OcaBitstring(bitstring=BitArray(hex="0x0001")), 
-            b"\x00\x10\x10\x00": OcaBitstring(bitstring=BitArray(hex="0x1000"))
+            b"\x00\x10\x00\x01": OcaBitstring(num_bits=16, data=b"\x00\x01"), 
+            b"\x00\x10\x10\x00": OcaBitstring(num_bits=16, data=b"\x10\x00")
         }, 
             None
+        ),
+        (OcaBlob, {
+            b"\x00\x03\x01\x02\x03": OcaBlob(data=b"\x01\x02\x03"),
+            b"\x00\x00": OcaBlob(data=b"")
+        },
+            None
         )
     ]
 )
@@ -141,8 +147,10 @@ def test_SerialisableBase_unpack(
         (OcaUint32(0xAF_FF_FF_FF), b"\xAF\xFF\xFF\xFF"),
         (OcaUint64(0xAF_FF_FF_FF_FF_FF_FF_FF), b"\xAF\xFF\xFF\xFF\xFF\xFF\xFF\xFF"),
         (OcaString("Beans"), b"\x00\x05Beans"),
-        (OcaBitstring(bitstring=BitArray(hex="0x0001")), b"\x00\x10\x00\x01"),
-        (OcaBitstring(bitstring=BitArray(hex="0x1000")), b"\x00\x10\x10\x00")
+        (OcaBitstring(num_bits=16, data=b"\x00\x01"), b"\x00\x10\x00\x01"),
+        (OcaBitstring(num_bits=16, data=b"\x10\x00"), b"\x00\x10\x10\x00"),
+        (OcaBlob(data=[1, 2, 3]), b"\x00\x03\x01\x02\x03"),
+        (OcaBlobFixedLen.length(3)(data=b"abc"), b"abc")
     ]
 )
 def test_SerialisableBase_pack(
@@ -150,3 +158,56 @@ def test_SerialisableBase_pack(
     obj_bytes: bytes
 ) -> None:
     assert obj.bytes == obj_bytes
+
+
+def test_OcaString_utf8() -> None:
+    role = OcaString("Lautstärke → Süd")
+    assert role.bytes == b"\x00\x10" + "Lautstärke → Süd".encode("UTF-8")
+    data = b"\xAA" + role.bytes + OcaString("Ä").bytes + b"\xFF"
+    value, consumed = OcaString.unpack_from(data, 1)
+    assert value == "Lautstärke → Süd"
+    assert consumed == len(role.bytes)
+    assert OcaString.unpack_from(data, 1 + consumed) == (OcaString("Ä"), 4)
+
+    # Decoded roles share one string object
+    assert OcaString.from_bytes(b"\x00\x04Gain").value is OcaString.from_bytes(b"\x00\x04Gain").value
+
+    for truncated in (b"\x00\x05Bean", b"\x00\x03\xc3\xa4\xc3\xa4"):
+        with pytest.raises(struct.error):
+            OcaString.from_bytes(truncated)
+
+
+def test_OcaBitstring_bits() -> None:
+    bits = [True, False, True, True, False, False, False, False, False, True]
+    bitstring = OcaBitstring.from_bits(bits)
+    assert bitstring.bytes == b"\x00\x0A\xB0\x40"
+    assert len(bitstring) == 10
+    assert bitstring[0] and not bitstring[1] and bitstring[-1]
+    assert bitstring.bits() == bits
+    assert int(bitstring) == 0b1011000001
+    assert OcaBitstring.from_int(0b1011000001, 10) == bitstring
+    assert OcaBitstring.unpack_from(b"\x01" + bitstring.bytes + b"\x02", 1) == (bitstring, 4)
+    with pytest.raises(IndexError):
+        bitstring[10]
+    for num_bits, data in ((3, b""), (8, b"\x00\x00"), (0, b"\x00")):
+        with pytest.raises(pydantic.error_wrappers.ValidationError):
+            OcaBitstring(num_bits=num_bits, data=data)
+
+
+def test_OcaBlob_slices() -> None:
+    data = memoryview(b"\xAA\x00\x04blob\xFF")
+    blob, consumed = OcaBlob.unpack_from(data, 1)
+    assert consumed == 6 and blob.data == b"blob" and len(blob) == blob.data_size == 4
+    assert isinstance(blob.data, memoryview) and blob.data.obj is data.obj
+    buffer = bytearray(8)
+    assert blob.pack_into(buffer, 1) == 7
+    assert buffer == b"\x00\x00\x04blob\x00"
+    with pytest.raises(struct.error):
+        OcaBlob.from_bytes(b"\x00\x05blob")
+
+    # Fixed length types are built once per length
+    assert OcaBlobFixedLen.length(4) is OcaBlobFixedLen.length(4)
+    assert OcaBlobFixedLen.length(4).length == 4
+    assert OcaBlobFixedLen.length(4).unpack_from(data, 3) == (OcaBlobFixedLen.length(4)(data=b"blob"), 4)
+    with pytest.raises(pydantic.error_wrappers.ValidationError):
+        OcaBlobFixedLen.length(4)(data=b"abc")
@@ -0,0 +1,106 @@
+import pytest
+import struct
+from ocacore.ocp1 import *
+from ocacore.occ.worker import OcaGain
+
+
+def command(handle: int, *arguments: OCCBase) -> Ocp1Command:
+    return Ocp1Command(
+        handle=handle,
+        target_ono=0x1001,
+        method_id=OcaGain.set_gain.method_id,
+        parameters=Ocp1Parameters(parameters=[Parameter(value=argument) for argument in arguments] or None),
+    )
+
+
+def test_command_pdu_encoding() -> None:
+    commands = [
+        command(1, OcaDB(-6.0)),
+        command(2),
+        command(0xFFFFFFFF, OcaString("Süd"), OcaUint16(7), OcaEvent(emitter_ono=OcaONo(0x1001), event_id=OcaRoot.property_changed_event)),
+    ]
+    pdu = Ocp1CommandPdu(
+        header=Ocp1Header(
+            protocol_version=OcaUint16(1),
+            message_size=OcaUint32(9 + sum(c.encoded_size for c in commands)),
+            message_type=MessageType.COMMAND_RESPONSE_REQUIRED,
+            message_count=OcaUint16(len(commands)),
+        ),
+        commands=commands,
+    )
+    expected_parameters = [
+        b"\x01" + struct.pack("!f", -6.0),
+        b"\x00",
+        b"\x03" + b"\x00\x03" + "Süd".encode("UTF-8") + b"\x00\x07" + struct.pack("!IHH", 0x1001, 1, 1),
+    ]
+    expected = b"".join(
+        struct.pack("!IIIHH", 16 + len(parameters), int(c.handle), 0x1001, 4, 2) + parameters
+        for c, parameters in zip(commands, expected_parameters)
+    )
+    expected = struct.pack("!BHIBH", SYNC_VAL, 1, 9 + len(expected), 1, 3) + expected
+
+    assert [c.encoded_size for c in commands] == [16 + len(parameters) for parameters in expected_parameters]
+    assert pdu.encoded_size == len(expected)
+    assert pdu.bytes == expected
+
+    # The encoder reuses its buffer, and grows it for larger PDUs
+    encoder = Ocp1Encoder(size=16)
+    assert encoder.encode(pdu) == expected
+    buffer = encoder.buffer
+    assert encoder.encode(pdu) == expected
+    assert encoder.buffer is buffer
+
+    # Received commands are sent on as their raw parameters
+    received = Ocp1CommandPdu.from_bytes(expected)
+    assert received.bytes == expected
+
+
+def test_templates() -> None:
+    keepalive = Ocp1KeepAlivePdu(
+        header=Ocp1Header(
+            protocol_version=OcaUint16(1),
+            message_size=OcaUint32(11),
+            message_type=MessageType.KEEPALIVE,
+            message_count=OcaUint16(1),
+        ),
+        heartbeat=OcaUint16(5),
+    )
+    template = Ocp1PduTemplate.of(keepalive)
+    assert template.bytes == struct.pack("!BHIBHH", SYNC_VAL, 1, 11, 4, 1, 5)
+    assert Ocp1Encoder().encode(template) is template.bytes
+    assert Ocp1KeepAlivePdu.from_bytes(template.bytes) == keepalive
+
+    messages = [struct.pack("!IIBB", 10, handle, 0, 0) for handle in (1, 2)]
+    pdu = bytearray(PDU_HEADER_TEMPLATES[MessageType.RESPONSE]) + b"".join(messages)
+    patch_header(pdu, 0, len(pdu) - 1, len(messages))
+    assert [response.handle for response in marshal(bytes(pdu), {}, None).responses] == [1, 2]
+
+
+def test_handle_table() -> None:
+    table = HandleTable(slot_bits=2)
+    handles = [table.allocate(command(0)) for _ in range(4)]
+    assert sorted(handle & 3 for handle in handles) == [0, 1, 2, 3]
+    assert 0 not in handles
+    assert len(table) == 4
+    with pytest.raises(HandleTableFull):
+        table.allocate()
+
+    # A released slot comes back with a new generation, and the old handle is stale
+    assert table.release(handles[0]) is not None
+    reused = table.allocate(command(1))
+    assert reused & 3 == handles[0] & 3 and reused != handles[0]
+    assert handles[0] not in table and table.get(handles[0]) is None
+    assert int(table[reused].handle) == 1
+    assert table.release(handles[0]) is None
+
+    # Generations wrap within uint32 without ever making handle 0
+    wrapping = HandleTable(slot_bits=24)
+    wrapping[0xFF000000] = command(2)
+    wrapping.release(0xFF000000)
+    assert wrapping.allocate() == 0x01000000
+
+    # Handles from elsewhere take over their slot, and reclaim keeps those still wanted
+    table[handles[1] + 4] = command(3)
+    assert handles[1] not in table and int(table[handles[1] + 4].handle) == 3
+    assert table.reclaim(lambda handle: handle == reused) == 3
+    assert list(table) == [reused]
@@ -0,0 +1,74 @@
+import math
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from ocacore.response import ClassicalFilter, ParametricEQ, ResponseChain, Tabulated, log_frequencies, prototype
+from ocacore.occ.types.worker import OcaClassicalFilterShape, OcaFilterPassband, OcaParametricEQShape
+
+
+def biquad(b: list[float], a: list[float], frequencies: np.ndarray, sample_rate: float) -> np.ndarray:
+    z = np.exp(-2j * np.pi * frequencies / sample_rate)
+    return (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+
+
+def test_classical_filters() -> None:
+    chain = ResponseChain(np.array([100.0, 1000.0, 10000.0]))
+    chain.append(ClassicalFilter(OcaClassicalFilterShape.BUTTERWORTH, OcaFilterPassband.LOW_PASS, 1000, order=2))
+    assert chain.magnitude[1] == pytest.approx(-3.0103, abs=1e-4)
+    assert chain.magnitude[2] == pytest.approx(-40.0, abs=1e-3)
+    assert chain.phase[1] == pytest.approx(-90)
+
+    chain[0] = ClassicalFilter(OcaClassicalFilterShape.LINKWITZ_RILEY, OcaFilterPassband.HIGH_PASS, 1000, order=4)
+    assert chain.magnitude[1] == pytest.approx(-6.0206, abs=1e-4)
+    assert chain.magnitude[0] == pytest.approx(-80.0, abs=1e-3)
+
+    # As scipy.signal: besselap(2, "phase") and cheb1ap(2, 1)
+    poles, _ = prototype(OcaClassicalFilterShape.BESSEL, 2)
+    assert sorted(poles, key=lambda pole: pole.imag) == pytest.approx([-math.sqrt(3) / 2 - 0.5j, -math.sqrt(3) / 2 + 0.5j])
+    poles, gain = prototype(OcaClassicalFilterShape.CHEBYSHEV, 2, 1.0)
+    assert poles[0].real == pytest.approx(-0.548867, abs=1e-6) and gain == pytest.approx(0.982613, abs=1e-6)
+
+    all_pass = ResponseChain(log_frequencies(points=32), stages=[
+        ClassicalFilter(OcaClassicalFilterShape.BUTTERWORTH, OcaFilterPassband.ALL_PASS, 1000, order=3)
+    ])
+    assert np.allclose(all_pass.magnitude, 0)
+    with pytest.raises(ValueError):
+        prototype(OcaClassicalFilterShape.LINKWITZ_RILEY, 3)
+
+
+def test_digital_eq_matches_biquads() -> None:
+    sample_rate, frequency, gain, q = 48000, 1000, 6.0, 2.0
+    frequencies = log_frequencies(20, 20000, 128)
+    chain = ResponseChain(frequencies, sample_rate, [ParametricEQ(OcaParametricEQShape.PEQ, frequency, gain, q)])
+
+    # RBJ cookbook peaking EQ
+    a = 10 ** (gain / 40)
+    w0 = 2 * math.pi * frequency / sample_rate
+    alpha = math.sin(w0) / (2 * q)
+    expected = biquad(
+        [1 + alpha * a, -2 * math.cos(w0), 1 - alpha * a], [1 + alpha / a, -2 * math.cos(w0), 1 - alpha / a],
+        frequencies, sample_rate,
+    )
+    assert np.allclose(chain.magnitude, 20 * np.log10(np.abs(expected)))
+    assert np.allclose(chain.phase, np.angle(expected, deg=True))
+    with pytest.raises(ValueError):
+        ResponseChain(frequencies, 32000)
+
+
+def test_incremental_updates() -> None:
+    frequencies = log_frequencies(points=64)
+    bands = [ParametricEQ(OcaParametricEQShape.PEQ, 100 * 2 ** i, -3.0, 1.4) for i in range(8)]
+    chain = ResponseChain(frequencies, 48000, bands)
+    chain.append(ParametricEQ(OcaParametricEQShape.NOTCH, 1000, q=4))
+    chain.append(Tabulated.from_frequency_response({20.0: 0.0, 20000.0: -6.0}))
+    assert np.isfinite(chain.magnitude).all()
+    assert chain.magnitude.flags.writeable is False
+
+    for gain in (6.0, -12.0, 0.0):
+        chain[3] = chain[3]._replace(gain=gain)
+    del chain[-2]
+    fresh = ResponseChain(frequencies, 48000, list(chain))
+    assert np.allclose(chain.magnitude, fresh.magnitude)
+    assert np.allclose(chain.phase, fresh.phase)
+    assert chain.frequency_response()[20.0] == pytest.approx(chain.magnitude[0])